@@ -0,0 +1,276 @@
+#!/usr/bin/env  python3
+# benchmarks of the imports, computations and charts of the scripts, on synthetic source files (see synth.py):
+# the scripts are run on a work dir (their paths being redirected there), and the timings saved as json,
+# to be compared between commits
+#   python bench/run.py run --scale 0.1 --path /tmp/bench
+#   python bench/run.py compare /tmp/bench/bench_a.json /tmp/bench/bench_b.json
+import os
+import sys
+import io
+import json
+import time
+import shutil
+import fnmatch
+import platform
+import importlib.util
+import contextlib
+import subprocess
+import traceback
+import click
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(HERE, "..")
+sys.path.insert(0, ROOT)
+import synth
+import charts
+import memo
+
+
+def _load_script(name, path):
+    spec = importlib.util.spec_from_file_location(name, os.path.join(ROOT, path))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+# (the root script is not imported as "run", which is this one)
+run = _load_script("c19_run", "run.py")
+cold_run = _load_script("cold_run", "cold/run.py")
+eurostat_run = _load_script("eurostat_run", "eurostat/run.py")
+se_run = _load_script("se_run", "se_run.py")
+
+
+@click.group()
+def main():
+    pass
+
+
+def _set_paths(path):
+    # redirect the data, dbs and results of the scripts to the work dir
+    run.HERE = path
+    cold_run.HERE = os.path.join(path, "cold")
+    cold_run.DATA_PATH = os.path.join(path, "data")
+    cold_run.DB_PATH = os.path.join(path, "cold", "data.sqlite")
+    eurostat_run.HERE = os.path.join(path, "eurostat")
+    eurostat_run.DATA_DIR = os.path.join(path, "eurostat", "data")
+    eurostat_run.RESULTS_DIR = os.path.join(path, "eurostat", "results")
+    se_run.HERE = path
+    se_run.DATA_DIR = os.path.join(path, "data", "se")
+    for dpath in ("data/se", "results", "cold/results", "eurostat/data", "eurostat/results"):
+        synth.makedirs(os.path.join(path, dpath))
+    # (plot_deaths renders its README from the template next to the script)
+    shutil.copy(os.path.join(ROOT, "eurostat", "README.md.tmpl"), os.path.join(path, "eurostat"))
+
+
+# generation
+
+@main.command("generate")
+@click.option("--scale", default=0.1, help="Volume of the generated data, 1 being the real one")
+@click.option("--seed", default=0)
+@click.option("--path", required=True, help="Work dir")
+def cmd_generate(scale, seed, path):
+    generate(os.path.abspath(path), scale, seed)
+
+
+def generate(path, scale, seed):
+    _set_paths(path)
+    data_path = os.path.join(path, "data")
+    deces_fnames = sorted(set(os.path.basename(src) for src in run.DECES_FILES_SRC + cold_run.DECES_FILES_SRC))
+    nb_rows = 0
+    for idx, fname in enumerate(deces_fnames):
+        nb_rows += synth.write_deces_file(os.path.join(data_path, fname), fname, scale, seed, idx)
+    print(f"deces: {len(deces_fnames)} files, {nb_rows} rows")
+    for conf in run.DATA_FILES_CONFS:
+        if conf["type"] in ("pyramide-des-ages", "pyramide-des-ages-2"):
+            synth.write_pda_file(os.path.join(data_path, run._get_conf_fname(conf)), conf, seed)
+    nb_rows = synth.write_meteo_file(os.path.join(data_path, cold_run.METEO_FNAME), cold_run.FIRST_DATE, cold_run.LAST_DATE, scale, seed)
+    print(f"meteo: {nb_rows} rows")
+    geos = synth.eurostat_geos(eurostat_run.COUNTRY_CODES, scale)
+    eurostat_data = eurostat_run.DATA_DIR
+    synth.write_eurostat_by_age_sex(os.path.join(eurostat_data, "population_age_sex.tsv.gz"), "unit,age,sex,geo\\time", range(1960, 2021+1), geos, seed, 0)
+    synth.write_eurostat_by_age_sex(os.path.join(eurostat_data, "deaths_age_sex.tsv.gz"), "unit,sex,age,geo\\time", range(1960, 2020+1), geos, seed, 1, rates=True)
+    synth.write_eurostat_deaths(os.path.join(eurostat_data, "deaths.tsv.gz"), geos, seed)
+    print(f"eurostat: {len(geos)} geos")
+    synth.write_se_deaths_file(os.path.join(se_run.DATA_DIR, se_run.DATA_SE_DEATHS_CONF["name"]), se_run.YEARS, seed)
+    for conf in se_run.DATA_SE_AGE_PYRAMIDS_CONFS:
+        synth.write_se_age_pyramid_file(os.path.join(se_run.DATA_DIR, conf["name"]), conf["year"], seed)
+    with open(os.path.join(path, "synth.json"), "w") as file:
+        json.dump({"scale": scale, "seed": seed}, file)
+
+
+# benchmarks
+
+@main.command("run")
+@click.option("--scale", default=0.1, help="Volume of the generated data, 1 being the real one")
+@click.option("--seed", default=0)
+@click.option("--path", required=True, help="Work dir (the data are generated again only if the scale or seed changed)")
+@click.option("--only", multiple=True, help="Benchmarks to run, as patterns (ex: 'import.*', 'compute.*forecast*')")
+@click.option("--workers", default=1, help="Nb of processes for the imports and charts rendering")
+@click.option("--output", help="Json file of the results, default: bench_<commit>_<scale>.json in the work dir")
+def cmd_run(scale, seed, path, only, workers, output):
+    path = os.path.abspath(path)
+    results = run_benchmarks(path, scale, seed, only=only, workers=workers)
+    output = output or os.path.join(path, f"bench_{results['commit'] or 'nogit'}_{scale}.json")
+    with open(output, "w") as file:
+        json.dump(results, file, indent=2)
+    print(f"results saved in {output}")
+
+
+def run_benchmarks(path, scale, seed, only=(), workers=1):
+    synth.makedirs(path)
+    stamp_path = os.path.join(path, "synth.json")
+    stamp = json.load(open(stamp_path)) if os.path.exists(stamp_path) else None
+    results = {
+        "scale": scale,
+        "seed": seed,
+        "commit": _git_commit(),
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "workers": workers,
+        "benchmarks": {},
+    }
+    if stamp != {"scale": scale, "seed": seed}:
+        _bench(results, "generate", lambda: generate(path, scale, seed), quiet=False)
+    _set_paths(path)
+    state = {}
+    for name, fun in _benchmarks(state, workers):
+        if not only or any(fnmatch.fnmatch(name, pattern) for pattern in only):
+            _bench(results, name, fun)
+    return results
+
+
+def _benchmarks(state, workers):
+    # (name, fun), run in this order: the computations use the imported dbs and the loaded source
+    # (the imports are full ones, so that a run can be limited to the computations with --only)
+    def _import_run():
+        run._init_db(full=True)
+        run._import_data(workers=workers)
+        run._index_db()
+    def _import_cold(name):
+        cold_run.init_db(name=name, full=True)
+        cold_run.import_data(name=name, workers=workers)
+    def _import_eurostat():
+        eurostat_run.init_db()
+        eurostat_run.import_data()
+    def _import_se():
+        se_run._init_db()
+        se_run._import_data()
+    def _load():
+        state["src"] = run._load_all_source()
+    def _compute(fun, *args, **kwargs):
+        def _fun():
+            state.setdefault("report", []).append(fun(*args, src=state.get("src"), **kwargs))
+        return _fun
+    def _render():
+        charts.render_charts(state.get("report", []), workers=workers)
+    def _cold(fun, **kwargs):
+        def _fun():
+            with cold_run.db_connect() as conn:
+                fun(conn, **kwargs)
+        return _fun
+    def _plot_deaths():
+        # (README.md is written in the current dir)
+        with _chdir(eurostat_run.HERE):
+            eurostat_run.plot_deaths(workers=workers)
+    return [
+        ("import.run", _import_run),
+        ("import.cold_deces", lambda: _import_cold("deces")),
+        ("import.cold_pda", lambda: _import_cold("pda")),
+        ("import.cold_meteo", lambda: _import_cold("meteo")),
+        ("import.eurostat", _import_eurostat),
+        ("import.se", _import_se),
+        ("load.run", _load),
+        ("compute.taux_mortalite_par_age_pics", _compute(run.compute_taux_mortalite_par_age, "pics_2017_2020")),
+        ("compute.taux_mortalite_par_age_2000_2021", _compute(run.compute_taux_mortalite_par_age, "2000_to_2021")),
+        ("compute.deces_par_date", _compute(run.compute_deces_par_date, "pics_2017_2020")),
+        ("compute.population_par_age", _compute(run.compute_population_par_age, "pics_2017_2020")),
+        ("compute.deces_par_age", _compute(run.compute_deces_par_age, "pics_2017_2020")),
+        ("compute.deces_par_age_simulate", _compute(run.compute_deces_par_age, "2016_2020", simulate=True)),
+        ("compute.mortalite_standardise", _compute(run.compute_mortalite_standardise, "2000_to_2021")),
+        ("compute.mortalite_standardise_juin", _compute(run.compute_mortalite_standardise, "2000_to_2021_juin")),
+        ("compute.mortality_forecast", _compute(run.compute_mortality_forecast)),
+        ("compute.mortality_forecast_scenarios", _compute(run.compute_mortality_forecast, nb_scenarios=1000, seed=0)),
+        ("compute.surmortality", _compute(run.compute_surmortality, debut=2010)),
+        ("compute.standard_mortality_by_date_clage", _compute(run.compute_standard_mortality_by_date_clage, debut=2010)),
+        ("render.run", _render),
+        ("cold.plot_mortalite_par_temperature", _cold(cold_run.plot_mortalite_par_temperature)),
+        ("cold.estimate_mortalite_par_temperature", _cold(cold_run.estimate_mortalite_par_temperature)),
+        ("eurostat.plot_deaths", _plot_deaths),
+        ("se.compute_mortalite_moyenne_par_age", se_run._compute_mortality_rate_meaned_by_age),
+    ]
+
+
+def _bench(results, name, fun, quiet=True):
+    # wall and cpu times (cpu of this process and of its terminated children, ex: import or render workers)
+    memo.clear()
+    error = None
+    out = io.StringIO() if quiet else sys.stdout
+    start, start_cpu = time.perf_counter(), _cpu_time()
+    try:
+        with contextlib.redirect_stdout(out):
+            fun()
+    except Exception as exc:
+        error = "".join(traceback.format_exception_only(type(exc), exc)).strip()
+    res = {"seconds": time.perf_counter() - start, "cpu_seconds": _cpu_time() - start_cpu}
+    if error:
+        res["error"] = error
+    results["benchmarks"][name] = res
+    print(f"{name:<45} {res['seconds']:>9.3f}s {res['cpu_seconds']:>9.3f}s cpu" + (f"  ERROR {error}" if error else ""))
+
+
+def _cpu_time():
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+@contextlib.contextmanager
+def _chdir(path):
+    cwd = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(cwd)
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# comparison
+
+@main.command("compare")
+@click.argument("before")
+@click.argument("after")
+def cmd_compare(before, after):
+    before, after = json.load(open(before)), json.load(open(after))
+    for res in (before, after):
+        print(f"{res['commit']}: scale {res['scale']}, seed {res['seed']}, {res['date']}")
+    names = list(before["benchmarks"]) + [name for name in after["benchmarks"] if name not in before["benchmarks"]]
+    print(f"{'':<45} {'before':>10} {'after':>10} {'ratio':>7}")
+    for name in names:
+        bres, ares = before["benchmarks"].get(name), after["benchmarks"].get(name)
+        cols = [_fmt_result(bres), _fmt_result(ares)]
+        ratio = ""
+        if bres and ares and "error" not in bres and "error" not in ares and bres["seconds"] > 0:
+            ratio = f"{ares['seconds'] / bres['seconds']:.2f}x"
+        print(f"{name:<45} {cols[0]:>10} {cols[1]:>10} {ratio:>7}")
+
+
+def _fmt_result(res):
+    if res is None:
+        return "-"
+    if "error" in res:
+        return "error"
+    return f"{res['seconds']:.3f}s"
+
+
+if __name__ == "__main__":
+    main()
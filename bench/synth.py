@@ -0,0 +1,324 @@
+# deterministic synthetic versions of the source files, in their real formats,
+# for benchmarks without downloads
+# volumes are given as a scale of the real ones (REAL_VOLUMES), files of fixed layout
+# (age pyramids, swedish csvs) being generated at their real size whatever the scale
+import os
+import re
+import gzip
+import zipfile
+from xml.sax.saxutils import escape
+
+import numpy as np
+
+REAL_VOLUMES = {
+    "deces_per_year": 600000,     # INSEE death records
+    "meteo_stations": 62,         # SYNOP stations, 8 observations a day
+    "eurostat_geos": 60,          # countries and aggregates of the eurostat files
+}
+
+NB_AGES = 106  # 0 to 105 (and more)
+
+
+def rng_for(seed, *keys):
+    # one independent generator by file, so that a file does not depend on the others
+    return np.random.default_rng([seed, *keys])
+
+
+# population and mortality shapes
+
+def _pyramid(total, nb_ages=NB_AGES):
+    # population by age: flat then decreasing (survival), normalized to total
+    ages = np.arange(nb_ages)
+    survival = np.exp(-0.00006 * (np.exp(0.095 * ages) - 1) / 0.095)
+    pop = survival * (1 + 0.15 * np.sin(ages / 9))
+    return pop / pop.sum() * total
+
+def _mortality_rates(nb_ages=NB_AGES):
+    # gompertz-like rates by age, and infant mortality
+    ages = np.arange(nb_ages)
+    return np.minimum(0.00006 * np.exp(0.095 * ages) + 0.0002 + 0.0035 * (ages == 0), 0.6)
+
+def _death_age_weights():
+    weights = _pyramid(1) * _mortality_rates()
+    return weights / weights.sum()
+
+
+# INSEE deces: fixed-width records, one by line
+# (sex at 80, birth date at 81:89, death date at 154:162, death place at 162:167)
+
+RECORD_LEN = 198
+DECES_BLOCK_ROWS = 200000
+
+def deces_file_period(fname):
+    # (first day, nb of days) of the deaths of a file: deces-2020.txt, deces-2021-t1.txt, deces-2021-m10.txt
+    year, kind, num = re.match(r"deces-(\d{4})(?:-([tm])(\d+))?", fname).groups()
+    if kind is None:
+        start, end = np.datetime64(year, "Y"), np.datetime64(year, "Y") + 1
+    elif kind == "t":
+        start = np.datetime64(year, "M") + 3 * (int(num) - 1)
+        end = start + 3
+    else:
+        start = np.datetime64(year, "M") + int(num) - 1
+        end = start + 1
+    start, end = start.astype("datetime64[D]"), end.astype("datetime64[D]")
+    return int(start.astype(np.int64)), int((end - start).astype(np.int64))
+
+def deces_file_rows(fname, scale):
+    _, nb_days = deces_file_period(fname)
+    return int(round(REAL_VOLUMES["deces_per_year"] * scale * nb_days / 365))
+
+def _communes(seed):
+    # death place codes (metropolitan, overseas and abroad), with their weights
+    rng = rng_for(seed, 0)
+    deps = [f"{d:02d}" for d in range(1, 96) if d != 20] + ["2A", "2B"]
+    codes = [dep + f"{c:03d}" for dep in deps for c in sorted(rng.choice(900, 120, replace=False) + 1)]
+    nb_metro = len(codes)
+    codes += [dep + f"{c:02d}" for dep in ("971", "972", "973", "974", "976") for c in range(1, 31)]
+    nb_dom = len(codes) - nb_metro
+    codes += [f"99{c:03d}" for c in range(100, 450, 7)]
+    nb_abroad = len(codes) - nb_metro - nb_dom
+    zipf = 1 / np.arange(1, 121) ** 0.8
+    weights = np.concatenate([
+        np.tile(zipf / zipf.sum(), nb_metro // 120) / (nb_metro // 120) * 0.96,
+        np.full(nb_dom, 0.015 / nb_dom),
+        np.full(nb_abroad, 0.025 / nb_abroad),
+    ])
+    chars = np.frombuffer("".join(codes).encode(), dtype=np.uint8).reshape(-1, 5)
+    return chars, weights / weights.sum()
+
+def _put_digits(arr, col, vals, width):
+    for i in range(width):
+        arr[:, col + i] = vals // 10 ** (width - 1 - i) % 10 + ord("0")
+
+def _put_date(arr, col, days):
+    dates = days.astype("datetime64[D]")
+    months = dates.astype("datetime64[M]")
+    _put_digits(arr, col, dates.astype("datetime64[Y]").astype(np.int64) + 1970, 4)
+    _put_digits(arr, col + 4, months.astype(np.int64) % 12 + 1, 2)
+    _put_digits(arr, col + 6, (dates - months.astype("datetime64[D]")).astype(np.int64) + 1, 2)
+
+def write_deces_file(path, fname, scale, seed, file_idx):
+    first_day, nb_days = deces_file_period(fname)
+    nb_rows = deces_file_rows(fname, scale)
+    rng = rng_for(seed, 1, file_idx)
+    communes, commune_weights = _communes(seed)
+    doy = (np.arange(nb_days) + first_day) % 365.25
+    day_weights = 1 + 0.25 * np.cos(2 * np.pi * (doy - 15) / 365.25)
+    day_weights /= day_weights.sum()
+    age_weights = _death_age_weights()
+    template = np.full(RECORD_LEN + 1, ord(" "), dtype=np.uint8)
+    template[0:15] = np.frombuffer(b"SYNTH*PERSONNE/", dtype=np.uint8)
+    template[94:101] = np.frombuffer(b"COMMUNE", dtype=np.uint8)
+    template[RECORD_LEN] = ord("\n")
+    with open(path, "wb") as file:
+        for start in range(0, nb_rows, DECES_BLOCK_ROWS):
+            n = min(DECES_BLOCK_ROWS, nb_rows - start)
+            arr = np.tile(template, (n, 1))
+            death_days = first_day + rng.choice(nb_days, n, p=day_weights)
+            ages = rng.choice(NB_AGES, n, p=age_weights)
+            birth_days = death_days - np.floor(ages * 365.25).astype(np.int64) - rng.integers(1, 365, n)
+            arr[:, 80] = ord("1") + rng.integers(0, 2, n)
+            _put_date(arr, 81, birth_days)
+            arr[:, 89:94] = communes[rng.choice(len(communes), n, p=commune_weights)]
+            _put_date(arr, 154, death_days)
+            arr[:, 162:167] = communes[rng.choice(len(communes), n, p=commune_weights)]
+            _put_digits(arr, 167, start + np.arange(n), 9)
+            # unknown birth month and day (defaulted by the parser), and invalid death dates (rejected)
+            unknown = rng.random(n) < 0.01
+            arr[unknown, 85:89] = ord("0")
+            invalid = rng.random(n) < 0.001
+            arr[invalid, 158:160] = ord("0")
+            file.write(arr.tobytes())
+    return nb_rows
+
+
+# INSEE age pyramids: excel sheets, written as minimal xlsx files (read by xlrd whatever their extension)
+
+def write_xlsx(path, sheet_name, cells):
+    # cells: {(row, col): value}, 0-based
+    rows = {}
+    for (row, col), val in sorted(cells.items()):
+        ref = f"{_col_name(col)}{row + 1}"
+        if isinstance(val, str):
+            cell = f'<c r="{ref}" t="inlineStr"><is><t>{escape(val)}</t></is></c>'
+        else:
+            cell = f'<c r="{ref}"><v>{val}</v></c>'
+        rows.setdefault(row, []).append(cell)
+    sheet = "".join(f'<row r="{row + 1}">{"".join(cells)}</row>' for row, cells in rows.items())
+    ns = 'xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"'
+    rel_ns = 'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships"'
+    rels_ns = 'xmlns="http://schemas.openxmlformats.org/package/2006/relationships"'
+    doc_rel = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr("[Content_Types].xml", (
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+            '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+            '<Default Extension="xml" ContentType="application/xml"/>'
+            '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+            '<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+            '</Types>'))
+        zf.writestr("_rels/.rels", (
+            f'<?xml version="1.0" encoding="UTF-8"?><Relationships {rels_ns}>'
+            f'<Relationship Id="rId1" Type="{doc_rel}/officeDocument" Target="xl/workbook.xml"/></Relationships>'))
+        zf.writestr("xl/workbook.xml", (
+            f'<?xml version="1.0" encoding="UTF-8"?><workbook {ns} {rel_ns}>'
+            f'<sheets><sheet name="{escape(sheet_name)}" sheetId="1" r:id="rId1"/></sheets></workbook>'))
+        zf.writestr("xl/_rels/workbook.xml.rels", (
+            f'<?xml version="1.0" encoding="UTF-8"?><Relationships {rels_ns}>'
+            f'<Relationship Id="rId1" Type="{doc_rel}/worksheet" Target="worksheets/sheet1.xml"/></Relationships>'))
+        zf.writestr("xl/worksheets/sheet1.xml", (
+            f'<?xml version="1.0" encoding="UTF-8"?><worksheet {ns}><sheetData>{sheet}</sheetData></worksheet>'))
+
+def _col_name(col):
+    name = ""
+    col += 1
+    while col:
+        col, rem = divmod(col - 1, 26)
+        name = chr(ord("A") + rem) + name
+    return name
+
+def _age_label(age, last):
+    return f"{age} et +" if age == last else age
+
+def write_pda_file(path, conf, seed):
+    # layouts of the "pyramide-des-ages" (years in columns) and "pyramide-des-ages-2" (one year) confs
+    rng = rng_for(seed, 2)
+    cells = {}
+    col_age = conf["cols"]["age"] - 1
+    if conf["type"] == "pyramide-des-ages":
+        rows = conf["rows"]
+        nb_ages = rows["hommes_fin"] - rows["hommes_debut"] + 1
+        for i, year in enumerate(range(2000, 2020+1)):
+            col = col_age + 2 + i
+            cells[(rows["annee"] - 1, col)] = year
+            pop = _pyramid(32e6, nb_ages) * (1 + 0.004 * i) * rng.normal(1, 0.01, nb_ages)
+            for first_row in (rows["hommes_debut"], rows["femmes_debut"]):
+                for age in range(nb_ages):
+                    cells[(first_row - 1 + age, col_age)] = _age_label(age, nb_ages - 1)
+                    cells[(first_row - 1 + age, col)] = int(pop[age])
+    else:
+        rows, col_nb = conf["rows"], conf["cols"]["nb"] - 1
+        nb_ages = rows["fin"] - rows["debut"]
+        pop = _pyramid(65e6, nb_ages) * rng.normal(1, 0.01, nb_ages)
+        for age in range(nb_ages):
+            cells[(rows["debut"] + age, col_age)] = _age_label(age, nb_ages - 1)
+            cells[(rows["debut"] + age, col_nb)] = int(pop[age])
+    write_xlsx(path, conf["sheet"], cells)
+
+
+# eurostat: gzipped tsvs, "dim1,dim2,...,geo\time" then one column by year ("2020 ")
+
+EUROSTAT_AGES = ["Y_LT1"] + [f"Y{age}" for age in range(1, 100)] + ["Y_OPEN", "TOTAL", "UNK"]
+
+def eurostat_geos(geos, scale):
+    # the given ones, then synthetic ones up to the scaled volume
+    nb = max(len(geos), int(round(REAL_VOLUMES["eurostat_geos"] * scale)))
+    return list(geos) + [f"X{i:04d}" for i in range(nb - len(geos))]
+
+def _eurostat_val(val, missing):
+    # (missing values are written as 0, the importers not handling ": " in the age/sex files)
+    return "0 " if missing else f"{int(val)} "
+
+def write_eurostat_by_age_sex(path, header, years, geos, seed, key, rates=False):
+    # demo_pjan (population, "unit,age,sex,geo\time") or demo_magec (deaths, "unit,sex,age,geo\time")
+    rng = rng_for(seed, 3, key)
+    years = sorted(years, reverse=True)
+    mortality = np.append(_mortality_rates(101), 0)
+    with gzip.open(path, "wt", newline="") as file:
+        file.write(header + "\t" + "\t".join(f"{year} " for year in years) + "\n")
+        for geo_idx, geo in enumerate(geos):
+            size = 1e6 * (1 + geo_idx % 17) ** 1.5
+            first_year = years[-1] + int(rng.integers(0, 20))
+            pyramid = np.append(_pyramid(size, 101), 0)
+            for sex in ("F", "M", "T"):
+                factor = 2 if sex == "T" else 1
+                by_age = pyramid * factor * (mortality if rates else 1)
+                for age_idx, age in enumerate(EUROSTAT_AGES):
+                    val = by_age.sum() if age == "TOTAL" else by_age[min(age_idx, len(by_age) - 1)]
+                    dims = ("NR", age, sex) if "age,sex" in header else ("NR", sex, age)
+                    vals = val * rng.normal(1, 0.02, len(years))
+                    file.write(",".join((*dims, geo)) + "\t" + "\t".join(
+                        _eurostat_val(v, year < first_year) for v, year in zip(vals, years)) + "\n")
+
+def write_eurostat_deaths(path, geos, seed):
+    # tps00029: total deaths ("indic_de,geo\time")
+    rng = rng_for(seed, 4)
+    years = list(range(2021, 2010-1, -1))
+    with gzip.open(path, "wt", newline="") as file:
+        file.write("indic_de,geo\\time\t" + "\t".join(f"{year} " for year in years) + "\n")
+        for geo_idx, geo in enumerate(geos):
+            deaths = 1e6 * (1 + geo_idx % 17) ** 1.5 * 0.01
+            for indic, val in (("DEATH_NR", deaths), ("GDEATHRT", 10)):
+                file.write(f"{indic},{geo}\t" + "\t".join(
+                    f"{v:.1f} " if indic == "GDEATHRT" else f"{int(v)} "
+                    for v in val * rng.normal(1, 0.03, len(years))) + "\n")
+
+
+# SYNOP meteo: csv (";" separated), 8 observations a day by station
+
+METEO_HEADER = [
+    "ID OMM station", "Date", "Pression au niveau mer", "Variation de pression en 3 heures",
+    "Direction du vent moyen 10 mn", "Vitesse du vent moyen 10 mn", "Température", "Point de rosée",
+    "Humidité", "Visibilité horizontale", "Température (°C)", "Nom", "department (code)",
+    "region (code)", "communes (code)",
+]
+
+def meteo_stations(scale):
+    nb = max(1, int(round(REAL_VOLUMES["meteo_stations"] * scale)))
+    deps = [f"{d:02d}" for d in range(1, 96) if d != 20] + ["2A", "2B", "971", "972", "973", "974"]
+    return [(7000 + i, deps[i * 7 % len(deps)]) for i in range(nb)]
+
+def write_meteo_file(path, first_date, last_date, scale, seed):
+    rng = rng_for(seed, 5)
+    stations = meteo_stations(scale)
+    days = np.arange(np.datetime64(first_date), np.datetime64(last_date) + 1)
+    hours = np.arange(0, 24, 3)
+    nb_rows = 0
+    with open(path, "w", newline="") as file:
+        file.write(";".join(METEO_HEADER) + "\n")
+        for station_id, dep in stations:
+            offset = rng.normal(0, 3)
+            doy = days.astype(np.int64) % 365.25
+            daily = 12.5 + offset - 8 * np.cos(2 * np.pi * (doy - 15) / 365.25) + rng.normal(0, 3, len(days))
+            temps = daily[:, None] + 4 * np.sin(2 * np.pi * (hours - 9) / 24) + rng.normal(0, 1, (len(days), len(hours)))
+            missing = rng.random(temps.shape) < 0.01
+            lines = []
+            for day, day_temps, day_missing in zip(days.astype(str), temps.round(1).tolist(), missing.tolist()):
+                for hour, temp, miss in zip(hours.tolist(), day_temps, day_missing):
+                    temp_c = "" if miss else str(temp)
+                    temp_k = "" if miss else f"{temp + 273.15:.2f}"
+                    lines.append(
+                        f"{station_id:05d};{day}T{hour:02d}:00:00+01:00;101320;-40;250;3.1;{temp_k};278.15;"
+                        f"80;20000;{temp_c};STATION {station_id};{dep};{dep[:2]};{dep}001\n")
+            file.writelines(lines)
+            nb_rows += len(lines)
+    return nb_rows
+
+
+# swedish data: deaths by age and year (SCB), and population by age class for each year (populationpyramid.net)
+
+def write_se_deaths_file(path, years, seed):
+    rng = rng_for(seed, 6)
+    deaths = _pyramid(5e6, 101) * _mortality_rates(101)
+    with open(path, "w", newline="") as file:
+        file.write(",".join(["age", "sex"] + [str(year) for year in years]) + "\n")
+        for sex in ("men", "women"):
+            for age in range(101):
+                label = "100+ years" if age == 100 else f"{age} years"
+                file.write(",".join([label, sex] + [str(int(v)) for v in deaths[age] * rng.normal(1, 0.05, len(years))]) + "\n")
+
+def write_se_age_pyramid_file(path, year, seed):
+    rng = rng_for(seed, 7, year)
+    pop = _pyramid(5e6, 101)
+    with open(path, "w", newline="") as file:
+        file.write("Age,M,F\n")
+        for start in range(0, 100, 5):
+            nb = pop[start:start+5].sum() * rng.normal(1, 0.02)
+            file.write(f"{start}-{start+4},{int(nb)},{int(nb * 1.03)}\n")
+        file.write(f"100+,{int(pop[100])},{int(pop[100] * 2)}\n")
+
+
+def makedirs(path):
+    os.makedirs(path, exist_ok=True)
+    return path
@@ -0,0 +1,49 @@
+# dates are handled as integer day numbers (days since 1970-01-01, as numpy datetime64[D]),
+# in the db and in memory: ISO strings are only used at the edges (CLI arguments, source files, plot labels)
+import numpy as np
+
+
+def to_day(iso):
+    # "YYYY-MM-DD", or "YYYY-MM" / "YYYY" for their first day
+    return int(np.datetime64(iso, "D").astype(np.int64))
+
+
+def to_iso(day):
+    return str(np.datetime64(int(day), "D"))
+
+
+def to_days(isos):
+    return np.array(isos, dtype="datetime64[D]").astype(np.int64)
+
+
+def to_isos(days):
+    return np.asarray(days).astype("datetime64[D]").astype(str)
+
+
+def to_datetimes(days):
+    # for matplotlib, which handles datetime64 axes
+    return np.asarray(days).astype("datetime64[D]")
+
+
+def day_range(first_day, last_day):
+    return np.arange(first_day, last_day + 1)
+
+
+def range_to_days(date_range):
+    # (first day, last day) of an ISO range, with the semantic of "date BETWEEN ? AND ?" on ISO strings:
+    # an upper bound "2011" or "2011-01" excludes the dates it prefixes (("2010", "2011") is year 2010)
+    first, last = date_range
+    return to_day(first), to_day(last) - (1 if len(last) < 10 else 0)
+
+
+def year_range(year):
+    return to_day(str(year)), to_day(str(year + 1)) - 1
+
+
+def years(days):
+    return np.asarray(days).astype("datetime64[D]").astype("datetime64[Y]").astype(np.int64) + 1970
+
+
+def months(days):
+    # as "YYYY-MM" labels
+    return np.asarray(days).astype("datetime64[D]").astype("datetime64[M]").astype(str)
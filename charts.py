@@ -0,0 +1,42 @@
+# charts are computed as dicts holding their data, then rendered separately
+# on Agg Figures (no global pyplot state), possibly in a pool of processes
+from concurrent.futures import ProcessPoolExecutor
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+import profiling
+
+
+def new_chart(fpath=None, suptitle=None, figsize=None):
+    return {"fpath": fpath, "suptitle": suptitle, "figsize": figsize, "calls": []}
+
+
+def add(chart, method, *args, **kwargs):
+    # a call of a matplotlib Axes method (plot, bar, set_title, legend...), replayed when rendering
+    chart["calls"].append((method, args, kwargs))
+
+
+@profiling.profiled("render")
+def render_chart(chart):
+    return _render_chart(chart)
+
+
+def _render_chart(chart):
+    fig = Figure(figsize=chart["figsize"])
+    FigureCanvasAgg(fig)
+    ax = fig.subplots()
+    if chart["suptitle"]:
+        fig.suptitle(chart["suptitle"])
+    for method, args, kwargs in chart["calls"]:
+        getattr(ax, method)(*args, **kwargs)
+    fig.savefig(chart["fpath"])
+    return chart["fpath"]
+
+
+@profiling.profiled("render")
+def render_charts(charts, workers=1):
+    profiling.add_rows(len(charts))
+    if workers <= 1:
+        return [_render_chart(chart) for chart in charts]
+    with ProcessPoolExecutor(workers) as executor:
+        return list(executor.map(_render_chart, charts))
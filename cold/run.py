@@ -4,8 +4,6 @@ import sys
 import re
 import click
 import sqlite3
-import urllib.request
-from datetime import datetime, timedelta
 from collections import defaultdict
 from glob import glob
 import xlrd
@@ -17,21 +15,19 @@ import numpy as np
 from scipy import optimize
 
 HERE = os.path.dirname(__file__)
+sys.path.insert(0, os.path.join(os.path.abspath(HERE), ".."))
+import deces
+import manifest
+import download
+import tensor
+import utils
+import calendar_index
+import profiling
+import windows
+
 DATA_PATH = os.path.join(HERE, "../data")
 DB_PATH = os.path.join(HERE, "data.sqlite")
 
-def _to_dt(date):
-    return datetime.strptime(date, '%Y-%m-%d')
-
-def _add_days(date, days):
-    dt = _to_dt(date)
-    dt += timedelta(days=days)
-    return dt.strftime('%Y-%m-%d')
-
-def _date_range(date, days):
-    return (date, _add_days(date, days))
-
-
 DECES_FILES_SRC = [
     "https://static.data.gouv.fr/resources/fichier-des-personnes-decedees/20191209-190504/deces-2000.txt",
     "https://static.data.gouv.fr/resources/fichier-des-personnes-decedees/20191209-190558/deces-2001.txt",
@@ -94,18 +90,32 @@ PDA_CONFS = [
 ]
 
 METEO_SRC_FILE = "https://public.opendatasoft.com/explore/dataset/donnees-synop-essentielles-omm/download/?format=csv&timezone=Europe/Berlin&lang=en&use_labels_for_header=true&csv_separator=%3B"
+METEO_FNAME = "meteo.csv"
 
 START_DATE = FIRST_DATE = "2010-01-01"
 END_DATE = LAST_DATE = "2021-12-31"
+# as day numbers, used in the db and in memory (see calendar_index)
+FIRST_DAY, LAST_DAY = calendar_index.to_day(FIRST_DATE), calendar_index.to_day(LAST_DATE)
 
 
 def _get_conf_fname(conf):
     return conf.get("name") or os.path.basename(conf["src"])
 
 
+TENSOR = None
+
 @click.group()
-def main():
-    pass
+@profiling.cli_options
+@click.option("--tensor", "tensor_path", help="Read deaths and population from a tensor saved by export_tensor, instead of the db")
+def main(tensor_path):
+    global TENSOR
+    if tensor_path:
+        TENSOR = tensor.load_tensor(tensor_path)
+
+
+def _deaths_source(conn):
+    # deaths and population are read from the --tensor one if any (meteo is always read from the db)
+    return TENSOR if TENSOR is not None else conn
 
 
 @main.command("all")
@@ -113,6 +123,7 @@ def main():
 def cmd_all(do_import):
     if do_import:
         download_data()
+        init_db()
         import_data()
 
 
@@ -120,105 +131,91 @@ def db_connect():
     return sqlite3.connect(DB_PATH)
 
 
-def init_db(name=None):
+# matching the access paths of the compute commands (see explain_queries)
+# (deaths are counted from deces_agg, whose primary key starts with the date)
+DB_INDEXES = {
+    "pda": {"ages_annee_age": "ages(annee, age, nb)"},
+    "meteo": {"meteo_date_dep": "meteo(date, dep, temperature)"},
+}
+
+def init_db(name=None, full=False, compact=None):
+    # compact: deces table in its compact layout (see deces.create_table), None to keep the existing one
     with db_connect() as conn:
-        cur = conn.cursor()
+        manifest.init_manifest(conn)
+        if full:
+            # indexes are faster to build once the tables are filled
+            for key, indexes in DB_INDEXES.items():
+                if name in (None, key): utils.drop_indexes(conn, indexes)
         if name in (None, "deces"):
-            cur.execute('''CREATE TABLE IF NOT EXISTS deces(sex text, date_naissance text, date_deces text, lieu_deces text, dep text, age integer, is_metro bool)''')
-            cur.execute('''DELETE FROM deces''')
+            rebuild_agg = deces.create_table(conn, '''CREATE TABLE IF NOT EXISTS deces(sex text, date_naissance integer, date_deces integer, lieu_deces text, dep text, age integer, is_metro bool, file_id integer)''', compact=compact)
+            deces.init_agg(conn, rebuild=rebuild_agg)
+            utils.drop_indexes(conn, ["deces_metro_date_age"])
+            if full: manifest.reset(conn, ["deces", "deces_agg"], [os.path.basename(src) for src in DECES_FILES_SRC])
         if name in (None, "pda"):
-            cur.execute('''CREATE TABLE IF NOT EXISTS ages(annee integer, age integer, nb integer)''')
-            cur.execute('''DELETE FROM ages''')
+            manifest.create_table(conn, "ages", '''CREATE TABLE IF NOT EXISTS ages(annee integer, age integer, nb integer, file_id integer)''')
+            if full: manifest.reset(conn, ["ages"], [_get_conf_fname(conf) for conf in PDA_CONFS])
         if name in (None, "meteo"):
-            cur.execute('''CREATE TABLE IF NOT EXISTS meteo(date text, dep text, temperature float)''')
-            cur.execute('''DELETE FROM meteo''')
+            # (daily mean, min and max temperatures)
+            manifest.create_table(conn, "meteo", '''CREATE TABLE IF NOT EXISTS meteo(date integer, dep text, temperature float, temperature_min float, temperature_max float, file_id integer)''')
+            if full: manifest.reset(conn, ["meteo"], [METEO_FNAME])
 
 
 @main.command("download_data")
-def cmd_download_data_cmd():
-    download_data()
+@click.option("--workers", default=download.WORKERS, help="Nb of concurrent downloads")
+def cmd_download_data_cmd(workers):
+    download_data(workers=workers)
 
 
-def download_data():
+def download_data(workers=download.WORKERS):
     if not os.path.exists(DATA_PATH):
         os.makedirs(DATA_PATH)
-    for url in DECES_FILES_SRC:
-        _download_data_file(url, os.path.join(DATA_PATH, url.split('/')[-1]))
-    for conf in PDA_CONFS:
-        _download_data_file(conf["src"], os.path.join(DATA_PATH, _get_conf_fname(conf)))
-    _download_data_file(METEO_SRC_FILE, os.path.join(DATA_PATH, "meteo.csv"))
-
-
-def _download_data_file(url, ofpath):
-    if not os.path.exists(ofpath):
-        print(f'Download {os.path.basename(ofpath)}... ', end='')
-        sys.stdout.flush()
-        urllib.request.urlretrieve(url, ofpath)
-        print(f'DONE')
+    # (death files kept compressed by run.py compress_data are not downloaded again)
+    jobs = [
+        {"url": url, "path": os.path.join(DATA_PATH, url.split('/')[-1])}
+        for url in DECES_FILES_SRC
+        if not utils.is_compressed(utils.find_source(os.path.join(DATA_PATH, url.split('/')[-1])))
+    ]
+    jobs += [{"url": conf["src"], "path": os.path.join(DATA_PATH, _get_conf_fname(conf))} for conf in PDA_CONFS]
+    jobs.append({"url": METEO_SRC_FILE, "path": os.path.join(DATA_PATH, METEO_FNAME)})
+    download.download_files(jobs, workers=workers)
 
 
 @main.command("import_data")
 @click.option("--name")
-def cmd_import_data(name):
-    init_db(name=name)
-    import_data(name=name)
+@click.option("--batch-size", default=deces.BATCH_SIZE)
+@click.option("--workers", default=1, help="Nb of processes parsing death files")
+@click.option("--full", is_flag=True, help="Reimport all files, even the already imported ones")
+@click.option("--compact/--no-compact", default=None, help="Layout of the deces table (a change of layout reimports the deaths), default: keep the existing one")
+def cmd_import_data(name, batch_size, workers, full, compact):
+    init_db(name=name, full=full, compact=compact)
+    import_data(name=name, batch_size=batch_size, workers=workers)
 
 
-def import_data(name=None):
+def import_data(name=None, batch_size=deces.BATCH_SIZE, workers=1):
     with db_connect() as conn:
         if name in (None, "deces"):
-            for src in DECES_FILES_SRC:
-                fname = os.path.basename(src)
-                print(f"import {fname}")
-                _import_deces_file(conn, fname)
+            paths = [utils.find_source(os.path.join(DATA_PATH, os.path.basename(src))) for src in DECES_FILES_SRC]
+            deces.import_deces_files(conn, paths, batch_size=batch_size, workers=workers)
         if name in (None, "pda"):
             for conf in PDA_CONFS:
-                if conf["type"] == "pyramide-des-ages":
-                    _import_pda_file(conn, conf)
-                if conf["type"] == "pyramide-des-ages-2":
-                    _import_pda2_file(conn, conf)
+                path = os.path.join(DATA_PATH, _get_conf_fname(conf))
+                manifest.import_file(conn, path, ["ages"], lambda file_id: _import_pda(conn, conf, file_id))
         if name in (None, "meteo"):
-            print(f"import meteo")
-            _import_meteo_file(conn)
+            manifest.import_file(conn, os.path.join(DATA_PATH, METEO_FNAME), ["meteo"], lambda file_id: _import_meteo_file(conn, file_id))
+        print("index db")
+        for key, indexes in DB_INDEXES.items():
+            if name in (None, key): utils.create_indexes(conn, indexes)
 
 
-def _import_deces_file(conn, fname):
-    fpath = os.path.join(DATA_PATH, fname)
-    with open(fpath, 'rb') as file:
-        rows, errors = [], []
-        num_line = 1
-        nb_inserted = 0
-        for line in file.readlines():
-            try:
-                date_naissance = _parse_date(line[81:89].decode("utf-8"), def_month="06", def_day="15")
-                date_deces = _parse_date(line[154:162].decode("utf-8"))
-                lieu_deces = line[162:167].decode("utf-8")
-                naissance_dt = _to_dt(date_naissance)
-                deces_dt = _to_dt(date_deces)
-                age = max(0, min(100, _dt_to_annees(deces_dt - naissance_dt)))
-                parsed = {
-                    "sex": _parse_sex(line[80:81].decode("utf-8")),
-                    "date_naissance": date_naissance,
-                    "date_deces": date_deces,
-                    "lieu_deces": lieu_deces,
-                    "dep": lieu_deces[:2],
-                    "age": age,
-                    "is_metro": _parse_int(lieu_deces, 99999) < 96000
-                }
-                rows.append(parsed)
-                nb_inserted += 1
-            except Exception as exc:
-                if isinstance(exc, ParseError) or isinstance(exc, ValueError):
-                    errors.append(exc)
-                else:
-                    raise()
-            num_line += 1
-        print(f"Nb errors for {fname}: {len(errors)} / {num_line-1} ({'{:.5f}'.format(100*len(errors)/(num_line-1))}%)")
-        for e in errors[:10]: print(e)
-    _db_bulk_insert(conn, "deces", rows)
-
-
-def _import_pda_file(conn, conf):
+def _import_pda(conn, conf, file_id):
+    print(f"import {_get_conf_fname(conf)}")
+    if conf["type"] == "pyramide-des-ages":
+        return _import_pda_file(conn, conf, file_id)
+    if conf["type"] == "pyramide-des-ages-2":
+        return _import_pda2_file(conn, conf, file_id)
+
+
+def _import_pda_file(conn, conf, file_id):
     fname = _get_conf_fname(conf)
     path = os.path.join(DATA_PATH, fname)
     book = xlrd.open_workbook(path)
@@ -263,12 +260,14 @@ def _import_pda_file(conn, conf):
     rows = [{
         "annee": annee,
         "age": age,
-        "nb": nb
+        "nb": nb,
+        "file_id": file_id
     } for (annee, age), nb in pop_by_annee_age.items()]
     _db_bulk_insert(conn, "ages", rows)
+    return len(rows)
 
 
-def _import_pda2_file(conn, conf):
+def _import_pda2_file(conn, conf, file_id):
     fname = _get_conf_fname(conf)
     path = os.path.join(DATA_PATH, fname)
     book = xlrd.open_workbook(path)
@@ -300,45 +299,54 @@ def _import_pda2_file(conn, conf):
     rows = [{
         "annee": conf["annee"],
         "age": age,
-        "nb": nb
+        "nb": nb,
+        "file_id": file_id
     } for age, nb in res.items()]
     _db_bulk_insert(conn, "ages", rows)
+    return len(rows)
 
 
-def _import_meteo_file(conn):
-    fpath = os.path.join(DATA_PATH, "meteo.csv")
+METEO_BATCH_SIZE = 10000
+SQL_INSERT_METEO = "INSERT INTO meteo (date, dep, temperature, temperature_min, temperature_max, file_id) VALUES (?, ?, ?, ?, ?, ?)"
 
-    def parse_float(val):
-        try:
-            return float(val)
-        except ValueError:
-            return None
-
-    values = []
+def _import_meteo_file(conn, file_id):
+    # streamed: running sum, count, min and max of the 3-hourly temperatures by (date, department),
+    # so that memory depends on the nb of days and departments, not on the nb of stations and readings
+    print(f"import meteo")
+    fpath = os.path.join(DATA_PATH, METEO_FNAME)
+    stats = {}
     with open(fpath, newline='') as csvf:
-        for row in csv.DictReader(csvf, delimiter=';'):
-            date = row["Date"][:10]
+        reader = csv.reader(csvf, delimiter=';')
+        header = next(reader)
+        col_date, col_temp, col_dep = (header.index(col) for col in ("Date", "Température (°C)", "department (code)"))
+        for row in reader:
+            # (ISO dates are compared as strings, before parsing anything else)
+            date = row[col_date][:10]
             if date < FIRST_DATE or date > LAST_DATE: continue
-            temp = parse_float(row["Température (°C)"])
-            if temp is None: continue
-            # values.append({
-            #     "date": date,
-            #     "dep": row["department (code)"][:2],
-            #     "temperature": temp,
-            # })
-            key = (date, row["department (code)"])
-            if key not in values: values[key] = []
-            values[key].append(temp)
-    values_meaned = (
-        {
-            "date": date,
-            "dep": dep,
-            "temperature": mean(vals),
-        }
-        for (date, dep), vals in values.items()
+            dep = row[col_dep]
+            if not dep: continue
+            try:
+                temp = float(row[col_temp])
+            except ValueError:
+                continue
+            key = (date, dep)
+            stat = stats.get(key)
+            if stat is None:
+                stats[key] = [temp, 1, temp, temp]
+                continue
+            stat[0] += temp
+            stat[1] += 1
+            if temp < stat[2]: stat[2] = temp
+            elif temp > stat[3]: stat[3] = temp
+    dates = sorted(set(date for date, _ in stats))
+    days = dict(zip(dates, calendar_index.to_days(dates).tolist()))
+    rows = (
+        (days[date], dep, total / nb, temp_min, temp_max, file_id)
+        for (date, dep), (total, nb, temp_min, temp_max) in sorted(stats.items())
     )
-    for vals in _get_by_paquet(values, 1000):
-        _db_bulk_insert(conn, "meteo", values_meaned)
+    for paquet in utils.get_by_paquet(rows, METEO_BATCH_SIZE):
+        conn.executemany(SQL_INSERT_METEO, paquet)
+    return len(stats)
 
 
 @main.command("plot_mortalite_par_temperature")
@@ -348,67 +356,64 @@ def cmd_plot_mortalite_par_temperature(ages):
         plot_mortalite_par_temperature(conn, ages=ages.split('-') if ages else None)
 
 
+SQL_DEATHS_BY_DATE_DEP_AGE = "SELECT date, dep, age, SUM(n) FROM deces_agg WHERE is_metro=true AND date between ? and ? GROUP BY date, dep, age"
+DEATHS_FETCH_SIZE = 100000
+
+@profiling.profiled("compute")
 def plot_mortalite_par_temperature(conn, ages=None):
-    dates = _get_all_dates(START_DATE, END_DATE)
-    years = sorted(set(d[:4] for d in dates))
-    ages = range(0, 100+1)
-    deaths_by_date_dep_age = {
-        (date, dep, age): deaths
-        for date, dep, age, deaths in conn.execute(
-            "SELECT date_deces, dep, age, count(*) FROM deces WHERE is_metro=true AND date_deces between ? and ? GROUP BY date_deces, dep, age",
-            [START_DATE, END_DATE]
-        )
-    }
-    deps = sorted(set(dep for _, dep, _ in deaths_by_date_dep_age.keys()))
-    summer_dates_by_year = {
-        year: [
-            date
-            for date in dates
-            if date > f"{year}-06" and date < f"{year}-08"
-        ]
-        for year in years
-    }
-    summer_deaths_by_year_age_dep_age = {
-        (year, dep, age): mean(
-            deaths_by_date_dep_age.get((date, dep, age),0)
-            for date in summer_dates_by_year[year]
-        )
-        for dep in deps
-        for year in years
-        for age in ages
-    }
-    print("TMP summer_deaths_by_year_age_dep_age", list(summer_deaths_by_year_age_dep_age.values())[:0])
-    temps_by_date_dep = {
-        (date, dep): temp
-        for date, dep, temp in conn.execute(
-            f"select date, dep, AVG(temperature) from meteo group by date, dep"
-        )
-    }
-    death_refpairs_by_age_temp = {}
-    for date in dates:
-        for dep in deps:
-            if (date, dep) in temps_by_date_dep:
-                temp = int(temps_by_date_dep[(date, dep)])
-                for age in ages:
-                    deaths = deaths_by_date_dep_age.get((date, dep, age), 0)
-                    summer_deaths = summer_deaths_by_year_age_dep_age.get((date, dep, age), 0)
-                    death_refpairs_by_age_temp.setdefault((age, temp), []).append((deaths, summer_deaths))
-    death_factors_by_age_temp = {
-        (age, temp): float(sum(v for v, _ in refpairs)) / max(sum(v for _, v in refpairs), 1)
-        for (age, temp), refpairs in death_refpairs_by_age_temp.items()
-    }
-    temps = sorted(set(t for _, t in death_factors_by_age_temp.keys()))
+    # deaths by (age, daily temperature of their department), relatively to the summer (june and july)
+    # mean of their year, department and age: deaths are streamed and accumulated in dense arrays
+    # indexed by integer codes (day, department, age, temperature bin)
+    days = calendar_index.day_range(FIRST_DAY, LAST_DAY)
+    year_idx = calendar_index.years(days) - calendar_index.years(FIRST_DAY)
+    nb_years, nb_ages = year_idx[-1] + 1, 100 + 1
+    deps, temps = comp_temps_matrix(conn, FIRST_DAY, LAST_DAY)
+    nb_deps = len(deps)
+    has_temp = ~np.isnan(temps)
+    # temperature bins: int() of the daily means, from the coldest one
+    temp_bins = np.trunc(np.where(has_temp, temps, 0)).astype(np.int64)
+    min_bin = temp_bins[has_temp].min()
+    nb_bins = temp_bins[has_temp].max() - min_bin + 1
+    bin_idx = temp_bins - min_bin
+    is_summer = np.isin(calendar_index.to_datetimes(days).astype("datetime64[M]").astype(np.int64) % 12, (5, 6))
+    nb_summer_days = np.bincount(year_idx, weights=is_summer, minlength=nb_years)
+    summer_deaths = np.zeros(nb_years * nb_deps * nb_ages)
+    deaths_by_age_bin = np.zeros(nb_ages * nb_bins)
+    has_deaths = np.zeros(nb_deps, dtype=bool)
+    for day, dep, age, nb in _iter_deaths_by_date_dep_age(conn, deps, nb_ages):
+        has_deaths[dep] = True
+        summer = is_summer[day]
+        summer_deaths += np.bincount(
+            (year_idx[day[summer]] * nb_deps + dep[summer]) * nb_ages + age[summer],
+            weights=nb[summer], minlength=summer_deaths.size)
+        with_temp = has_temp[day, dep]
+        deaths_by_age_bin += np.bincount(
+            age[with_temp] * nb_bins + bin_idx[day[with_temp], dep[with_temp]],
+            weights=nb[with_temp], minlength=deaths_by_age_bin.size)
+    summer_means = summer_deaths.reshape(nb_years, nb_deps, nb_ages) / np.maximum(nb_summer_days, 1)[:, None, None]
+    # reference deaths: summer means summed over the (date, department) of each temperature bin
+    pair_days, pair_deps = (has_temp & has_deaths).nonzero()
+    pairs_by_year_dep_bin = np.bincount(
+        (year_idx[pair_days] * nb_deps + pair_deps) * nb_bins + bin_idx[pair_days, pair_deps],
+        minlength=nb_years * nb_deps * nb_bins).reshape(nb_years, nb_deps, nb_bins)
+    ref_deaths_by_age_bin = np.einsum("yda,ydb->ab", summer_means, pairs_by_year_dep_bin)
+    deaths_by_age_bin = deaths_by_age_bin.reshape(nb_ages, nb_bins)
+    death_factors = np.divide(deaths_by_age_bin, ref_deaths_by_age_bin,
+        out=np.full(deaths_by_age_bin.shape, np.nan), where=ref_deaths_by_age_bin > 0)
+    used_bins = pairs_by_year_dep_bin.sum(axis=(0, 1)) > 0
+    temps = (np.arange(nb_bins) + min_bin)[used_bins]
 
     plt.clf()
     title = ["[France] Facteur de mortalité par age et température"]
     #if ages: title.append(f"(Ages: {'-'.join(ages)})")
     plt.title(" ".join(title))
     for age in range(40, 90+1, 10):
-        plt.plot(temps, [death_factors_by_age_temp.get((age, t)) for t in temps], label=age)
+        plt.plot(temps, death_factors[age, used_bins], label=age)
     plt.legend()
     figname = ["facteur_mortalite_par_age_temperature"]
     #if ages: figname.append(f"ages_{'_'.join(ages)}")
-    plt.savefig(os.path.join(HERE, f'results/{"_".join(figname)}.png'))
+    with profiling.stage("render", "savefig"):
+        plt.savefig(os.path.join(HERE, f'results/{"_".join(figname)}.png'))
 
 
 
@@ -474,20 +479,18 @@ def plot_mortalite_par_temperature(conn, ages=None):
 
 
 def plot_mortalite_par_temperature_old(ages=None):
-    first_date = FIRST_DATE
-    last_date = LAST_DATE
     with db_connect() as conn:
-        standard2_mortality_by_date = comp_standard2_mortality_by_date(conn, first_date, last_date, ages=ages)
+        standard2_mortality_by_date = comp_standard2_mortality_by_date(conn, FIRST_DAY, LAST_DAY, ages=ages)
         temps_by_date = comp_temps_by_date(conn)
-        mortality_by_temp = comp_mortalite_par_temperature(conn, first_date, last_date, temps_by_date, standard2_mortality_by_date)
+        mortality_by_temp = comp_mortalite_par_temperature(conn, FIRST_DAY, LAST_DAY, temps_by_date, standard2_mortality_by_date)
 
     plt.clf()
     fig, axs = plt.subplots(2)
     title = ["[France] Mortalité et température"]
     if ages: title.append(f"(Ages: {'-'.join(ages)})")
     fig.suptitle(" ".join(title))
-    axs[0].plot(temps_by_date.keys(), temps_by_date.values(), label="Temperature")
-    axs[1].plot(standard2_mortality_by_date.keys(), standard2_mortality_by_date.values(), label="Mortalite")
+    axs[0].plot(calendar_index.to_datetimes(list(temps_by_date.keys())), list(temps_by_date.values()), label="Temperature")
+    axs[1].plot(calendar_index.to_datetimes(list(standard2_mortality_by_date.keys())), list(standard2_mortality_by_date.values()), label="Mortalite")
     plt.legend()
     figname = ["mortalite_et_temperature"]
     if ages: figname.append(f"ages_{'_'.join(ages)}")
@@ -504,70 +507,178 @@ def plot_mortalite_par_temperature_old(ages=None):
     plt.savefig(os.path.join(HERE, f'results/{"_".join(figname)}.png'))
 
 
-def comp_standard2_mortality_by_date(conn, first_date, last_date, ages=None):
-    first_year = int(first_date[:4])
-    last_year = int(last_date[:4])
+def comp_standard2_mortality_by_date(conn, first_day, last_day, ages=None, window=None, center=True):
+    # standard mortality by date, relatively to the mean of the summer (june and july) of its year,
+    # optionally as a rolling mean over window days (centered on the date, or ending with it)
+    first_year, last_year = calendar_index.years([first_day, last_day]).tolist()
     standard_mortality_by_date = _compute_standard_mortality_by_date(conn, first_year, last_year, ages=ages)
-    ref_mortality_by_year = {
-        year: mean(
-            standard_mortality_by_date[date]
-            for date in standard_mortality_by_date.keys()
-            if date >= f"{year}-06" and date < f"{year}-08"
-        )
-        for year in range(first_year, last_year+1)
-    }
-    return {
-        date: standard_mortality_by_date[date] / ref_mortality_by_year[int(date[:4])]
-        for date in standard_mortality_by_date.keys()
-    }
-
+    dates = np.fromiter(standard_mortality_by_date.keys(), dtype=np.int64)
+    series = np.full(dates.max() - dates.min() + 1, np.nan)
+    series[dates - dates.min()] = list(standard_mortality_by_date.values())
+    wins = windows.DayWindows(series, first_day=dates.min())
+    years = range(first_year, last_year+1)
+    ref_mortality_by_year = wins.mean(
+        calendar_index.to_days([f"{year}-06-01" for year in years]),
+        calendar_index.to_days([f"{year}-08-01" for year in years]))
+    if window:
+        series = wins.rolling_mean(window, center=center)
+    res = series[dates - dates.min()] / ref_mortality_by_year[calendar_index.years(dates) - first_year]
+    return dict(zip(dates.tolist(), res.tolist()))
+
+
+SQL_TEMPS_BY_DATE = "select date, {agg}(temperature) from meteo group by date"
 
 def comp_temps_by_date(conn, agg='avg'):
     return {
         date: temp
-        for date, temp in conn.execute(
-            f"select date, {agg}(temperature) from meteo group by date"
-        )
+        for date, temp in conn.execute(SQL_TEMPS_BY_DATE.format(agg=agg))
     }
 
+SQL_TEMPS_BY_DATE_DEP = "select date, dep, {agg}(temperature) from meteo group by date, dep"
+
 def comp_temps_by_date_dep(conn, agg='avg'):
     return {
         (date, dep): temp
-        for date, dep, temp in conn.execute(
-            f"select date, dep, {agg}(temperature) from meteo group by date, dep"
-        )
+        for date, dep, temp in conn.execute(SQL_TEMPS_BY_DATE_DEP.format(agg=agg))
     }
 
 
+def comp_temps_matrix(conn, first_day, last_day, agg='avg'):
+    # (departments, temperatures by [day, department] from first_day, nan where missing)
+    rows = conn.execute(SQL_TEMPS_BY_DATE_DEP.format(agg=agg)).fetchall()
+    dates = np.array([date for date, _, _ in rows], dtype=np.int64)
+    deps, dep_idx = np.unique(np.array([dep for _, dep, _ in rows], dtype=str), return_inverse=True)
+    vals = np.array([temp for _, _, temp in rows], dtype=float)
+    in_range = (dates >= first_day) & (dates <= last_day)
+    temps = np.full((last_day - first_day + 1, len(deps)), np.nan)
+    temps[dates[in_range] - first_day, dep_idx[in_range]] = vals[in_range]
+    return deps, temps
+
+
+def _iter_deaths_by_date_dep_age(conn, deps, nb_ages):
+    # chunks of (day index, department index, age, nb of deaths) arrays, from FIRST_DAY,
+    # for the given (sorted) departments and ages below nb_ages
+    src = _deaths_source(conn)
+    if isinstance(src, tensor.DeathTensor):
+        days, row_deps, deaths = src.deaths_by_date_dep_age((FIRST_DAY, LAST_DAY))
+        day, age, strata = deaths.nonzero()
+        chunks = [(days[day], row_deps[strata], age, deaths[day, age, strata])]
+    else:
+        cursor = conn.execute(SQL_DEATHS_BY_DATE_DEP_AGE, [FIRST_DAY, LAST_DAY])
+        chunks = (
+            tuple(map(np.array, zip(*rows)))
+            for rows in iter(lambda: cursor.fetchmany(DEATHS_FETCH_SIZE), [])
+        )
+    for days, row_deps, ages, nbs in chunks:
+        dep = np.minimum(np.searchsorted(deps, row_deps.astype(str)), len(deps) - 1)
+        keep = (deps[dep] == row_deps) & (ages >= 0) & (ages < nb_ages)
+        yield days[keep] - FIRST_DAY, dep[keep], ages[keep].astype(np.int64), nbs[keep].astype(float)
+
+
+SQL_MORTALITY_BY_DEP = "select dep, SUM(n) from deces_agg group by dep"
+
 def comp_mortality_by_dep(conn):
+    src = _deaths_source(conn)
+    if isinstance(src, tensor.DeathTensor):
+        return src.deaths_by_dep()
     return {
         dep: nb
-        for dep, nb in conn.execute(
-            f"select dep, count(*) from deces group by dep"
-        )
+        for dep, nb in conn.execute(SQL_MORTALITY_BY_DEP)
     }
 
 
-def comp_mortalite_par_temperature(conn, first_date, last_date, temps_by_date, standard2_mortality_by_date, date_delta=0):
+SQL_DEATHS_BY_DEP_AGE = "SELECT dep, age, SUM(n) FROM deces_agg WHERE is_metro=true AND date between ? and ? GROUP BY dep, age"
+
+def comp_population_by_dep(conn, first_day, last_day, nb_ages=100+1):
+    # the ages table has no departments: their populations are estimated from their deaths by age,
+    # at the national death rates by age (up to a factor, which does not matter for weights)
+    src = _deaths_source(conn)
+    if isinstance(src, tensor.DeathTensor):
+        _, strata_deps, deaths = src.deaths_by_date_dep_age((first_day, last_day))
+        deaths = deaths.sum(axis=0, dtype=np.int64)
+        ages, strata = deaths.nonzero()
+        row_deps, nbs = strata_deps[strata], deaths[ages, strata]
+    else:
+        rows = conn.execute(SQL_DEATHS_BY_DEP_AGE, [first_day, last_day]).fetchall()
+        row_deps = np.array([dep for dep, _, _ in rows], dtype=str)
+        ages = np.array([age for _, age, _ in rows], dtype=np.int64)
+        nbs = np.array([nb for _, _, nb in rows], dtype=float)
+    keep = (ages >= 0) & (ages < nb_ages)
+    deps, dep_idx = np.unique(row_deps[keep].astype(str), return_inverse=True)
+    deaths = np.zeros((len(deps), nb_ages))
+    np.add.at(deaths, (dep_idx, ages[keep].astype(np.int64)), nbs[keep])
+    first_year, last_year = calendar_index.years([first_day, last_day]).tolist()
+    pop = np.nansum(_select_pop_matrix(conn, first_year, last_year, nb_ages), axis=0)
+    nat_deaths = deaths.sum(axis=0)
+    inv_rates = np.divide(pop, nat_deaths, out=np.zeros(nb_ages), where=nat_deaths > 0)
+    return dict(zip(deps.tolist(), (deaths @ inv_rates).tolist()))
+
+
+DEP_WEIGHTS = ["mortality", "population"]
+
+def comp_dep_weights(conn, weights="mortality"):
+    if weights == "population":
+        return comp_population_by_dep(conn, FIRST_DAY, LAST_DAY)
+    return comp_mortality_by_dep(conn)
+
+
+class TempsMatrix:
+    # temperatures by [day, department] from first_day, queried once, then averaged by day
+    # with any weights by department, on any subset of them
+
+    def __init__(self, conn, first_day, last_day, agg='avg'):
+        self.first_day = first_day
+        self.deps, temps = comp_temps_matrix(conn, first_day, last_day, agg=agg)
+        self.known = ~np.isnan(temps)
+        self.temps = np.where(self.known, temps, 0)
+        self.mask = self.known.astype(float)
+
+    def weights(self, weights_by_dep, deps=None):
+        # by department of the matrix, 0 for the ones without weight or not in deps
+        weights = np.array([weights_by_dep.get(dep, 0) for dep in self.deps.tolist()], dtype=float)
+        if deps is not None:
+            weights[~np.isin(self.deps, list(deps))] = 0
+        return weights
+
+    def weighted_mean(self, weights_by_dep, deps=None):
+        # by day: mean of the known temperatures, weighted by department (nan if no known weighted one)
+        weights = self.weights(weights_by_dep, deps)
+        totals, total_weights = self.temps @ weights, self.mask @ weights
+        return np.divide(totals, total_weights, out=np.full(len(totals), np.nan), where=total_weights > 0)
+
+
+def comp_mortalite_par_temperature(conn, first_day, last_day, temps_by_date, standard2_mortality_by_date, date_delta=0):
+    # the lag is an offset on day numbers
     temps_by_date = comp_temps_by_date(conn)
     return [
-        (standard2_mortality_by_date[date], temps_by_date[_add_days(date, -date_delta)])
+        (standard2_mortality_by_date[date], temps_by_date[date - date_delta])
         for date in standard2_mortality_by_date.keys()
-        if date >= _add_days(first_date, date_delta) and last_date <= last_date
+        if date >= first_day + date_delta and date <= last_day
     ]
 
 
 @main.command("estimate_mortalite_par_temperature")
 @click.option("--date-delta", default=0)
 @click.option("--ages")
-def cmd_estimate_mortalite_par_temperature(date_delta, ages):
+@click.option("--window", type=int, help=f"Rolling mean of the mortality over this nb of days (ex: {', '.join(map(str, windows.ROLLING_WINDOWS))})")
+@click.option("--trailing", is_flag=True, help="Rolling windows end with their date, instead of being centered on it")
+@click.option("--lags", help="Scan these temperature lags (ex: 0-30), instead of fitting the --date-delta one")
+@click.option("--weights", type=click.Choice(DEP_WEIGHTS), default="mortality", help="Weights of the departments in the national temperature of the estimated mortality")
+@click.option("--deps", help="Departments of the national temperature of the estimated mortality, comma separated (default: all)")
+def cmd_estimate_mortalite_par_temperature(date_delta, ages, window, trailing, lags, weights, deps):
     with db_connect() as conn:
-        estimate_mortalite_par_temperature(conn, date_delta=date_delta, ages=ages.split('-') if ages else None)
+        if lags:
+            first_lag, last_lag = (int(lag) for lag in lags.split('-')) if '-' in lags else (int(lags), int(lags))
+            scan_mortalite_par_temperature_lags(conn, range(first_lag, last_lag+1), ages=ages.split('-') if ages else None, window=window, center=not trailing)
+        else:
+            estimate_mortalite_par_temperature(conn, date_delta=date_delta, ages=ages.split('-') if ages else None, window=window, center=not trailing,
+                weights=weights, deps=deps.split(',') if deps else None)
 
-def estimate_mortalite_par_temperature(conn, date_delta=0, ages=None):
-    standard2_mortality_by_date = comp_standard2_mortality_by_date(conn, FIRST_DATE, LAST_DATE, ages=ages)
+@profiling.profiled("compute")
+def estimate_mortalite_par_temperature(conn, date_delta=0, ages=None, window=None, center=True, weights="mortality", deps=None):
+    standard2_mortality_by_date = comp_standard2_mortality_by_date(conn, FIRST_DAY, LAST_DAY, ages=ages, window=window, center=center)
     temps_by_date = comp_temps_by_date(conn)
-    mortalite_par_temperature = comp_mortalite_par_temperature(conn, FIRST_DATE, LAST_DATE, temps_by_date, standard2_mortality_by_date, date_delta=date_delta)
+    mortalite_par_temperature = comp_mortalite_par_temperature(conn, FIRST_DAY, LAST_DAY, temps_by_date, standard2_mortality_by_date, date_delta=date_delta)
 
     temps = [t for _, t in mortalite_par_temperature]
     mortalites = [m for m, _ in mortalite_par_temperature]
@@ -589,143 +700,292 @@ def estimate_mortalite_par_temperature(conn, date_delta=0, ages=None):
     fname = ["mortalite_par_temperature_est"]
     if date_delta: fname.append(f"delta{date_delta}")
     if ages: fname.append(f"ages_{'_'.join(ages)}")
-    plt.savefig(os.path.join(HERE, f'results/{"_".join(fname)}.png'))
+    if window: fname.append(f"window{window}{'' if center else 't'}")
+    with profiling.stage("render", "savefig"):
+        plt.savefig(os.path.join(HERE, f'results/{"_".join(fname)}.png'))
 
-    dates = standard2_mortality_by_date.keys()
+    dates = list(standard2_mortality_by_date.keys())
     min_date = min(dates)
 
     plt.clf()
     plt.title("[France] Mortalité Réelle VS Estimée")
     plt.figure(figsize=(50, 3))
-    plt.plot(dates, [standard2_mortality_by_date[d] for d in dates], label="réelle")
-    temps_by_date_dep = comp_temps_by_date_dep(conn)
-    deps = set(dep for _, dep in temps_by_date_dep.keys())
-    mortality_by_dep = comp_mortality_by_dep(conn)
-    weigth_temps_by_date = {
-        date: weighted_mean([
-            (temps_by_date_dep[(date, dep)], mortality_by_dep.get(dep, 0))
-            for dep in deps
-            if (date, dep) in temps_by_date_dep
-        ])
-        for date in dates
-    }
-    temps = np.array([
-        weigth_temps_by_date[max(min_date, _add_days(d, -date_delta))]
-        for d in dates
-    ])
-    plt.plot(dates, piecewise_linear(temps, *popt).tolist(), label="estimée")
+    plt.plot(calendar_index.to_datetimes(dates), [standard2_mortality_by_date[d] for d in dates], label="réelle")
+    weigth_temps = TempsMatrix(conn, FIRST_DAY, LAST_DAY).weighted_mean(comp_dep_weights(conn, weights), deps=deps)
+    temps = weigth_temps[np.maximum(min_date, np.array(dates) - date_delta) - FIRST_DAY]
+    plt.plot(calendar_index.to_datetimes(dates), piecewise_linear(temps, *popt).tolist(), label="estimée")
     plt.legend()
     fname = ["mortalite_reelle_vs_est"]
     if date_delta: fname.append(f"delta{date_delta}")
     if ages: fname.append(f"ages_{'_'.join(ages)}")
-    plt.savefig(os.path.join(HERE, f'results/{"_".join(fname)}.png'))
-
+    if window: fname.append(f"window{window}{'' if center else 't'}")
+    if weights != "mortality": fname.append(f"{weights}_weights")
+    if deps: fname.append(f"deps_{'_'.join(deps)}")
+    with profiling.stage("render", "savefig"):
+        plt.savefig(os.path.join(HERE, f'results/{"_".join(fname)}.png'))
+
+
+@profiling.profiled("compute")
+def scan_mortalite_par_temperature_lags(conn, lags, ages=None, window=None, center=True):
+    # the quadratic fit of estimate_mortalite_par_temperature, for all the lags at once:
+    # series are loaded once, and the fits solved as one batch of least squares
+    lags = list(lags)
+    mortality, temps = _mortality_temperature_series(conn, ages=ages, window=window, center=center)
+    coefs, r2, rmse, nb = fit_lagged_quadratic(mortality, temps, lags)
+    print(f"{'lag':>4} {'nb':>6} {'r2':>8} {'rmse':>8} {'a':>11} {'b':>11} {'c':>11}")
+    for i, lag in enumerate(lags):
+        print(f"{lag:>4} {nb[i]:>6} {r2[i]:>8.4f} {rmse[i]:>8.4f} {coefs[i, 0]:>11.3e} {coefs[i, 1]:>11.3e} {coefs[i, 2]:>11.3e}")
+    best = int(np.nanargmax(r2))
+    print(f"best lag: {lags[best]} (r2 {r2[best]:.4f})")
 
-def _select_pop_par_age(conn, annee):
-    rows = conn.execute(
-        '''SELECT age, SUM(nb) FROM ages WHERE annee = ? GROUP BY age''',
-        [annee]
-    )
-    return {age:nb for age, nb in rows}
+    plt.clf()
+    fig, axs = plt.subplots(2, figsize=(8, 8))
+    fig.suptitle(f"[France] Mortalité par température, décalage de {lags[best]} jours")
+    valid = ~np.isnan(mortality[lags[best]:]) & ~np.isnan(temps[:len(temps) - lags[best]])
+    best_temps = temps[:len(temps) - lags[best]][valid]
+    axs[0].scatter(best_temps, mortality[lags[best]:][valid], s=5, alpha=0.3)
+    xd = np.linspace(best_temps.min(), best_temps.max(), 100)
+    axs[0].plot(xd, np.polyval(coefs[best], xd), color="red")
+    axs[1].plot(lags, r2, marker="o")
+    axs[1].set_xlabel("décalage (jours)")
+    axs[1].set_ylabel("r2")
+    fname = ["mortalite_par_temperature_lags", f"{lags[0]}_{lags[-1]}"]
+    if ages: fname.append(f"ages_{'_'.join(ages)}")
+    if window: fname.append(f"window{window}{'' if center else 't'}")
+    with profiling.stage("render", "savefig"):
+        fig.savefig(os.path.join(HERE, f'results/{"_".join(fname)}.png'))
+    plt.close(fig)
+
+
+def _mortality_temperature_series(conn, ages=None, window=None, center=True):
+    # (standard2 mortality, national mean temperature) by day from FIRST_DAY to LAST_DAY, nan where missing
+    mortality = np.full(LAST_DAY - FIRST_DAY + 1, np.nan)
+    temps = np.full(LAST_DAY - FIRST_DAY + 1, np.nan)
+    for series, by_date in (
+        (mortality, comp_standard2_mortality_by_date(conn, FIRST_DAY, LAST_DAY, ages=ages, window=window, center=center)),
+        (temps, comp_temps_by_date(conn)),
+    ):
+        dates = np.fromiter(by_date.keys(), dtype=np.int64)
+        vals = np.fromiter(by_date.values(), dtype=float)
+        in_range = (dates >= FIRST_DAY) & (dates <= LAST_DAY)
+        series[dates[in_range] - FIRST_DAY] = vals[in_range]
+    return mortality, temps
+
+
+def fit_lagged_quadratic(mortality, temps, lags):
+    # least squares fits of mortality[day] = a*t^2 + b*t + c, t = temps[day - lag], for all the lags at once
+    # (the lagged temperatures are a strided view of the series): ([lag, (a, b, c)], r2, rmse, nb of days) by lag
+    padded = np.concatenate([np.full(max(lags), np.nan), temps])
+    lagged = np.lib.stride_tricks.sliding_window_view(padded, max(lags) + 1)[:, ::-1][:, lags]
+    valid = ~np.isnan(lagged) & ~np.isnan(mortality)[:, None]
+    t = np.where(valid, lagged, 0)
+    y = np.where(valid, mortality[:, None], 0)
+    design = np.stack([t * t, t, valid.astype(float)], axis=-1)
+    coefs = np.linalg.solve(
+        np.einsum("dlp,dlq->lpq", design, design),
+        np.einsum("dlp,dl->lp", design, y)[:, :, None])[:, :, 0]
+    nb = valid.sum(axis=0)
+    sse = ((y - np.einsum("dlp,lp->dl", design, coefs)) ** 2).sum(axis=0)
+    sst = (np.where(valid, y - y.sum(axis=0) / nb, 0) ** 2).sum(axis=0)
+    return coefs, 1 - sse / sst, np.sqrt(sse / nb), nb
+
+
+# distributed lag non-linear model (DLNM): daily mortality relatively to its yearly (centered 365 days) mean,
+# by age band, explained by a spline basis of the temperature crossed with a basis of its lags,
+# with the seasonality as confounder (harmonics of the day of the year)
+DLNM_AGES = ["0-64", "65-74", "75-84", "85-120"]
+DLNM_MAX_LAG = 21
+DLNM_LAG_EDGES = (0, 1, 3, 7, 14)  # starts of the lag strata
+DLNM_TEMP_KNOTS = (10, 50, 90)  # percentiles of the temperature
+DLNM_NB_HARMONICS = 2
+
+@main.command("estimate_dlnm")
+@click.option("--ages", default=",".join(DLNM_AGES), help="Age bands, comma separated")
+@click.option("--max-lag", default=DLNM_MAX_LAG)
+def cmd_estimate_dlnm(ages, max_lag):
+    with db_connect() as conn:
+        estimate_dlnm(conn, [tuple(int(age) for age in band.split('-')) for band in ages.split(',')], max_lag=max_lag)
+
+@profiling.profiled("compute")
+def estimate_dlnm(conn, age_bands, max_lag=DLNM_MAX_LAG):
+    mortality = _relative_mortality_by_age_band(conn, age_bands)
+    _, temps = _mortality_temperature_series(conn)
+    knots = np.nanpercentile(temps, DLNM_TEMP_KNOTS)
+    center, scale = np.nanmean(temps), np.nanstd(temps)
+    lag_basis = _dlnm_lag_basis(max_lag)
+    cross_basis = _dlnm_cross_basis(temps, knots, center, scale, lag_basis)
+    days = calendar_index.day_range(FIRST_DAY, LAST_DAY)
+    design = np.concatenate([_dlnm_seasonal_basis(days), cross_basis.reshape(len(days), -1)], axis=1)
+    valid = np.isfinite(design).all(axis=1) & np.isfinite(mortality).all(axis=1)
+    # one least squares solve for all the age bands
+    coefs, *_ = np.linalg.lstsq(design[valid], mortality[valid], rcond=None)
+    resid = mortality[valid] - design[valid] @ coefs
+    r2 = 1 - (resid ** 2).sum(axis=0) / ((mortality[valid] - mortality[valid].mean(axis=0)) ** 2).sum(axis=0)
+    # [temp basis, lag stratum, band] coefficients, then by [temp basis, lag, band]
+    temp_coefs = coefs[-cross_basis.shape[1] * cross_basis.shape[2]:].reshape(cross_basis.shape[1], cross_basis.shape[2], -1)
+    lag_coefs = np.einsum("kjs,lj->kls", temp_coefs, lag_basis)
+    # responses relatively to the minimum mortality temperature (MMT), within the 1st-99th percentiles
+    low, high = np.nanpercentile(temps, (1, 99))
+    temp_grid = np.linspace(low, high, 200)
+    grid_basis = _dlnm_temp_basis(temp_grid, knots, center, scale)
+    cumulative = grid_basis @ lag_coefs.sum(axis=1)
+    mmt_idx = cumulative.argmin(axis=0)
+    cumulative -= cumulative[mmt_idx, np.arange(len(age_bands))]
+    print(f"{'ages':>8} {'nb':>6} {'r2':>7} {'mmt':>6} {f'cold {low:.1f}':>10} {f'hot {high:.1f}':>10}")
+    for i, (min_age, max_age) in enumerate(age_bands):
+        print(f"{f'{min_age}-{max_age}':>8} {valid.sum():>6} {r2[i]:>7.3f} {temp_grid[mmt_idx[i]]:>6.1f} {cumulative[0, i]:>10.3f} {cumulative[-1, i]:>10.3f}")
 
+    plt.clf()
+    fig, axs = plt.subplots(2, figsize=(8, 8))
+    fig.suptitle(f"[France] Mortalité relative par température, décalages de 0 à {max_lag} jours")
+    for i, (min_age, max_age) in enumerate(age_bands):
+        label = f"{min_age}-{max_age} ans"
+        axs[0].plot(temp_grid, cumulative[:, i], color=f"C{i}", label=label)
+        mmt_basis = grid_basis[mmt_idx[i]]
+        for temp_idx, style in ((0, "-"), (-1, "--")):
+            axs[1].plot(range(max_lag+1), (grid_basis[temp_idx] - mmt_basis) @ lag_coefs[:, :, i], style,
+                color=f"C{i}", label=f"{label}, {temp_grid[temp_idx]:.1f}°C")
+    axs[0].set_xlabel("température (°C)")
+    axs[0].set_ylabel("effet cumulé")
+    axs[0].legend()
+    axs[1].set_xlabel("décalage (jours)")
+    axs[1].set_ylabel("effet")
+    axs[1].legend(fontsize="small")
+    fname = ["dlnm", f"lag{max_lag}"] + [f"{min_age}_{max_age}" for min_age, max_age in age_bands]
+    with profiling.stage("render", "savefig"):
+        fig.savefig(os.path.join(HERE, f'results/{"_".join(fname)}.png'))
+    plt.close(fig)
+
+
+def _relative_mortality_by_age_band(conn, age_bands):
+    # deaths by [day, band] from FIRST_DAY to LAST_DAY, divided by their centered 365 days mean
+    deaths_by_age = _select_deaths_matrix(conn, FIRST_DAY, LAST_DAY)
+    deaths = np.stack([deaths_by_age[:, min_age:max_age+1].sum(axis=1) for min_age, max_age in age_bands], axis=1)
+    yearly = windows.DayWindows(deaths, first_day=FIRST_DAY).rolling_mean(365, center=True)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return deaths / yearly
+
+
+def _dlnm_temp_basis(temps, knots, center, scale):
+    # cubic truncated power spline of the (standardized) temperature: [..., basis]
+    x = (np.asarray(temps) - center) / scale
+    x_knots = (np.asarray(knots) - center) / scale
+    return np.concatenate([
+        np.stack([x, x ** 2, x ** 3], axis=-1),
+        np.maximum(x[..., None] - x_knots, 0) ** 3,
+    ], axis=-1)
+
+
+def _dlnm_lag_basis(max_lag):
+    # [lag, stratum]: lag strata starting at DLNM_LAG_EDGES (constant effect within a stratum)
+    edges = [edge for edge in DLNM_LAG_EDGES if edge <= max_lag] + [max_lag + 1]
+    lags = np.arange(max_lag + 1)
+    return np.stack([(lags >= start) & (lags < end) for start, end in zip(edges, edges[1:])], axis=1).astype(float)
+
+
+def _dlnm_cross_basis(temps, knots, center, scale, lag_basis):
+    # [day, temp basis, lag stratum]: temperature basis of the previous days, summed by lag stratum
+    # (lagged values are a strided view of the basis; nan for the first days)
+    max_lag = len(lag_basis) - 1
+    basis = _dlnm_temp_basis(temps, knots, center, scale)
+    padded = np.concatenate([np.full((max_lag, basis.shape[1]), np.nan), basis])
+    lagged = np.lib.stride_tricks.sliding_window_view(padded, max_lag + 1, axis=0)[:, :, ::-1]
+    return np.einsum("dkl,lj->dkj", lagged, lag_basis)
+
+
+def _dlnm_seasonal_basis(days):
+    # intercept, and harmonics of the day of the year
+    angle = 2 * np.pi * (np.asarray(days) % 365.25) / 365.25
+    return np.stack([np.ones(len(angle))] + [
+        fun(harmonic * angle)
+        for harmonic in range(1, DLNM_NB_HARMONICS + 1)
+        for fun in (np.sin, np.cos)
+    ], axis=1)
+
+
+SQL_DEATHS_BY_DATE_AGE = "SELECT date, age, SUM(n) FROM deces_agg WHERE is_metro=true AND date between ? and ? GROUP BY date, age"
+STANDARD_NB_AGES = 100 + 1
 
 def _compute_standard_mortality_by_date(conn, first_year, last_year, ages=None):
-    deces_standard_par_date = {}
-    last_pop_par_age = _select_pop_par_age(conn, last_year)
-    ages_sql = "AND age between ? and ?" if ages else ""
-    ages_sql_args = ages if ages else []
-    for year in range(first_year, last_year+1):
-        pop_par_age = _select_pop_par_age(conn, year)
-        deces_par_date_age = {
-            (date, age): val
-            for date, age, val in conn.execute(
-                f"SELECT date_deces, age, count(*) FROM deces WHERE is_metro=true AND date_deces between ? and ? {ages_sql} GROUP BY date_deces, age",
-                [str(year), str(year+1)] + ages_sql_args
-            )
-        }
-        dates = sorted(set(d for (d, _) in deces_par_date_age.keys()))
-        deces_standard_par_date_age = {
-            (date, age): val * last_pop_par_age.get(age, 0) / pop_par_age.get(age, 1)
-            for (date, age), val in deces_par_date_age.items()
-        }
-        deces_standard_par_date.update({
-            date: sum(
-                deces_standard_par_date_age.get((date, age),0)
-                for age in range(0, 100+1)
-            )
-            for date in dates
-        })
-    return deces_standard_par_date
-
-
-# parsing
-
-class ParseError(Exception):
-    pass
-
-class ParseSexError(ParseError):
-    pass
-
-def _parse_sex(val):
-    if val == "1": return "M"
-    if val == "2": return "F"
-    raise ParseSexError(f"Bad sex value: {val}")
-
-def _parse_int(val, def_val=0):
-    try:
-        return int(val)
-    except:
-        return def_val
-
-class DateParseError(ParseError):
-    pass
-
-def _parse_date(val, def_month=None, def_day=None):
-    try:
-        year = val[0:4]
-        month = val[4:6]
-        day = val[6:8]
-        if year=="0000":
-            raise DateParseError(f"Bad year value: {year}")
-        if month=="00":
-            if def_month:
-                month = def_month
-            else:
-                raise DateParseError(f"Bad month value: {month}")
-        if day=="00":
-            if def_day:
-                day = def_day
-            else:
-                raise DateParseError(f"Bad day value: {day}")
-        return f"{year}-{month}-{day}"
-    except Exception as exc:
-        raise DateParseError(exc)
-
-
-def _date_range_to_dates(date_range):
-    res = []
-    start, end = _to_dt(date_range[0]), _to_dt(date_range[1])
-    day = start
-    while day <= end:
-        res.append(day)
-        day += timedelta(days=1)
-    return res
+    # deaths of the dates (with deaths) of the years, at the population by age of the last year:
+    # deaths by [day, age] * (pop of the last year / pop of the year of the day) by age, summed by day
+    first_day, last_day = calendar_index.year_range(first_year)[0], calendar_index.year_range(last_year)[1]
+    deaths = _select_deaths_matrix(conn, first_day, last_day)
+    pop = _select_pop_matrix(conn, first_year, last_year, STANDARD_NB_AGES)
+    factors = np.zeros((len(pop), deaths.shape[1]))
+    factors[:, :STANDARD_NB_AGES] = np.nan_to_num(pop[-1]) / np.where(np.isnan(pop), 1, pop)
+    if ages:
+        min_age, max_age = (int(age) for age in ages)
+        deaths, factors = deaths[:, min_age:max_age+1], factors[:, min_age:max_age+1]
+    days = np.arange(first_day, last_day + 1)
+    year_idx = calendar_index.years(days) - first_year
+    standard = (deaths * factors[year_idx]).sum(axis=1)
+    has_deaths = deaths.sum(axis=1) > 0
+    return dict(zip(days[has_deaths].tolist(), standard[has_deaths].tolist()))
+
+
+def _select_deaths_matrix(conn, first_day, last_day):
+    # deaths by [day, age] from first_day, in one query (at least STANDARD_NB_AGES ages)
+    src = _deaths_source(conn)
+    if isinstance(src, tensor.DeathTensor):
+        days, deaths_by_age = src.deaths_by_date_age((first_day, last_day))
+        deaths = np.zeros((last_day - first_day + 1, max(deaths_by_age.shape[1], STANDARD_NB_AGES)))
+        deaths[days - first_day, :deaths_by_age.shape[1]] = deaths_by_age
+        return deaths
+    rows = np.array(conn.execute(SQL_DEATHS_BY_DATE_AGE, [first_day, last_day]).fetchall(), dtype=np.int64).reshape(-1, 3)
+    dates, ages, nbs = rows[rows[:, 1] >= 0].T
+    deaths = np.zeros((last_day - first_day + 1, max(ages.max(initial=0) + 1, STANDARD_NB_AGES)))
+    deaths[dates - first_day, ages] = nbs
+    return deaths
+
+
+SQL_POP_BY_YEAR_AGE = '''SELECT annee, age, SUM(nb) FROM ages WHERE annee between ? and ? GROUP BY annee, age'''
+
+def _select_pop_matrix(conn, first_year, last_year, nb_ages):
+    # population by [year, age] from first_year, nan where unknown
+    pop = np.full((last_year - first_year + 1, nb_ages), np.nan)
+    src = _deaths_source(conn)
+    if isinstance(src, tensor.DeathTensor):
+        idx = np.arange(first_year, last_year + 1) - src.first_year
+        known = (idx >= 0) & (idx < len(src.pop))
+        nbs = src.pop[idx[known], :nb_ages]
+        pop[known, :nbs.shape[1]] = np.where(nbs >= 0, nbs, np.nan)
+        return pop
+    rows = np.array(conn.execute(SQL_POP_BY_YEAR_AGE, [first_year, last_year]).fetchall(), dtype=float).reshape(-1, 3)
+    years, ages, nbs = rows[(rows[:, 1] >= 0) & (rows[:, 1] < nb_ages)].T
+    pop[years.astype(np.int64) - first_year, ages.astype(np.int64)] = nbs
+    return pop
+
+
+@main.command("export_tensor")
+@click.option("--start", default=START_DATE)
+@click.option("--end", default=END_DATE)
+@click.argument("path", default=os.path.join(HERE, "tensor"))
+def cmd_export_tensor(start, end, path):
+    with db_connect() as conn:
+        tensor.save_tensor(tensor.build_tensor(conn, start, end), path)
+
+
+# queries issued by the compute commands, with example arguments
+EXPLAINED_QUERIES = {
+    "deaths_by_date_dep_age": (SQL_DEATHS_BY_DATE_DEP_AGE, [FIRST_DAY, LAST_DAY]),
+    "temps_by_date": (SQL_TEMPS_BY_DATE.format(agg="avg"), []),
+    "temps_by_date_dep": (SQL_TEMPS_BY_DATE_DEP.format(agg="avg"), []),
+    "mortality_by_dep": (SQL_MORTALITY_BY_DEP, []),
+    "deaths_by_dep_age": (SQL_DEATHS_BY_DEP_AGE, [FIRST_DAY, LAST_DAY]),
+    "pop_by_year_age": (SQL_POP_BY_YEAR_AGE, [2010, 2021]),
+    "deaths_by_date_age": (SQL_DEATHS_BY_DATE_AGE, [FIRST_DAY, LAST_DAY]),
+}
+
+@main.command("explain_queries")
+def cmd_explain_queries():
+    with db_connect() as conn:
+        for name, (req, args) in EXPLAINED_QUERIES.items():
+            utils.print_query_plan(conn, name, req, args)
 
 
 # utils
 
-def _get_all_dates(start_date, end_date):
-    date = datetime.strptime(start_date, "%Y-%m-%d")
-    _end_date = datetime.strptime(end_date, "%Y-%m-%d")
-    res = []
-    while date <= _end_date:
-        res.append(date.strftime("%Y-%m-%d"))
-        date += timedelta(days=1)
-    return res
-
-def _dt_to_annees(dt):
-    return int(dt.days / 365.25)
-
 def _db_bulk_insert(conn, table_name, values):
     if len(values) == 0:
         return
@@ -733,26 +993,5 @@ def _db_bulk_insert(conn, table_name, values):
         f"INSERT INTO {table_name} ({','.join(values[0].keys())}) VALUES ({','.join('?' for _ in range(len(values[0])))})",
         [list(v.values()) for v in values])
 
-def _add_days(date_str, n):
-    if n == 0: return date_str
-    date = datetime.strptime(date_str, "%Y-%m-%d")
-    date += timedelta(days=n)
-    return date.strftime("%Y-%m-%d")
-
-def _get_by_paquet(ite, size):
-    paquet = []
-    for val in ite:
-        paquet.append(val)
-        if len(paquet) >= size:
-            yield paquet
-            paquet.clear()
-    if paquet:
-        yield paquet
-
-def weighted_mean(vals):
-    total = sum(a*b for a, b in vals)
-    total_weigths = sum(b for _, b in vals)
-    return total / total_weigths
-
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,472 @@
+# INSEE "fichier des personnes décédées" parsing & import
+import os
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from itertools import count
+from operator import itemgetter
+
+import numpy as np
+
+import utils
+import manifest
+import calendar_index
+import profiling
+
+DECES_COLUMNS = ("sex", "date_naissance", "date_deces", "lieu_deces", "dep", "age", "is_metro")
+
+# nb of rows sent to executemany at once
+BATCH_SIZE = 10000
+
+# with several workers, files bigger than this are parsed by chunks
+CHUNK_SIZE = 16 * 1024 * 1024
+
+# size of the blocks of records decoded at once
+BLOCK_SIZE = 4 * 1024 * 1024
+
+
+def import_deces_files(conn, paths, table="deces", columns=DECES_COLUMNS, batch_size=BATCH_SIZE, workers=1):
+    # only new or changed files are imported, each one in its own transaction
+    infos_by_path = {}
+    for path in paths:
+        infos = manifest.get_file_infos(conn, path)
+        if infos: infos_by_path[path] = infos
+    paths = list(infos_by_path.keys())
+    try:
+        if workers <= 1:
+            for path in paths:
+                print(f"import {os.path.basename(path)}")
+                with profiling.stage("import", os.path.basename(path)):
+                    file_id = _start_file(conn, infos_by_path[path], table)
+                    nb_rows = import_deces_file(conn, path, file_id, table=table, columns=columns, batch_size=batch_size)
+                    profiling.add_rows(nb_rows)
+                    manifest.end_file(conn, file_id, nb_rows)
+        else:
+            _import_deces_files_parallel(conn, paths, infos_by_path, table, columns, batch_size, workers)
+    except BaseException:
+        conn.rollback()
+        raise
+
+
+def _import_deces_files_parallel(conn, paths, infos_by_path, table, columns, batch_size, workers):
+    # parsing is done by a pool of processes, this process being the only sqlite writer
+    # (results come in the order of the chunks, so a file is complete when the next one starts)
+    chunks = (chunk for path in paths for chunk in iter_file_chunks(path))
+    current = None
+    def _end_file():
+        print_stats(os.path.basename(current["path"]), current["stats"])
+        add_to_agg(conn, current["agg"])
+        profiling.add_rows(current["nb_rows"])
+        manifest.end_file(conn, current["file_id"], current["nb_rows"])
+        current["stage"].__exit__(None, None, None)
+    with ProcessPoolExecutor(workers) as pool:
+        for path, rows, agg, stats in _map_bounded(pool, parse_chunk, chunks, 2*workers):
+            if current is None or current["path"] != path:
+                if current: _end_file()
+                print(f"import {os.path.basename(path)}")
+                # (the stage of a file runs from its first parsed chunk to its end)
+                stage = profiling.stage("import", os.path.basename(path)).__enter__()
+                file_id = _start_file(conn, infos_by_path[path], table)
+                current = {"path": path, "file_id": file_id, "nb_rows": 0, "agg": Counter(), "stats": _new_stats(),
+                           "write": _rows_writer(conn, table, columns, file_id), "stage": stage}
+            for paquet in utils.get_by_paquet(rows, batch_size):
+                current["write"](paquet)
+            current["nb_rows"] += len(rows)
+            current["agg"].update(agg)
+            _merge_stats(current["stats"], stats)
+    if current: _end_file()
+
+
+def import_deces_file(conn, path, file_id, table="deces", columns=DECES_COLUMNS, batch_size=BATCH_SIZE):
+    # rows are inserted by batches, the commit being left to the caller
+    fname = os.path.basename(path)
+    stats = _new_stats()
+    write = _rows_writer(conn, table, columns, file_id)
+    agg = Counter()
+    nb_rows = 0
+    with utils.open_source(path) as file:
+        rows = (row for block in iter_blocks(file) for row in decode_block(block, stats))
+        for paquet in utils.get_by_paquet(rows, batch_size):
+            agg.update(map(AGG_KEY, paquet))
+            write(paquet)
+            nb_rows += len(paquet)
+    print_stats(fname, stats)
+    add_to_agg(conn, agg)
+    return nb_rows
+
+
+def _start_file(conn, infos, table):
+    # rows of a previous import of the file are about to be removed: remove them from the aggregate first
+    file_id = manifest.get_file_id(conn, infos["fname"])
+    if file_id is not None:
+        add_to_agg(conn, Counter({
+            tuple(key): n
+            for *key, n in conn.execute(_agg_select(conn, table) + " WHERE file_id = ? GROUP BY 1, 2, 3, 4, 5", [file_id])
+        }), sign=-1)
+    return manifest.start_file(conn, infos, [table])
+
+
+def _insert_req(table, columns):
+    columns = (*columns, "file_id")
+    return f"INSERT INTO {table} ({','.join(columns)}) VALUES ({','.join('?' for _ in columns)})"
+
+def _cols_getter(columns, extra=()):
+    idxs = [DECES_COLUMNS.index(col) for col in columns]
+    return lambda row: tuple(row[i] for i in idxs) + extra
+
+def _rows_writer(conn, table, columns, file_id):
+    # returns a function inserting a paquet of parsed rows in the table, in its layout
+    if not is_compact(conn, table):
+        req, get_cols = _insert_req(table, columns), _cols_getter(columns, (file_id,))
+        return lambda paquet: conn.executemany(req, map(get_cols, paquet))
+    req = _insert_req(table, COMPACT_COLUMNS)
+    get_commune = _communes_getter(conn)
+    seq = count()
+    # (sorted by the primary key: less pages touched by each batch)
+    return lambda paquet: conn.executemany(req, sorted(
+        (date_deces, age, SEX_CODES[sex], date_naissance, get_commune(lieu_deces, dep, is_metro), next(seq), file_id)
+        for sex, date_naissance, date_deces, lieu_deces, dep, age, is_metro in paquet))
+
+
+# compact layout of the deces table: integer coded sex, death place as an id in the communes dictionary,
+# clustered by (date_deces, age) (file_id and seq make the key unique)
+# dates are day numbers, and small integers take a single byte in sqlite
+
+COMPACT_COLUMNS = ("date_deces", "age", "sex", "date_naissance", "commune", "seq")
+
+CREATE_COMPACT = '''CREATE TABLE IF NOT EXISTS {table}(date_deces integer, age integer, sex integer, date_naissance integer, commune integer, seq integer, file_id integer, PRIMARY KEY (date_deces, age, file_id, seq)) WITHOUT ROWID'''
+
+CREATE_COMMUNES = '''CREATE TABLE IF NOT EXISTS communes(id integer PRIMARY KEY, code text UNIQUE, dep text, is_metro bool)'''
+
+SEX_CODES = {"M": 1, "F": 2}
+
+def create_table(conn, create_req, table="deces", compact=None):
+    # the deces table, with the given create_req, or in its compact layout
+    # compact=None keeps the layout of an existing table
+    # returns True if an existing table was dropped (see manifest.create_table)
+    if compact is None:
+        compact = is_compact(conn, table)
+    if compact:
+        conn.execute(CREATE_COMMUNES)
+        create_req = CREATE_COMPACT.format(table=table)
+    return manifest.create_table(conn, table, create_req)
+
+def is_compact(conn, table="deces"):
+    return "commune" in [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+
+def compact_table(conn, table="deces"):
+    # converts the deces table to the compact layout, keeping its rows (and so the import manifest)
+    if is_compact(conn, table):
+        return False
+    conn.execute(f"ALTER TABLE {table} RENAME TO {table}_plain")
+    conn.execute(CREATE_COMMUNES)
+    conn.execute(CREATE_COMPACT.format(table=table))
+    conn.execute(f"INSERT OR IGNORE INTO communes (code, dep, is_metro) SELECT lieu_deces, substr(lieu_deces, 1, 2), is_metro FROM {table}_plain GROUP BY lieu_deces")
+    conn.execute(f'''INSERT INTO {table} ({", ".join(COMPACT_COLUMNS)}, file_id)
+        SELECT date_deces, age, CASE sex WHEN 'M' THEN 1 ELSE 2 END, date_naissance, communes.id, p.rowid, file_id
+        FROM {table}_plain p JOIN communes ON communes.code = p.lieu_deces
+        ORDER BY 1, 2, 7, 6''')
+    conn.execute(f"DROP TABLE {table}_plain")
+    conn.commit()
+    # the freed pages are only given back to the file system by a VACUUM
+    conn.execute("VACUUM")
+    return True
+
+def _communes_getter(conn):
+    # id of a death place in the communes dictionary, new ones being added on the fly
+    ids = {code: id for id, code in conn.execute("SELECT id, code FROM communes")}
+    def _get(code, dep, is_metro):
+        if code not in ids:
+            ids[code] = conn.execute("INSERT INTO communes (code, dep, is_metro) VALUES (?, ?, ?)", [code, dep, is_metro]).lastrowid
+        return ids[code]
+    return _get
+
+
+# deces_agg: nb of deaths by date, age, sex, departement and is_metro,
+# maintained along with the deces table
+
+AGG_KEY = itemgetter(2, 5, 0, 4, 6)
+
+def _agg_select(conn, table):
+    # the deces_agg columns of the deces rows, to be grouped by 1, 2, 3, 4, 5
+    if is_compact(conn, table):
+        return f"SELECT date_deces, age, CASE sex WHEN 1 THEN 'M' ELSE 'F' END, dep, is_metro, count(*) FROM {table} JOIN communes ON communes.id = commune"
+    return f"SELECT date_deces, age, sex, substr(lieu_deces, 1, 2), is_metro, count(*) FROM {table}"
+
+CREATE_AGG = '''CREATE TABLE IF NOT EXISTS deces_agg(date integer, age integer, sex text, dep text, is_metro bool, n integer, PRIMARY KEY (date, age, sex, dep, is_metro)) WITHOUT ROWID'''
+
+def init_agg(conn, table="deces", rebuild=False):
+    # deces_agg is rebuilt from the deces table when its schema changed, or when asked (deces table dropped)
+    if rebuild or not manifest.is_same_schema(conn, "deces_agg", CREATE_AGG):
+        conn.execute("DROP TABLE IF EXISTS deces_agg")
+    conn.execute(CREATE_AGG)
+    if conn.execute("SELECT 1 FROM deces_agg LIMIT 1").fetchone() is None:
+        # deces rows imported before deces_agg existed
+        conn.execute(f"INSERT INTO deces_agg {_agg_select(conn, table)} GROUP BY 1, 2, 3, 4, 5")
+
+def add_to_agg(conn, agg, sign=1):
+    conn.executemany(
+        "INSERT INTO deces_agg (date, age, sex, dep, is_metro, n) VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (date, age, sex, dep, is_metro) DO UPDATE SET n = n + excluded.n",
+        [(*key, sign * n) for key, n in agg.items()])
+    if sign < 0:
+        conn.execute("DELETE FROM deces_agg WHERE n = 0")
+
+
+# chunks
+
+def get_file_chunks(path, chunk_size=CHUNK_SIZE):
+    # records are fixed-width lines: cutting a chunk just after a newline keeps them whole
+    size = os.path.getsize(path)
+    chunks, start = [], 0
+    with open(path, 'rb') as file:
+        while start < size:
+            end = start + chunk_size
+            if end < size:
+                file.seek(end)
+                file.readline()
+                end = file.tell()
+            end = min(end, size)
+            chunks.append((path, start, end))
+            start = end
+    return chunks
+
+def iter_file_chunks(path, chunk_size=CHUNK_SIZE):
+    # compressed files can't be seeked: they are decompressed here, and their chunks carry the data
+    if not utils.is_compressed(path):
+        for chunk in get_file_chunks(path, chunk_size):
+            yield (*chunk, None)
+        return
+    with utils.open_source(path) as file:
+        for block in iter_blocks(file, chunk_size):
+            yield (path, None, None, block)
+
+def parse_chunk(chunk):
+    # rows are returned with all the DECES_COLUMNS, the importing process choosing its columns
+    path, start, end, block = chunk
+    stats = _new_stats()
+    if block is None:
+        with open(path, 'rb') as file:
+            file.seek(start)
+            block = file.read(end - start)
+    rows = decode_block(block, stats)
+    agg = Counter(map(AGG_KEY, rows))
+    return path, rows, agg, stats
+
+def _map_bounded(pool, fun, args, max_pending):
+    # like pool.map, but without letting results pile up faster than they are consumed
+    args, pending = iter(args), deque()
+    for arg in args:
+        pending.append(pool.submit(fun, arg))
+        if len(pending) >= max_pending:
+            break
+    while pending:
+        res = pending.popleft().result()
+        for arg in args:
+            pending.append(pool.submit(fun, arg))
+            break
+        yield res
+
+
+def iter_blocks(file, block_size=BLOCK_SIZE):
+    rest = b""
+    while True:
+        data = file.read(block_size)
+        if not data:
+            break
+        block, sep, rest = (rest + data).rpartition(b"\n")
+        if sep:
+            yield block + sep
+    if rest:
+        yield rest
+
+
+# columnar decoding
+
+# offsets of the decoded bytes in a record: sex, birth date, death date, death place
+OFFSETS = np.r_[80:89, 154:167]
+SEX = 0
+BIRTH = slice(1, 9)
+DEATH = slice(9, 17)
+LIEU = slice(17, 22)
+
+def decode_block(block, stats):
+    # decode a block of whole lines with numpy
+    # lines which are not obviously valid are given to the slow parser, which reports the errors
+    arr = np.frombuffer(block, dtype=np.uint8)
+    nls = np.flatnonzero(arr == ord("\n"))
+    starts = np.concatenate(([0], nls + 1))
+    ends = np.concatenate((nls, [len(arr)]))
+    if starts[-1] == len(arr):
+        starts, ends = starts[:-1], ends[:-1]
+    fields = arr[np.minimum(starts[:, None] + OFFSETS, max(len(arr) - 1, 0))]
+    ok = (ends - starts) > OFFSETS[-1]
+
+    sex = fields[:, SEX]
+    ok &= (sex == ord("1")) | (sex == ord("2"))
+
+    birth_year, birth_month, birth_day, birth_ok = _decode_dates(fields[:, BIRTH], def_month=6, def_day=15)
+    death_year, death_month, death_day, death_ok = _decode_dates(fields[:, DEATH])
+    ok &= birth_ok & death_ok
+
+    lieu = fields[:, LIEU]
+    ok &= ((lieu >= 32) & (lieu < 128)).all(axis=1)
+    lieu_is_digit = (lieu >= ord("0")) & (lieu <= ord("9"))
+    lieu_is_int = lieu_is_digit.all(axis=1)
+    # int() accepts spaces, signs and underscores: let the slow parser handle those
+    ok &= lieu_is_int | ~np.isin(lieu, np.frombuffer(b" +-_", dtype=np.uint8)).any(axis=1)
+    lieu_int = _digits_to_int(lieu)
+    is_metro = lieu_is_int & (lieu_int < 96000)
+
+    birth_days = _days_from_civil(birth_year, birth_month, birth_day)
+    death_days = _days_from_civil(death_year, death_month, death_day)
+    ages = np.clip(np.trunc((death_days - birth_days) / 365.25), 0, 100).astype(np.int64)
+
+    oks = np.flatnonzero(ok)
+    rows = list(zip(
+        np.where(sex[oks] == ord("1"), "M", "F").tolist(),
+        birth_days[oks].tolist(),
+        death_days[oks].tolist(),
+        _to_str(lieu[oks]),
+        _to_str(lieu[oks, :2]),
+        ages[oks].tolist(),
+        is_metro[oks].tolist(),
+    ))
+    stats["nb_lines"] += len(oks)
+    bad_lines = (block[start:end+1] for start, end in zip(starts[~ok], ends[~ok]))
+    rows += iter_deces_rows(bad_lines, stats)
+    return rows
+
+def _decode_dates(digits, def_month=None, def_day=None):
+    ok = ((digits >= ord("0")) & (digits <= ord("9"))).all(axis=1)
+    year, month, day = _digits_to_int(digits[:, 0:4]), _digits_to_int(digits[:, 4:6]), _digits_to_int(digits[:, 6:8])
+    if def_month:
+        month = np.where(month == 0, def_month, month)
+    if def_day:
+        day = np.where(day == 0, def_day, day)
+    ok &= (year > 0) & (month >= 1) & (month <= 12) & (day >= 1)
+    ok &= day <= _days_in_month(year, np.clip(month, 1, 12))
+    return year, month, day, ok
+
+def _digits_to_int(digits):
+    res = np.zeros(len(digits), dtype=np.int64)
+    for i in range(digits.shape[1]):
+        res = res * 10 + (digits[:, i].astype(np.int64) - ord("0"))
+    return res
+
+DAYS_IN_MONTH = np.array([0, 31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])
+
+def _days_in_month(year, month):
+    is_leap = ((year % 4 == 0) & (year % 100 != 0)) | (year % 400 == 0)
+    return DAYS_IN_MONTH[month] + ((month == 2) & is_leap)
+
+def _days_from_civil(year, month, day):
+    # nb of days since 1970-01-01 (proleptic gregorian calendar), as in calendar_index
+    year = year - (month <= 2)
+    era = np.floor_divide(year, 400)
+    yoe = year - era * 400
+    doy = (153 * (month + np.where(month > 2, -3, 9)) + 2) // 5 + day - 1
+    doe = yoe * 365 + yoe // 4 - yoe // 100 + doy
+    return era * 146097 + doe - 719468
+
+def _to_str(chars):
+    return np.ascontiguousarray(chars).view(f"S{chars.shape[1]}")[:, 0].astype(str).tolist()
+
+
+def iter_deces_rows(lines, stats):
+    for line in lines:
+        stats["nb_lines"] += 1
+        try:
+            yield parse_deces_line(line)
+        except (ParseError, ValueError) as exc:
+            _add_error(stats, exc)
+
+
+def parse_deces_line(line):
+    date_naissance = _parse_date(line[81:89].decode("utf-8"), def_month="06", def_day="15")
+    date_deces = _parse_date(line[154:162].decode("utf-8"))
+    lieu_deces = line[162:167].decode("utf-8")
+    naissance_dt = _to_dt(date_naissance)
+    deces_dt = _to_dt(date_deces)
+    age = max(0, min(100, _dt_to_annees(deces_dt - naissance_dt)))
+    return (
+        _parse_sex(line[80:81].decode("utf-8")),
+        calendar_index.to_day(date_naissance),
+        calendar_index.to_day(date_deces),
+        lieu_deces,
+        lieu_deces[:2],
+        age,
+        _parse_int(lieu_deces, 99999) < 96000
+    )
+
+
+# stats
+
+MAX_KEPT_ERRORS = 10
+
+def _new_stats():
+    return {"nb_lines": 0, "nb_errors": 0, "errors": []}
+
+def _add_error(stats, exc):
+    stats["nb_errors"] += 1
+    if len(stats["errors"]) < MAX_KEPT_ERRORS:
+        stats["errors"].append(exc)
+
+def _merge_stats(stats, other):
+    stats["nb_lines"] += other["nb_lines"]
+    stats["nb_errors"] += other["nb_errors"]
+    stats["errors"] += other["errors"][:MAX_KEPT_ERRORS-len(stats["errors"])]
+
+def print_stats(fname, stats):
+    nb_lines, nb_errors = stats["nb_lines"], stats["nb_errors"]
+    print(f"Nb errors for {fname}: {nb_errors} / {nb_lines} ({'{:.5f}'.format(100*nb_errors/max(nb_lines, 1))}%)")
+    for e in stats["errors"]: print(e)
+
+
+# parsing
+
+class ParseError(Exception):
+    pass
+
+class ParseSexError(ParseError):
+    pass
+
+def _parse_sex(val):
+    if val == "1": return "M"
+    if val == "2": return "F"
+    raise ParseSexError(f"Bad sex value: {val}")
+
+def _parse_int(val, def_val=0):
+    try:
+        return int(val)
+    except:
+        return def_val
+
+class DateParseError(ParseError):
+    pass
+
+def _parse_date(val, def_month=None, def_day=None):
+    try:
+        year = val[0:4]
+        month = val[4:6]
+        day = val[6:8]
+        if year=="0000":
+            raise DateParseError(f"Bad year value: {year}")
+        if month=="00":
+            if def_month:
+                month = def_month
+            else:
+                raise DateParseError(f"Bad month value: {month}")
+        if day=="00":
+            if def_day:
+                day = def_day
+            else:
+                raise DateParseError(f"Bad day value: {day}")
+        return f"{year}-{month}-{day}"
+    except Exception as exc:
+        raise DateParseError(exc)
+
+def _to_dt(date):
+    return datetime.strptime(date, '%Y-%m-%d')
+
+def _dt_to_annees(dt):
+    return int(dt.days / 365.25)
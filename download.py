@@ -0,0 +1,101 @@
+# downloads of the source files: a few at a time, streamed to a ".part" file
+# (resumed with an HTTP Range request after a crash), checked, then renamed
+import os
+import re
+import time
+import urllib.request
+import urllib.error
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import manifest
+import profiling
+
+WORKERS = 4
+CHUNK_SIZE = 1024 * 1024
+TIMEOUT = 60
+
+
+class DownloadError(Exception):
+    pass
+
+
+@profiling.profiled("download")
+def download_files(jobs, workers=WORKERS):
+    # jobs: dicts with "url" and "path", and optionally the expected "size" and "sha1" of the file
+    profiling.add_rows(len(jobs))
+    errors = []
+    with ThreadPoolExecutor(max(1, workers)) as executor:
+        futures = {
+            executor.submit(download_file, job["url"], job["path"], size=job.get("size"), sha1=job.get("sha1")): job
+            for job in jobs
+        }
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as exc:
+                print(f"Download {os.path.basename(futures[future]['path'])} FAILED: {exc}")
+                errors.append(futures[future]["path"])
+    if errors:
+        raise DownloadError(f"{len(errors)} download(s) failed: {', '.join(os.path.basename(p) for p in errors)}")
+
+
+def download_file(url, path, size=None, sha1=None):
+    fname = os.path.basename(path)
+    if os.path.exists(path):
+        # files are renamed once complete: only the expected size and hash are left to check
+        if _check_file(path, size, sha1) is None:
+            return False
+        print(f"Download {fname}: existing file does not match, download it again")
+        os.remove(path)
+    part_path = f"{path}.part"
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    start = time.time()
+    req = urllib.request.Request(url)
+    if offset:
+        req.add_header("Range", f"bytes={offset}-")
+    try:
+        with urllib.request.urlopen(req, timeout=TIMEOUT) as resp:
+            if offset and resp.status != 206:
+                # the server ignored the range: start again
+                offset = 0
+            length = resp.headers.get("Content-Length")
+            total = offset + int(length) if length is not None else None
+            with open(part_path, "ab" if offset else "wb") as file:
+                for chunk in iter(lambda: resp.read(CHUNK_SIZE), b""):
+                    file.write(chunk)
+    except urllib.error.HTTPError as exc:
+        # 416: nothing after offset, the part may be complete (crash before the rename)
+        if exc.code != 416:
+            raise
+        total = _parse_content_range_total(exc.headers.get("Content-Range"))
+        if total != offset:
+            os.remove(part_path)
+            raise DownloadError(f"{fname}: bad range {offset}- (size {total})")
+    nb_bytes = os.path.getsize(part_path)
+    if total is not None and nb_bytes != total:
+        # the part is kept, to be resumed
+        raise DownloadError(f"{fname}: incomplete ({nb_bytes} / {total} bytes)")
+    error = _check_file(part_path, size, sha1)
+    if error:
+        os.remove(part_path)
+        raise DownloadError(f"{fname}: {error}")
+    os.replace(part_path, path)
+    duration = time.time() - start
+    nb_read = nb_bytes - offset
+    print(f"Download {fname}: {nb_read / 1e6:.1f} MB in {duration:.1f}s ({nb_read / 1e6 / max(duration, 1e-6):.1f} MB/s){' (resumed)' if offset else ''}")
+    return True
+
+
+def _check_file(path, size, sha1):
+    # returns the error, if any
+    if size is not None and os.path.getsize(path) != size:
+        return f"bad size ({os.path.getsize(path)} instead of {size})"
+    if sha1 is not None and manifest.file_hash(path) != sha1:
+        return "bad sha1"
+    return None
+
+
+def _parse_content_range_total(val):
+    match = re.match(r"bytes (?:\d+-\d+|\*)/(\d+)", val or "")
+    return int(match.group(1)) if match else None
+
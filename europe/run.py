@@ -1,10 +1,12 @@
 #!/usr/bin/env python3
 import os
+import sys
 import click
-import requests
 
 HERE = os.path.dirname(__file__)
 DATA_DIR = os.path.join(HERE, "data")
+sys.path.insert(0, os.path.join(os.path.abspath(HERE), ".."))
+import download
 
 @click.group()
 def main():
@@ -20,7 +22,7 @@ def cmd_download_data():
 
 def download_data():
     _mkdir(DATA_DIR)
-    _download(
+    download.download_file(
         'https://ec.europa.eu/eurostat/estat-navtree-portlet-prod/BulkDownloadListing?file=data/tps00029.tsv.gz',
         os.path.join(DATA_DIR, "deaths.tsv.gz")
     )
@@ -31,12 +33,6 @@ def _mkdir(path):
     except Exception:
         pass
 
-def _download(url, ofpath):
-    if not os.path.exists(ofpath):
-        print(f"Download {os.path.basename(ofpath)}")
-        req = requests.get(url)
-        open(ofpath, 'wb').write(req.content)
-
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -2,15 +2,11 @@
 import os
 import sys
 import math
-import urllib.request
 import click
-import gzip
-import shutil
 import sqlite3
 import collections
 import csv
 import re
-import matplotlib.pyplot as plt
 from statistics import mean
 import traceback
 import jinja2
@@ -18,6 +14,11 @@ import jinja2
 HERE = os.path.abspath(os.path.dirname(__file__))
 DATA_DIR = os.path.join(HERE, 'data')
 RESULTS_DIR = os.path.join(HERE, 'results')
+sys.path.insert(0, os.path.join(HERE, ".."))
+import charts
+import utils
+import download
+import profiling
 
 FILE_CONFS = [
     {
@@ -86,6 +87,7 @@ AGE_MAX = 90  # after 90, data are less significant, and numbers should be summe
 
 
 @click.group()
+@profiling.cli_options
 def main():
     pass
 
@@ -103,12 +105,13 @@ def cmd_download_data():
     download_data()
 
 def download_data():
+    # files are kept gzipped, and decompressed on the fly when imported
     _mkdir(DATA_DIR)
-    for conf in FILE_CONFS:
-        fpath = os.path.join(DATA_DIR, conf['fname'])
-        if not os.path.exists(fpath):
-            _download(conf["url"], f"{fpath}.gz")
-            _ungzip(f"{fpath}.gz")
+    download.download_files([
+        {"url": conf["url"], "path": os.path.join(DATA_DIR, f"{conf['fname']}.gz")}
+        for conf in FILE_CONFS
+        if not os.path.exists(os.path.join(DATA_DIR, conf['fname']))
+    ])
 
 
 @main.command("import_data")
@@ -135,9 +138,10 @@ def import_data():
         _import_deaths(conn)
         _import_deaths_age_sex(conn)
 
+@profiling.profiled("import")
 def _import_population(conn):
     vals = collections.defaultdict(int)
-    with open(os.path.join(DATA_DIR, "population_age_sex.tsv"), newline='') as csvf:
+    with _open_data("population_age_sex.tsv") as csvf:
         for row in csv.DictReader(csvf, delimiter='\t'):
             ind, age, sex, geo = row["unit,age,sex,geo\\time"].split(",")
             age = _parse_age(age)
@@ -165,9 +169,10 @@ def _import_population(conn):
 #                 })
 #     _db_bulk_insert(conn, "population", db_rows)
 
+@profiling.profiled("import")
 def _import_deaths_age_sex(conn):
     vals = collections.defaultdict(int)
-    with open(os.path.join(DATA_DIR, "deaths_age_sex.tsv"), newline='') as csvf:
+    with _open_data("deaths_age_sex.tsv") as csvf:
         for row in csv.DictReader(csvf, delimiter='\t'):
             ind, sex, age, geo = row["unit,sex,age,geo\\time"].split(",")
             age = _parse_age(age)
@@ -182,10 +187,11 @@ def _import_deaths_age_sex(conn):
         "value": val
     } for (geo, year, sex, age), val in vals.items()])
 
+@profiling.profiled("import")
 def _import_deaths(conn):
     db_rows = []
    # 2020 from deaths.tsv
-    with open(os.path.join(DATA_DIR, "deaths.tsv"), newline='') as csvf:
+    with _open_data("deaths.tsv") as csvf:
         for row in csv.DictReader(csvf, delimiter='\t'):
             ind, geo = row["indic_de,geo\\time"].split(",")
             if ind == "DEATH_NR":
@@ -195,7 +201,7 @@ def _import_deaths(conn):
                     "value": _parse_int(row[f"2020 "])
                 })
     # before 2020 from deaths_age_sex.tsv
-    with open(os.path.join(DATA_DIR, "deaths_age_sex.tsv"), newline='') as csvf:
+    with _open_data("deaths_age_sex.tsv") as csvf:
         for row in csv.DictReader(csvf, delimiter='\t'):
             ind, sex, age, geo = row["unit,sex,age,geo\\time"].split(",")
             if ind == "NR" and sex == 'T' and age == 'TOTAL':
@@ -240,15 +246,18 @@ def _parse_age(val):
 @main.command("plot_deaths")
 @click.option("--start")
 @click.option("--country")
+@click.option("--workers", default=os.cpu_count(), help="Nb of processes rendering the charts")
 def cmd_plot_deaths(*args, **kwargs):
     plot_deaths(*args, **kwargs)
 
-def plot_deaths(start=None, country=None):
+@profiling.profiled("compute")
+def plot_deaths(start=None, country=None, workers=1):
     country_filter = country
     if not start: start = 1980
     ages = range(0, AGE_MAX+1)
     years_2019 = range(start, 2019+1)
     years_2020 = range(start, 2020+1)
+    report = []
     with db_connect() as conn:
         nb_country_ok = 0
         for code, country in COUNTRY_CODES.items():
@@ -328,7 +337,7 @@ def plot_deaths(start=None, country=None):
                     continue
                 nb_xticks, nb_years = 5, len(years_2020)
                 xticks_period = math.floor(nb_years/nb_xticks)
-                _plot(f"[{country}] Mortalite",
+                report.append(_chart(f"[{country}] Mortalite",
                     years_2020,
                     {
                         "Mortalité réelle": real_deaths,
@@ -337,11 +346,12 @@ def plot_deaths(start=None, country=None):
                     f'{code}_deaths.png',
                     axis=[None, None, 0, None],
                     xticks=[y if (2020-y) % xticks_period == 0 else None for y in years_2020]
-                )
+                ))
                 nb_country_ok += 1
             except Exception:
                 traceback.print_exc()
         print(f"Nb countries successfully computed: {nb_country_ok}/{len(COUNTRY_CODES)}")
+    charts.render_charts(report, workers=workers)
 
 
             # for year in range(start, 2019+1):
@@ -397,6 +407,10 @@ def plot_deaths(start=None, country=None):
 
 # utils
 
+def _open_data(fname):
+    # the gzipped file as downloaded, or the file itself if already ungzipped
+    return utils.open_source(utils.find_source(os.path.join(DATA_DIR, fname)), "rt", newline='')
+
 def _div(a, b):
     if not b: return 0
     return a / b
@@ -407,37 +421,26 @@ def _mkdir(path):
     except FileExistsError:
         pass
 
-def _download(url, ofpath):
-    if not os.path.exists(ofpath):
-        print(f'Download {os.path.basename(ofpath)}... ', end='')
-        sys.stdout.flush()
-        urllib.request.urlretrieve(url, ofpath)
-        print(f'DONE')
-
-def _ungzip(fpath):
-    with gzip.open(fpath, 'rb') as f_in:
-        with open(os.path.splitext(fpath)[0], 'wb') as f_out:
-            shutil.copyfileobj(f_in, f_out)
-    os.remove(fpath)
-
 def _db_bulk_insert(conn, table_name, values):
     if len(values) == 0:
         return
+    profiling.add_rows(len(values))
     conn.cursor().executemany(
         f"INSERT INTO {table_name} ({','.join(values[0].keys())}) VALUES ({','.join('?' for _ in range(len(values[0])))})",
         [list(v.values()) for v in values])
 
-def _plot(title, xs, yss, ofname, axis=None, xticks=None):
-    plt.clf()
-    plt.title(title)
+def _chart(title, xs, yss, ofname, axis=None, xticks=None):
+    chart = charts.new_chart()
+    charts.add(chart, "set_title", title)
     for label, ys in yss.items():
-        plt.plot(xs, ys, label=label)
+        charts.add(chart, "plot", xs, ys, label=label)
     if axis:
-        plt.axis(axis)
+        charts.add(chart, "axis", axis)
     if xticks:
-        plt.xticks(xs,xticks)
-    plt.legend()
-    plt.savefig(os.path.join(RESULTS_DIR, ofname))
+        charts.add(chart, "set_xticks", xs, xticks)
+    charts.add(chart, "legend")
+    chart["fpath"] = os.path.join(RESULTS_DIR, ofname)
+    return chart
 
 
 if __name__ == '__main__':
@@ -0,0 +1,125 @@
+# import_manifest: keeps track of the imported source files,
+# so that only new or changed files are (re)imported
+import os
+import hashlib
+from datetime import datetime
+
+import utils
+import profiling
+
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
+def init_manifest(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS import_manifest(id integer primary key, fname text unique, size integer, hash text, nb_rows integer, imported_at text)''')
+
+
+def create_table(conn, table, create_req):
+    # rows of tables created before the manifest can't be related to their file: start again
+    # same for tables with another schema, whose files are imported again
+    # returns True if an existing table was dropped
+    dropped = False
+    cols = [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+    if cols and ("file_id" not in cols or not is_same_schema(conn, table, create_req)):
+        if "file_id" in cols:
+            conn.execute(f"DELETE FROM import_manifest WHERE id IN (SELECT DISTINCT file_id FROM {table})")
+        conn.execute(f"DROP TABLE {table}")
+        bump_data_version(conn)
+        dropped = True
+    conn.execute(create_req)
+    return dropped
+
+
+def is_same_schema(conn, table, create_req):
+    row = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", [table]).fetchone()
+    return row is not None and row[0] == create_req.replace("IF NOT EXISTS ", "")
+
+
+def reset(conn, tables, fnames):
+    for table in tables:
+        conn.execute(f"DELETE FROM {table}")
+    conn.executemany("DELETE FROM import_manifest WHERE fname = ?", [[fname] for fname in fnames])
+    bump_data_version(conn)
+    conn.commit()
+
+
+def get_file_infos(conn, path):
+    # returns None if the file has already been imported as is
+    # (files are named without their compression extension, if any)
+    fname = utils.source_name(path)
+    size, hash = os.path.getsize(path), file_hash(path)
+    row = conn.execute("SELECT size, hash FROM import_manifest WHERE fname = ? AND nb_rows IS NOT NULL", [fname]).fetchone()
+    if row == (size, hash):
+        print(f"skip {fname} (already imported)")
+        return None
+    return {"fname": fname, "size": size, "hash": hash}
+
+
+def get_file_id(conn, fname):
+    row = conn.execute("SELECT id FROM import_manifest WHERE fname = ?", [fname]).fetchone()
+    return row[0] if row else None
+
+
+def start_file(conn, infos, tables):
+    # opens the file transaction: rows of a previous import of this file are removed
+    file_id = get_file_id(conn, infos["fname"])
+    if file_id is not None:
+        for table in tables:
+            conn.execute(f"DELETE FROM {table} WHERE file_id = ?", [file_id])
+        conn.execute("DELETE FROM import_manifest WHERE id = ?", [file_id])
+    cur = conn.execute(
+        "INSERT INTO import_manifest (fname, size, hash) VALUES (?, ?, ?)",
+        [infos["fname"], infos["size"], infos["hash"]])
+    return cur.lastrowid
+
+
+def end_file(conn, file_id, nb_rows):
+    conn.execute(
+        "UPDATE import_manifest SET nb_rows = ?, imported_at = ? WHERE id = ?",
+        [nb_rows, datetime.now().isoformat(timespec="seconds"), file_id])
+    bump_data_version(conn)
+    conn.commit()
+
+
+def import_file(conn, path, tables, import_fun):
+    # import_fun(file_id) inserts the rows of the file, and returns their number
+    infos = get_file_infos(conn, path)
+    if infos is None:
+        return False
+    try:
+        with profiling.stage("import", utils.source_name(path)):
+            file_id = start_file(conn, infos, tables)
+            nb_rows = import_fun(file_id)
+            profiling.add_rows(nb_rows or 0)
+            end_file(conn, file_id, nb_rows)
+    except BaseException:
+        conn.rollback()
+        raise
+    return True
+
+
+def update_file(conn, path):
+    # the file changed without changing its content (ex: compressed): its rows are kept
+    conn.execute(
+        "UPDATE import_manifest SET size = ?, hash = ? WHERE fname = ? AND nb_rows IS NOT NULL",
+        [os.path.getsize(path), file_hash(path), utils.source_name(path)])
+    conn.commit()
+
+
+# data version: changed with the contents of the imported tables, to invalidate what was computed from them
+# (see memo), kept in the user_version of the db file
+
+def get_data_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def bump_data_version(conn):
+    conn.execute(f"PRAGMA user_version = {get_data_version(conn) + 1}")
+
+
+def file_hash(path):
+    hash = hashlib.sha1()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(HASH_BLOCK_SIZE), b""):
+            hash.update(block)
+    return hash.hexdigest()
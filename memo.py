@@ -0,0 +1,78 @@
+# memoization of functions of the db contents, called as fun(conn, *args):
+# results are keyed on the db, its data version (bumped by the imports, see manifest.bump_data_version)
+# and the arguments, in a bounded LRU cache
+import copy
+import sqlite3
+from collections import OrderedDict
+from functools import wraps
+
+import manifest
+
+MAXSIZE = 1024
+
+CACHES = {}
+
+
+class LRUCache:
+
+    def __init__(self, maxsize=MAXSIZE):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+        self.hits = self.misses = 0
+
+    def get(self, key, default=None):
+        if key not in self.items:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self.items.move_to_end(key)
+        return self.items[key]
+
+    def put(self, key, val):
+        self.items[key] = val
+        self.items.move_to_end(key)
+        while len(self.items) > self.maxsize:
+            self.items.popitem(last=False)
+
+    def clear(self):
+        self.items.clear()
+        self.hits = self.misses = 0
+
+
+_MISSING = object()
+
+def memoize_db(maxsize=MAXSIZE):
+    # other sources than a sqlite connection (ex: a DeathTensor) are not cached
+    # (results are copied, so that callers can modify them)
+    def decorator(fun):
+        cache = CACHES[fun.__name__] = LRUCache(maxsize)
+        @wraps(fun)
+        def wrapper(src, *args):
+            if not isinstance(src, sqlite3.Connection):
+                return fun(src, *args)
+            key = (db_stamp(src), args)
+            res = cache.get(key, _MISSING)
+            if res is _MISSING:
+                res = fun(src, *args)
+                cache.put(key, res)
+            return copy.copy(res)
+        wrapper.cache = cache
+        return wrapper
+    return decorator
+
+
+def db_stamp(conn):
+    # (file of the db, data version), in-memory dbs being told apart by their connection
+    path = conn.execute("PRAGMA database_list").fetchone()[2]
+    return path or id(conn), manifest.get_data_version(conn)
+
+
+def clear():
+    for cache in CACHES.values():
+        cache.clear()
+
+
+def print_stats():
+    for name, cache in CACHES.items():
+        total = cache.hits + cache.misses
+        print(f"cache {name}: {cache.hits} hits, {cache.misses} misses ({100 * cache.hits / max(total, 1):.1f}% hits), {len(cache.items)} / {cache.maxsize} entries")
@@ -0,0 +1,252 @@
+# stage profiler, enabled by the --profile options of the scripts (see cli_options):
+# wall and cpu times, rows and time spent in sqlite of each stage (download, import of a file, computation,
+# chart rendering) and of each sql query, printed as a table at the end of the command,
+# with optionally a dump of the whole command as a cProfile file (pstats), or as sampled stacks
+# in the collapsed format of flame graphs (flamegraph.pl, speedscope, ...)
+import os
+import time
+import signal
+import sqlite3
+import cProfile
+import functools
+from collections import defaultdict
+
+import click
+
+ENABLED = False
+
+STAGES = {}   # (kind, name): Stats
+QUERIES = {}  # normalized sql: Stats
+_ACTIVE = []  # stack of the running stages
+
+PROFILE_FORMATS = ["pstats", "collapsed"]
+SAMPLING_INTERVAL = 0.001
+NB_QUERIES_SHOWN = 15
+
+
+class Stats:
+
+    def __init__(self):
+        self.calls = 0
+        self.wall = self.cpu = self.sql = 0.
+        self.rows = 0
+
+
+class stage:
+    # with stage("import", fname): ... (no-op if the profiler is not enabled)
+
+    def __init__(self, kind, name):
+        self.key = (kind, name)
+
+    def __enter__(self):
+        if ENABLED:
+            self.stats = STAGES.setdefault(self.key, Stats())
+            self.stats.calls += 1
+            self.start, self.start_cpu = time.perf_counter(), _cpu_time()
+            _ACTIVE.append(self.stats)
+        return self
+
+    def __exit__(self, *exc):
+        if ENABLED and getattr(self, "stats", None) in _ACTIVE:
+            self.stats.wall += time.perf_counter() - self.start
+            self.stats.cpu += _cpu_time() - self.start_cpu
+            _ACTIVE.remove(self.stats)
+
+
+def profiled(kind):
+    # decorator: each call of the function is a stage
+    def decorator(fun):
+        @functools.wraps(fun)
+        def wrapper(*args, **kwargs):
+            with stage(kind, fun.__name__):
+                return fun(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def add_rows(nb):
+    # rows processed by the current stage
+    if ENABLED and _ACTIVE:
+        _ACTIVE[-1].rows += nb
+
+
+def _cpu_time():
+    # (with the terminated children processes, ex: import or rendering workers)
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+# sql: the connections opened while profiling time their queries and count their fetched rows
+
+class ProfiledCursor(sqlite3.Cursor):
+
+    def execute(self, sql, *args):
+        self.query = _query_stats(sql)
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, *args)
+        finally:
+            _add_sql(self.query, time.perf_counter() - start)
+
+    def executemany(self, sql, seq_of_params):
+        self.query = _query_stats(sql)
+        params = _counted(self.query, seq_of_params)
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, params)
+        finally:
+            _add_sql(self.query, time.perf_counter() - start)
+
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            row = super().__next__()
+        finally:
+            _add_sql(self.query, time.perf_counter() - start)
+        self.query.rows += 1
+        return row
+
+    def fetchone(self):
+        return next(self, None)
+
+    def fetchmany(self, size=None):
+        return [row for _, row in zip(range(size or self.arraysize), self)]
+
+    def fetchall(self):
+        return list(self)
+
+
+class ProfiledConnection(sqlite3.Connection):
+
+    def cursor(self, factory=ProfiledCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, *args):
+        return self.cursor().execute(sql, *args)
+
+    def executemany(self, sql, seq_of_params):
+        return self.cursor().executemany(sql, seq_of_params)
+
+
+def _query_stats(sql):
+    stats = QUERIES.setdefault(" ".join(sql.split()), Stats())
+    stats.calls += 1
+    return stats
+
+def _counted(query, rows):
+    for row in rows:
+        query.rows += 1
+        yield row
+
+def _add_sql(query, duration):
+    query.wall += duration
+    # (nested stages include the time of their inner ones)
+    for stats in {id(stats): stats for stats in _ACTIVE}.values():
+        stats.sql += duration
+
+
+_connect = sqlite3.connect
+
+def _profiled_connect(*args, **kwargs):
+    kwargs.setdefault("factory", ProfiledConnection)
+    return _connect(*args, **kwargs)
+
+
+# whole command profiles
+
+class StackSampler:
+    # samples the python stack every SAMPLING_INTERVAL of cpu time, counted by collapsed stack
+
+    def __init__(self):
+        self.counts = defaultdict(int)
+
+    def start(self):
+        signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, SAMPLING_INTERVAL, SAMPLING_INTERVAL)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_DFL)
+
+    def _sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            stack.append(f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}")
+            frame = frame.f_back
+        self.counts[";".join(reversed(stack))] += 1
+
+    def dump(self, path):
+        with open(path, "w") as file:
+            for stack, count in self.counts.items():
+                file.write(f"{stack} {count}\n")
+
+
+_PROFILER = None
+
+def start(output=None, output_format="pstats"):
+    global ENABLED, _PROFILER
+    ENABLED = True
+    sqlite3.connect = _profiled_connect
+    if output:
+        _PROFILER = cProfile.Profile() if output_format == "pstats" else StackSampler()
+        _PROFILER.enable() if output_format == "pstats" else _PROFILER.start()
+
+
+def stop(output=None):
+    global ENABLED, _PROFILER
+    ENABLED = False
+    sqlite3.connect = _connect
+    if _PROFILER is not None:
+        if isinstance(_PROFILER, StackSampler):
+            _PROFILER.stop()
+            _PROFILER.dump(output)
+        else:
+            _PROFILER.disable()
+            _PROFILER.dump_stats(output)
+        print(f"profile saved in {output}")
+        _PROFILER = None
+
+
+def print_summary():
+    print(f"{'stage':<60} {'calls':>6} {'wall':>9} {'cpu':>9} {'sql':>9} {'rows':>10}")
+    for (kind, name), stats in STAGES.items():
+        _print_stats(f"{kind} {name}", stats, f"{stats.cpu:.3f}", f"{stats.sql:.3f}")
+    queries = sorted(QUERIES.items(), key=lambda item: -item[1].wall)
+    if queries:
+        print(f"{'sql query':<60}")
+        for sql, stats in queries[:NB_QUERIES_SHOWN]:
+            _print_stats(sql if len(sql) <= 60 else sql[:57] + "...", stats)
+        if len(queries) > NB_QUERIES_SHOWN:
+            print(f"... {len(queries) - NB_QUERIES_SHOWN} other queries")
+    # share of the commands time spent in sqlite, matplotlib and downloads, the rest being python
+    total = sum(stats.wall for (kind, _), stats in STAGES.items() if kind == "command")
+    if total:
+        shares = {
+            "sqlite": sum(stats.wall for stats in QUERIES.values()),
+            "matplotlib": sum(stats.wall for (kind, _), stats in STAGES.items() if kind == "render"),
+            "download": sum(stats.wall for (kind, _), stats in STAGES.items() if kind == "download"),
+        }
+        shares["python"] = max(0, total - sum(shares.values()))
+        print(f"total {total:.3f}s: " + ", ".join(f"{name} {100 * val / total:.1f}%" for name, val in shares.items()))
+
+
+def _print_stats(label, stats, cpu="", sql=""):
+    print(f"{label:<60} {stats.calls:>6} {stats.wall:>9.3f} {cpu:>9} {sql:>9} {stats.rows:>10}")
+
+
+def cli_options(fun):
+    # --profile options of a click group, its subcommand being the "command" stage
+    @click.option("--profile", is_flag=True, help="Print the time spent in each stage (import, query, computation, rendering) at exit")
+    @click.option("--profile-output", help="Save a profile of the whole command in this file (implies --profile)")
+    @click.option("--profile-format", type=click.Choice(PROFILE_FORMATS), default="pstats",
+        help="Format of --profile-output: cProfile stats, or collapsed stacks for flame graphs")
+    @functools.wraps(fun)
+    def wrapper(*args, profile, profile_output, profile_format, **kwargs):
+        if profile or profile_output:
+            ctx = click.get_current_context()
+            start(profile_output, profile_format)
+            ctx.call_on_close(print_summary)
+            ctx.call_on_close(lambda: stop(profile_output))
+            ctx.with_resource(stage("command", ctx.invoked_subcommand))
+        return fun(*args, **kwargs)
+    return wrapper
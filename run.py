@@ -4,33 +4,37 @@ import sys
 import re
 import click
 import sqlite3
-import urllib.request
-from datetime import datetime, timedelta
+import contextlib
+import io
+import time
 from collections import defaultdict
 from glob import glob
 import xlrd
-import matplotlib.pyplot as plt
-from math import floor
+import numpy as np
 from statistics import mean, stdev
 
-HERE = os.path.dirname(__file__)
-
-def _to_dt(date):
-    return datetime.strptime(date, '%Y-%m-%d')
+import deces
+import manifest
+import download
+import tensor
+import charts
+import utils
+import calendar_index
+import memo
+import profiling
 
-def _add_days(date, days):
-    dt = _to_dt(date)
-    dt += timedelta(days=days)
-    return dt.strftime('%Y-%m-%d')
+HERE = os.path.dirname(__file__)
 
+# ranges are (first day, last day) day numbers (see calendar_index)
 def _date_range(date, days):
-    return (date, _add_days(date, days))
+    day = calendar_index.to_day(date)
+    return (day, day + days)
 
 RANGES = {
     "pics_2017_2020": {
         "ranges": [
-            {"name":"Grippe (de 2017-01-01 à 2017-02-01)", "year":2017, "range":("2017-01-01", "2017-02-01")},
-            {"name":"Covid19 (de 2020-03-20 à 2020-04-20)", "year":2020, "range":("2020-03-20", "2020-04-20")},
+            {"name":"Grippe (de 2017-01-01 à 2017-02-01)", "year":2017, "range":calendar_index.range_to_days(("2017-01-01", "2017-02-01"))},
+            {"name":"Covid19 (de 2020-03-20 à 2020-04-20)", "year":2020, "range":calendar_index.range_to_days(("2020-03-20", "2020-04-20"))},
         ]
     },
     "2016_2020": {
@@ -73,8 +77,8 @@ RANGES = {
 for drkey, ranges in RANGES.items():
     duration = None
     for dr in ranges["ranges"]:
-        start_date, end_date = dr["range"]
-        dur = _to_dt(end_date) - _to_dt(start_date)
+        start_day, end_day = dr["range"]
+        dur = end_day - start_day
         if duration is None:
             duration = dur
         else:
@@ -150,6 +154,8 @@ def _get_conf_fname(conf):
     return conf.get("name") or os.path.basename(conf["src"])
 
 
+NB_AGES = 101
+
 CLAGES = {
     "0-39": (0, 39),
     "40-49": (40, 49),
@@ -161,121 +167,202 @@ CLAGES = {
 }
 
 
+TENSOR = None
+
 @click.group()
-def main():
-    pass
+@profiling.cli_options
+@click.option("--tensor", "tensor_path", help="Read deaths and population from a tensor saved by export_tensor, instead of the db")
+@click.option("--cache-stats", is_flag=True, help="Print the hits and misses of the memoized db lookups at exit")
+def main(tensor_path, cache_stats):
+    global TENSOR
+    if tensor_path:
+        TENSOR = tensor.load_tensor(tensor_path)
+    if cache_stats:
+        click.get_current_context().call_on_close(memo.print_stats)
 
 
 @main.command("all")
 @click.option("--import", "do_import", type=bool, default=True)
-def cmd_all(do_import):
+@click.option("--workers", default=os.cpu_count(), help="Nb of processes rendering the charts")
+def cmd_all(do_import, workers):
     if do_import:
         _download_data()
+        _init_db()
         _import_data()
-    compute_taux_mortalite_par_age("pics_2017_2020")
-    compute_taux_mortalite_par_age("2000_to_2021")
-    compute_deces_par_date("pics_2017_2020")
-    compute_population_par_age("pics_2017_2020")
-    compute_deces_par_age("pics_2017_2020")
-    compute_deces_par_age("2016_2020", simulate=True)
-    compute_mortalite_standardise("2000_to_2021")
-    compute_mortalite_standardise("2000_to_2021_juin")
-    compute_mortality_forecast()
-    compute_surmortality(debut=2010)
-    compute_surmortality(debut=2015)
-    compute_standard_mortality_by_date_clage(debut=2010)
+        _index_db()
+    start = time.time()
+    src = _load_all_source()
+    load_time = time.time() - start
+    start = time.time()
+    report = _compute_all(src)
+    compute_time = time.time() - start
+    start = time.time()
+    charts.render_charts(report, workers=workers)
+    print(f"load: {load_time:.1f}s, compute: {compute_time:.1f}s, render: {time.time() - start:.1f}s")
+
+
+@profiling.profiled("load")
+def _load_all_source():
+    # deaths and population are loaded once, and shared by all the computations
+    if TENSOR is not None:
+        return tensor.DeathTensor(np.array(TENSOR.deaths), np.array(TENSOR.pop), TENSOR.meta)
+    with _db_connect() as conn:
+        return tensor.build_tensor(conn, "2000-01-01", "2021-12-31", by_dep=False)
+
+
+def _compute_all(src):
+    return [
+        compute_taux_mortalite_par_age("pics_2017_2020", src=src),
+        compute_taux_mortalite_par_age("2000_to_2021", src=src),
+        compute_deces_par_date("pics_2017_2020", src=src),
+        compute_population_par_age("pics_2017_2020", src=src),
+        compute_deces_par_age("pics_2017_2020", src=src),
+        compute_deces_par_age("2016_2020", simulate=True, src=src),
+        compute_mortalite_standardise("2000_to_2021", src=src),
+        compute_mortalite_standardise("2000_to_2021_juin", src=src),
+        compute_mortality_forecast(src=src),
+        compute_surmortality(debut=2010, src=src),
+        compute_surmortality(debut=2015, src=src),
+        compute_standard_mortality_by_date_clage(debut=2010, src=src),
+    ]
 
 
 def _db_connect():
     return sqlite3.connect(os.path.join(HERE, "data.sqlite"))
 
 
-def _init_db():
+def _open_source(src=None):
+    # deaths and population are read from src (a DeathTensor) if any,
+    # then from the --tensor one, else from the db
+    if src is not None:
+        return contextlib.nullcontext(src)
+    if TENSOR is not None:
+        return contextlib.nullcontext(TENSOR)
+    return _db_connect()
+
+
+# matching the access paths of the compute commands (see explain_queries)
+# (deaths are counted from deces_agg, whose primary key starts with the date)
+DB_INDEXES = {
+    "ages_annee_age": "ages(annee, age, nb)",
+}
+OBSOLETE_DB_INDEXES = ["deces_metro_date_age"]
+
+def _init_db(full=False, compact=None):
+    # compact: deces table in its compact layout (see deces.create_table), None to keep the existing one
     with _db_connect() as conn:
-        cur = conn.cursor()
-        cur.execute('''CREATE TABLE IF NOT EXISTS deces(sex text, date_naissance text, date_deces text, lieu_deces text, age integer, is_metro bool)''')
-        cur.execute('''DELETE FROM deces''')
-        cur.execute('''CREATE TABLE IF NOT EXISTS ages(annee integer, age integer, nb integer)''')
-        cur.execute('''DELETE FROM ages''')
+        manifest.init_manifest(conn)
+        rebuild_agg = deces.create_table(conn, '''CREATE TABLE IF NOT EXISTS deces(sex text, date_naissance integer, date_deces integer, lieu_deces text, age integer, is_metro bool, file_id integer)''', compact=compact)
+        manifest.create_table(conn, "ages", '''CREATE TABLE IF NOT EXISTS ages(annee integer, age integer, nb integer, file_id integer)''')
+        deces.init_agg(conn, rebuild=rebuild_agg)
+        utils.drop_indexes(conn, OBSOLETE_DB_INDEXES)
+        if full:
+            # indexes are faster to build once the tables are filled
+            utils.drop_indexes(conn, DB_INDEXES)
+            manifest.reset(conn, ["deces", "deces_agg", "ages"], [_get_conf_fname(conf) for conf in DATA_FILES_CONFS])
+
+
+def _index_db():
+    print("index db")
+    with _db_connect() as conn:
+        utils.create_indexes(conn, DB_INDEXES)
 
 
 @main.command("download_data")
-def download_data_cmd():
-    _download_data()
+@click.option("--workers", default=download.WORKERS, help="Nb of concurrent downloads")
+def download_data_cmd(workers):
+    _download_data(workers=workers)
 
 
-def _download_data():
+def _download_data(workers=download.WORKERS):
     data_path = os.path.join(HERE, "data")
     if not os.path.exists(data_path):
         os.makedirs(data_path)
-    for conf in DATA_FILES_CONFS:
-        _download_data_file(conf)
-
-
-def _download_data_file(conf):
-    fname = _get_conf_fname(conf)
-    fpath = os.path.join(HERE, "data", fname)
-    if not os.path.exists(fpath):
-        print(f'Download {fname}... ', end='', flush=True)
-        urllib.request.urlretrieve(conf["src"], fpath)
-        print(f'DONE')
+    # (files kept compressed by compress_data are not downloaded again)
+    download.download_files([
+        {"url": conf["src"], "path": os.path.join(data_path, _get_conf_fname(conf)), "size": conf.get("size"), "sha1": conf.get("sha1")}
+        for conf in DATA_FILES_CONFS
+        if not utils.is_compressed(utils.find_source(os.path.join(data_path, _get_conf_fname(conf))))
+    ], workers=workers)
+
+
+@main.command("compress_data")
+@click.option("--format", "ext", type=click.Choice(["gz", "xz", "zst"]), default="gz")
+def cmd_compress_data(ext):
+    # death files are then read decompressed on the fly, without reimport
+    with _db_connect() as conn:
+        for conf in DATA_FILES_CONFS:
+            path = os.path.join(HERE, "data", _get_conf_fname(conf))
+            if conf["type"] != "deces" or not os.path.exists(path):
+                continue
+            size = os.path.getsize(path)
+            opath = utils.compress_file(path, f".{ext}")
+            print(f"compress {os.path.basename(path)}: {size / 1e6:.1f} MB -> {os.path.getsize(opath) / 1e6:.1f} MB")
+            manifest.update_file(conn, opath)
 
 
 @main.command("import_data")
-def import_data_cmd():
+@click.option("--batch-size", default=deces.BATCH_SIZE)
+@click.option("--workers", default=1, help="Nb of processes parsing death files")
+@click.option("--full", is_flag=True, help="Reimport all files, even the already imported ones")
+@click.option("--compact/--no-compact", default=None, help="Layout of the deces table (a change of layout reimports the deaths), default: keep the existing one")
+def import_data_cmd(batch_size, workers, full, compact):
+    _init_db(full=full, compact=compact)
+    _import_data(batch_size=batch_size, workers=workers)
+    _index_db()
+
+
+@main.command("compact_db")
+def cmd_compact_db():
+    # converts the deces table of an existing db to the compact layout, without reimport
+    db_path = os.path.join(HERE, "data.sqlite")
     _init_db()
-    _import_data()
-
-
-def _import_data():
+    before = (os.path.getsize(db_path), *_time_all())
+    with _db_connect() as conn:
+        if not deces.compact_table(conn):
+            print("deces table already compact")
+            return
+    after = (os.path.getsize(db_path), *_time_all())
+    for name, (size, load_time, compute_time) in (("before", before), ("after", after)):
+        print(f"{name}: db {size / 1e6:.1f} MB, all: load {load_time:.1f}s, compute {compute_time:.1f}s")
+
+
+def _time_all():
+    # (load, compute) times of the "all" command (charts are not rendered, nor their outputs printed)
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.time()
+        src = _load_all_source()
+        load_time = time.time() - start
+        start = time.time()
+        _compute_all(src)
+    return load_time, time.time() - start
+
+
+def _import_data(batch_size=deces.BATCH_SIZE, workers=1):
     with _db_connect() as conn:
         for conf in DATA_FILES_CONFS:
-            print(f"import {_get_conf_fname(conf)}")
-            if conf["type"] == "deces":
-               _import_deces_file(conn, conf)
-            if conf["type"] == "pyramide-des-ages":
-               _import_pda_file(conn, conf)
-            if conf["type"] == "pyramide-des-ages-2":
-                _import_pda2_file(conn, conf)
+            if conf["type"] in ("pyramide-des-ages", "pyramide-des-ages-2"):
+                path = os.path.join(HERE, "data", _get_conf_fname(conf))
+                manifest.import_file(conn, path, ["ages"], lambda file_id: _import_pda(conn, conf, file_id))
+        _import_deces_files(conn, [conf for conf in DATA_FILES_CONFS if conf["type"] == "deces"], batch_size=batch_size, workers=workers)
 
 
-def _import_deces_file(conn, conf):
-    fname = _get_conf_fname(conf)
-    path = os.path.join(HERE, "data", fname)
-    with open(path, 'rb') as file:
-        rows, errors = [], []
-        num_line = 1
-        nb_inserted = 0
-        for line in file.readlines():
-            try:
-                date_naissance = _parse_date(line[81:89].decode("utf-8"), def_month="06", def_day="15")
-                date_deces = _parse_date(line[154:162].decode("utf-8"))
-                lieu_deces = line[162:167].decode("utf-8")
-                naissance_dt = _to_dt(date_naissance)
-                deces_dt = _to_dt(date_deces)
-                age = max(0, min(100, _dt_to_annees(deces_dt - naissance_dt)))
-                parsed = {
-                    "sex": _parse_sex(line[80:81].decode("utf-8")),
-                    "date_naissance": date_naissance,
-                    "date_deces": date_deces,
-                    "lieu_deces": lieu_deces,
-                    "age": age,
-                    "is_metro": _parse_int(lieu_deces, 99999) < 96000
-                }
-                rows.append(parsed)
-                nb_inserted += 1
-            except Exception as exc:
-                if isinstance(exc, ParseError) or isinstance(exc, ValueError):
-                    errors.append(exc)
-                else:
-                    raise()
-            num_line += 1
-        print(f"Nb errors for {fname}: {len(errors)} / {num_line-1} ({'{:.5f}'.format(100*len(errors)/(num_line-1))}%)")
-        for e in errors[:10]: print(e)
-    _db_bulk_insert(conn, "deces", rows)
-
-
-def _import_pda_file(conn, conf):
+DECES_COLUMNS = ("sex", "date_naissance", "date_deces", "lieu_deces", "age", "is_metro")
+
+def _import_deces_files(conn, confs, batch_size=deces.BATCH_SIZE, workers=1):
+    paths = [utils.find_source(os.path.join(HERE, "data", _get_conf_fname(conf))) for conf in confs]
+    deces.import_deces_files(conn, paths, columns=DECES_COLUMNS, batch_size=batch_size, workers=workers)
+
+
+def _import_pda(conn, conf, file_id):
+    print(f"import {_get_conf_fname(conf)}")
+    if conf["type"] == "pyramide-des-ages":
+        return _import_pda_file(conn, conf, file_id)
+    if conf["type"] == "pyramide-des-ages-2":
+        return _import_pda2_file(conn, conf, file_id)
+
+
+def _import_pda_file(conn, conf, file_id):
     fname = _get_conf_fname(conf)
     path = os.path.join(HERE, "data", fname)
     book = xlrd.open_workbook(path)
@@ -320,12 +407,14 @@ def _import_pda_file(conn, conf):
     rows = [{
         "annee": annee,
         "age": age,
-        "nb": nb
+        "nb": nb,
+        "file_id": file_id
     } for (annee, age), nb in pop_by_annee_age.items()]
     _db_bulk_insert(conn, "ages", rows)
+    return len(rows)
 
 
-def _import_pda2_file(conn, conf):
+def _import_pda2_file(conn, conf, file_id):
     fname = _get_conf_fname(conf)
     path = os.path.join(HERE, "data", fname)
     book = xlrd.open_workbook(path)
@@ -357,9 +446,11 @@ def _import_pda2_file(conn, conf):
     rows = [{
         "annee": conf["annee"],
         "age": age,
-        "nb": nb
+        "nb": nb,
+        "file_id": file_id
     } for age, nb in res.items()]
     _db_bulk_insert(conn, "ages", rows)
+    return len(rows)
 
 
 @main.command("compute_taux_mortalite_par_age")
@@ -368,45 +459,51 @@ def _import_pda2_file(conn, conf):
 @click.argument("date_ranges", type=click.Choice(RANGES.keys()))
 def cmd_compute_taux_mortalite_par_age(date_ranges, min_age, max_age):
     print(f"compute taux_mortalite_par_age {date_ranges}")
-    compute_taux_mortalite_par_age(date_ranges, min_age=min_age, max_age=max_age)
+    charts.render_chart(compute_taux_mortalite_par_age(date_ranges, min_age=min_age, max_age=max_age))
 
 
-def compute_taux_mortalite_par_age(drkey, min_age=0, max_age=100):
-    plt.clf()
+@profiling.profiled("compute")
+def compute_taux_mortalite_par_age(drkey, min_age=0, max_age=100, src=None):
     ranges = RANGES[drkey]
     title = "[France] Taux de mortalité par âge"
     if "subtitle" in ranges:
         title += f' ({ranges["subtitle"]})'
-    plt.suptitle("[France] Taux de mortalité par âge")
-    plt.title("Source: INSEE - registre des décès", fontsize=10)
-    with _db_connect() as conn:
+    chart = charts.new_chart(suptitle="[France] Taux de mortalité par âge")
+    charts.add(chart, "set_title", "Source: INSEE - registre des décès", fontsize=10)
+    with _open_source(src) as src:
         age_range = list(range(min_age, max_age+1))
         for dr in ranges["ranges"]:
-            taux_mortalite_par_age = _compute_taux_mortalite_par_age(conn, dr["year"], dr["range"])
-            plt.plot(age_range, [taux_mortalite_par_age.get(i, 0) for i in age_range], label=dr["name"])
-    plt.legend()
-    plt.savefig(os.path.join(HERE, f'results/taux_mortalite_par_age_{drkey}.png'))
+            taux_mortalite_par_age = _compute_taux_mortalite_par_age(src, dr["year"], dr["range"])
+            charts.add(chart, "plot", age_range, [taux_mortalite_par_age.get(i, 0) for i in age_range], label=dr["name"])
+    charts.add(chart, "legend")
+    chart["fpath"] = os.path.join(HERE, f'results/taux_mortalite_par_age_{drkey}.png')
+    return chart
 
 
-def _select_pop_par_age(conn, annee):
-    rows = conn.cursor().execute(
-        '''SELECT age, SUM(nb) FROM ages WHERE annee = ? GROUP BY age''',
-        [annee]
-    )
+SQL_POP_PAR_AGE = '''SELECT age, SUM(nb) FROM ages WHERE annee = ? GROUP BY age'''
+
+@memo.memoize_db()
+def _select_pop_par_age(src, annee):
+    if isinstance(src, tensor.DeathTensor):
+        return src.pop_by_age(annee)
+    rows = src.cursor().execute(SQL_POP_PAR_AGE, [annee])
     return {age:nb for age, nb in rows}
 
 
-def _select_deces_par_age(conn, date_range):
-    rows = conn.cursor().execute(
-        '''SELECT age, count(*) FROM deces WHERE is_metro=true AND date_deces BETWEEN ? AND ? GROUP BY age''',
-        [*date_range]
-    )
+SQL_DECES_PAR_AGE = '''SELECT age, SUM(n) FROM deces_agg WHERE is_metro=true AND date BETWEEN ? AND ? GROUP BY age'''
+
+def _select_deces_par_age(src, day_range):
+    if isinstance(src, tensor.DeathTensor):
+        _, deaths = src.deaths_by_date_age(day_range)
+        return {age: nb for age, nb in enumerate(deaths.sum(axis=0).tolist()) if nb}
+    rows = src.cursor().execute(SQL_DECES_PAR_AGE, [*day_range])
     return {age: nb for age, nb in rows}
 
 
-def _compute_taux_mortalite_par_age(conn, year, date_range):
-    pop_par_age = _select_pop_par_age(conn, year)
-    nb_deces_par_age = _select_deces_par_age(conn, date_range)
+@memo.memoize_db()
+def _compute_taux_mortalite_par_age(src, year, day_range):
+    pop_par_age = _select_pop_par_age(src, year)
+    nb_deces_par_age = _select_deces_par_age(src, day_range)
     _div = lambda a, b: a/b if b else 0
     return {age: _div(nb, pop_par_age.get(age)) for age, nb in nb_deces_par_age.items()}
 
@@ -414,48 +511,54 @@ def _compute_taux_mortalite_par_age(conn, year, date_range):
 @main.command("compute_deces_par_date")
 @click.argument("date_ranges", type=click.Choice(RANGES.keys()))
 def cmd_compute_deces_par_date(date_ranges):
-    compute_deces_par_date(date_ranges)
+    charts.render_chart(compute_deces_par_date(date_ranges))
 
 
-def compute_deces_par_date(drkey, forecast_diff=False):
+@profiling.profiled("compute")
+def compute_deces_par_date(drkey, forecast_diff=False, src=None):
     print(f"compute deces_par_date {drkey}")
-    plt.clf()
-    plt.suptitle("[France] Décès par date")
-    plt.title("Source: INSEE - registre des décès", fontsize=10)
-    with _db_connect() as conn:
+    chart = charts.new_chart(suptitle="[France] Décès par date")
+    charts.add(chart, "set_title", "Source: INSEE - registre des décès", fontsize=10)
+    with _open_source(src) as src:
         for dr in RANGES[drkey]["ranges"]:
-            dates = _date_range_to_dates(dr["range"])
-            deces_par_date = _select_deces_par_date(conn, dr["range"])
-            plt.plot(range(len(dates)), [deces_par_date.get(d, 0) for d in dates], label=dr["name"])
-    plt.legend()
-    plt.savefig(os.path.join(HERE, f'results/deces_par_date_{drkey}.png'))
+            days = calendar_index.day_range(*dr["range"])
+            deces_par_date = _select_deces_par_date(src, dr["range"])
+            charts.add(chart, "plot", range(len(days)), [deces_par_date.get(d, 0) for d in days.tolist()], label=dr["name"])
+    charts.add(chart, "legend")
+    chart["fpath"] = os.path.join(HERE, f'results/deces_par_date_{drkey}.png')
+    return chart
 
 
-def _select_deces_par_date(conn, date_range):
-    rows = conn.cursor().execute(
-        '''SELECT date_deces, count(*) FROM deces WHERE is_metro=true AND date_deces BETWEEN ? AND ? GROUP BY date_deces''',
-        [*date_range]
-    )
-    return {_to_dt(date_deces): nb for date_deces, nb in rows}
+SQL_DECES_PAR_DATE = '''SELECT date, SUM(n) FROM deces_agg WHERE is_metro=true AND date BETWEEN ? AND ? GROUP BY date'''
+
+def _select_deces_par_date(src, day_range):
+    if isinstance(src, tensor.DeathTensor):
+        days, deaths = src.deaths_by_date_age(day_range)
+        rows = [(day, nb) for day, nb in zip(days.tolist(), deaths.sum(axis=1).tolist()) if nb]
+    else:
+        rows = src.cursor().execute(SQL_DECES_PAR_DATE, [*day_range])
+    return {day: nb for day, nb in rows}
 
 
 @main.command("compute_population_par_age")
 @click.argument("date_ranges", type=click.Choice(RANGES.keys()))
 def cmd_compute_population_par_age(drkey):
-    compute_population_par_age(drkey)
+    charts.render_chart(compute_population_par_age(drkey))
 
 
-def compute_population_par_age(drkey):
+@profiling.profiled("compute")
+def compute_population_par_age(drkey, src=None):
     print(f"compute population_par_age {drkey}")
-    plt.clf()
-    plt.title("[France] Population par âge")
+    chart = charts.new_chart()
+    charts.add(chart, "set_title", "[France] Population par âge")
     age_range = list(range(1, 101))
-    with _db_connect() as conn:
+    with _open_source(src) as src:
         for dr in RANGES[drkey]["ranges"]:
-            pop_par_age = _select_pop_par_age(conn, dr["year"])
-            plt.plot(age_range, [pop_par_age.get(i, 0) for i in age_range], label=dr["year"])
-    plt.legend()
-    plt.savefig(os.path.join(HERE, f'results/population_par_age_{drkey}.png'))
+            pop_par_age = _select_pop_par_age(src, dr["year"])
+            charts.add(chart, "plot", age_range, [pop_par_age.get(i, 0) for i in age_range], label=dr["year"])
+    charts.add(chart, "legend")
+    chart["fpath"] = os.path.join(HERE, f'results/population_par_age_{drkey}.png')
+    return chart
 
 
 @main.command("compute_deces_par_age")
@@ -463,34 +566,35 @@ def compute_population_par_age(drkey):
 @click.option("--simulate", is_flag=True)
 @click.option("--cum-diff", is_flag=True)
 def cmd_compute_deces_par_age(date_ranges, simulate, cum_diff):
-    compute_deces_par_age(date_ranges, simulate=simulate, cum_diff=cum_diff)
+    charts.render_chart(compute_deces_par_age(date_ranges, simulate=simulate, cum_diff=cum_diff))
 
 
-def compute_deces_par_age(drkey, simulate=False, cum_diff=False):
+@profiling.profiled("compute")
+def compute_deces_par_age(drkey, simulate=False, cum_diff=False, src=None):
     print(f"compute deces_par_age {drkey}")
-    plt.clf()
-    plt.suptitle("[France] Décès par âge")
-    plt.title("Source: INSEE - registre des décès", fontsize=10)
+    chart = charts.new_chart(suptitle="[France] Décès par âge")
+    charts.add(chart, "set_title", "Source: INSEE - registre des décès", fontsize=10)
     age_range = list(range(1, 101))
     nb_deces_par_age = {}
-    with _db_connect() as conn:
+    with _open_source(src) as src:
         for dr in RANGES[drkey]["ranges"]:
             name = dr["name"]
-            nb_deces_par_age[name] = _select_deces_par_age(conn, dr["range"])
-            plt.plot(age_range, [nb_deces_par_age[name].get(i, 0) for i in age_range], label=name)
+            nb_deces_par_age[name] = _select_deces_par_age(src, dr["range"])
+            charts.add(chart, "plot", age_range, [nb_deces_par_age[name].get(i, 0) for i in age_range], label=name)
         range1, range2 = RANGES[drkey]["ranges"][0], RANGES[drkey]["ranges"][1]
         name1, name2 = range1["name"], range2["name"]
         if simulate:
-            nb_deces_par_age["simulation"] = _simulate_deces_par_age(conn, range1["year"], range1["range"], range2["year"])
-            plt.plot(age_range, [nb_deces_par_age["simulation"].get(i, 0) for i in age_range], label=f"simulation: {range2['year']} population with {name1} mortality by age")
+            nb_deces_par_age["simulation"] = _simulate_deces_par_age(src, range1["year"], range1["range"], range2["year"])
+            charts.add(chart, "plot", age_range, [nb_deces_par_age["simulation"].get(i, 0) for i in age_range], label=f"simulation: {range2['year']} population with {name1} mortality by age")
         if cum_diff:
             cum_diffs = _cum_diff_dicts(nb_deces_par_age[name1], nb_deces_par_age[name2])
-            plt.plot(age_range, [cum_diffs.get(i, 0) for i in age_range], label=f"cum_diff: {name2} - {name1}")
+            charts.add(chart, "plot", age_range, [cum_diffs.get(i, 0) for i in age_range], label=f"cum_diff: {name2} - {name1}")
             if simulate:
                 sim_cum_diffs = _cum_diff_dicts(nb_deces_par_age["simulation"], nb_deces_par_age[name2])
-                plt.plot(age_range, [sim_cum_diffs.get(i, 0) for i in age_range], label=f"cum_diff: {name2} - simulation")
-    plt.legend()
-    plt.savefig(os.path.join(HERE, f'results/deces_par_age_{drkey}.png'))
+                charts.add(chart, "plot", age_range, [sim_cum_diffs.get(i, 0) for i in age_range], label=f"cum_diff: {name2} - simulation")
+    charts.add(chart, "legend")
+    chart["fpath"] = os.path.join(HERE, f'results/deces_par_age_{drkey}.png')
+    return chart
 
 
 def _cum_diff_dicts(dict_1, dict_2):
@@ -504,9 +608,9 @@ def _cum_diff_dicts(dict_1, dict_2):
     return res
 
 
-def _simulate_deces_par_age(conn, year1, range1, year2):
-    taux_mort = _compute_taux_mortalite_par_age(conn, year1, range1)
-    pop_par_age = _select_pop_par_age(conn, year2)
+def _simulate_deces_par_age(src, year1, range1, year2):
+    taux_mort = _compute_taux_mortalite_par_age(src, year1, range1)
+    pop_par_age = _select_pop_par_age(src, year2)
     return {
         age: taux_mort[age] * pop_par_age[age]
         for age in range(0, 101)
@@ -517,107 +621,147 @@ def _simulate_deces_par_age(conn, year1, range1, year2):
 @click.argument("date_ranges", type=click.Choice(RANGES.keys()))
 @click.option("--age-min", type=int, default=0)
 def cmd_compute_mortalite_standardise(date_ranges, age_min):
-    compute_mortalite_standardise(date_ranges, age_min=age_min)
+    charts.render_chart(compute_mortalite_standardise(date_ranges, age_min=age_min))
 
 
-def compute_mortalite_standardise(drkey, age_min=0):
+@profiling.profiled("compute")
+def compute_mortalite_standardise(drkey, age_min=0, src=None):
     print(f"compute mortalite_standardise {drkey}")
-    plt.clf()
     ranges = RANGES[drkey]
     title = "[France] Mortalité standardisé"
     if "subtitle" in ranges:
         title += f' ({ranges["subtitle"]})'
-    plt.suptitle(title)
-    plt.title("Source: INSEE - registre des décès", fontsize=10)
+    chart = charts.new_chart(suptitle=title)
+    charts.add(chart, "set_title", "Source: INSEE - registre des décès", fontsize=10)
     mortalite_standardise_par_annee = []
-    with _db_connect() as conn:
-        last_pop_par_age = _select_pop_par_age(conn, ranges["ranges"][-1]["year"])
+    with _open_source(src) as src:
+        last_pop_par_age = _select_pop_par_age(src, ranges["ranges"][-1]["year"])
         for dr in ranges["ranges"]:
             annee = dr["year"]
-            pop_par_age = _select_pop_par_age(conn, annee)
-            taux_mortalite_par_age = _compute_taux_mortalite_par_age(conn, annee, dr["range"])
+            pop_par_age = _select_pop_par_age(src, annee)
+            taux_mortalite_par_age = _compute_taux_mortalite_par_age(src, annee, dr["range"])
             taux_mortalite_standardise = {
                 age: last_pop_par_age.get(age, 0) * taux_mortalite_par_age.get(age, 0)
                 for age, pop in last_pop_par_age.items()
                 if age >= age_min
             }
             mortalite_standardise_par_annee.append(sum(taux_mortalite_standardise.values()))
-    plt.bar([dr["year"] for dr in ranges["ranges"]], mortalite_standardise_par_annee)
-    plt.legend()
-    plt.savefig(os.path.join(HERE, f'results/mortalite_standardise_{drkey}.png'))
+    charts.add(chart, "bar", [dr["year"] for dr in ranges["ranges"]], mortalite_standardise_par_annee)
+    charts.add(chart, "legend")
+    chart["fpath"] = os.path.join(HERE, f'results/mortalite_standardise_{drkey}.png')
+    return chart
 
 
 @main.command("compute_mortalite_par_annee")
 @click.argument("date_range", type=click.Choice(RANGES.keys()))
 def cmd_compute_mortalite_par_annee(date_range):
-    compute_mortalite_par_annee(date_range)
+    charts.render_chart(compute_mortalite_par_annee(date_range))
 
 
-def compute_mortalite_par_annee(drkey):
+@profiling.profiled("compute")
+def compute_mortalite_par_annee(drkey, src=None):
     print(f"compute mortalite_par_annee {drkey}")
-    plt.clf()
-    plt.suptitle("[France] Mortalité")
-    plt.title("Source: INSEE - registre des décès", fontsize=10)
+    chart = charts.new_chart(suptitle="[France] Mortalité")
+    charts.add(chart, "set_title", "Source: INSEE - registre des décès", fontsize=10)
     moyennes_mortalite = []
-    with _db_connect() as conn:
-        res = __compute_mortalite_par_annee(conn, [dr["year"] for dr in RANGES[drkey]["ranges"]])
-        plt.bar(res.keys(),res.values())
-        plt.legend()
-        plt.savefig(os.path.join(HERE, f'results/mortalite_par_annee_{drkey}.png'))
+    with _open_source(src) as src:
+        res = __compute_mortalite_par_annee(src, [dr["year"] for dr in RANGES[drkey]["ranges"]])
+        charts.add(chart, "bar", list(res.keys()), list(res.values()))
+        charts.add(chart, "legend")
+        chart["fpath"] = os.path.join(HERE, f'results/mortalite_par_annee_{drkey}.png')
+        return chart
 
 
-def __compute_mortalite_par_annee(conn, annees):
-    cur = conn.cursor()
+SQL_NB_DECES = '''SELECT SUM(n) FROM deces_agg WHERE is_metro=true AND date between ? and ?'''
+
+def __compute_mortalite_par_annee(src, annees):
     res = {}
     for annee in annees:
-        row = cur.execute(
-            '''SELECT count(*) FROM deces WHERE is_metro=true AND date_deces between ? and ?''',
-            (str(annee), str(annee+1))
-        ).fetchone()
-        res[annee] = row[0]
+        if isinstance(src, tensor.DeathTensor):
+            res[annee] = int(src.deaths_by_date_age(calendar_index.year_range(annee))[1].sum())
+            continue
+        row = src.execute(SQL_NB_DECES, calendar_index.year_range(annee)).fetchone()
+        res[annee] = row[0] or 0
     return res
 
 
+FORECAST_MODES = ["poisson", "resample", "resample-poisson"]
+
 @main.command("compute_mortality_forecast")
-def cmd_compute_mortality_forecast():
-    compute_mortality_forecast()
+@click.option("--scenarios", default=1000, help="Nb of stochastic scenarios, shown as quantile bands (0: none)")
+@click.option("--mode", type=click.Choice(FORECAST_MODES), default="resample-poisson",
+    help="poisson: deaths drawn from a Poisson law, resample: mortality rates of a random year of the reference ones")
+@click.option("--seed", type=int)
+def cmd_compute_mortality_forecast(scenarios, mode, seed):
+    charts.render_chart(compute_mortality_forecast(nb_scenarios=scenarios, mode=mode, seed=seed))
 
 
-def compute_mortality_forecast():
+@profiling.profiled("compute")
+def compute_mortality_forecast(nb_scenarios=0, mode="resample-poisson", seed=None, src=None):
     print("compute mortality_forecast")
-    plt.clf()
-    plt.title("[France] Prévision de mortalité")
-    DEBUT_PREV = 2010
-    with _db_connect() as conn:
-        mortalite_reelle_par_annee = __compute_mortalite_par_annee(conn, range(DEBUT_PREV, 2020+1))
-        taux_mortalite_par_age_moyen = _compute_taux_mortalite_par_age_moyen(conn, DEBUT_PREV, 2019)
-        prev_morts = {}
-        pop_par_age = _select_pop_par_age(conn, DEBUT_PREV)
-        def _estimate_mort_par_age():
-            return {
-                age: floor(pop_par_age[age] * taux_mortalite_par_age_moyen[age])
-                for age in range(0, 100+1)
-            }
-        mort_par_age = _estimate_mort_par_age()
-        prev_morts[DEBUT_PREV] = sum(mort_par_age.values())
-        for annee in range(DEBUT_PREV+1, 2050+1):
-            pop_par_age[100] = max(0, pop_par_age[99] - mort_par_age[99]) + max(0, pop_par_age[100] - mort_par_age[100])
-            for age in reversed(range(1, 99+1)):
-                pop_par_age[age] = max(0, pop_par_age[age-1] - mort_par_age[age-1])
-            mort_par_age = _estimate_mort_par_age()
-            sum_morts = sum(mort_par_age.values())
-            prev_morts[annee] = sum_morts
-            # print(annee, mortalite_reelle_par_annee.get(annee, 0), sum_morts)
-    plt.bar(mortalite_reelle_par_annee.keys(), mortalite_reelle_par_annee.values(), label="Mortalité réelle")
-    plt.plot(prev_morts.keys(), prev_morts.values(), 'r', label="Prévision de mortalité")
-    plt.legend()
-    plt.savefig(os.path.join(HERE, 'results/prevision_morts.png'))
-    # print("Ecart type", stdev([(prev_morts[annee]-mortalite_reelle_par_annee[annee]) for annee in range(DEBUT_PREV, 2020+1)]))
-
-
-def _compute_taux_mortalite_par_age_moyen(conn, annee1, annee2):
+    chart = charts.new_chart()
+    charts.add(chart, "set_title", "[France] Prévision de mortalité")
+    DEBUT_PREV, FIN_TAUX_MORTALITE, FIN_PREV = 2010, 2019, 2050
+    with _open_source(src) as src:
+        mortalite_reelle_par_annee = __compute_mortalite_par_annee(src, range(DEBUT_PREV, 2020+1))
+        taux_mortalite_par_age_moyen = _compute_taux_mortalite_par_age_moyen(src, DEBUT_PREV, FIN_TAUX_MORTALITE)
+        pop_par_age = _select_pop_par_age(src, DEBUT_PREV)
+        pop = np.array([pop_par_age[age] for age in range(NB_AGES)], dtype=np.float64)
+        taux_moyen = np.array([taux_mortalite_par_age_moyen[age] for age in range(NB_AGES)])
+        annees = list(range(DEBUT_PREV, FIN_PREV+1))
+        prev_morts = _project_deaths(pop, taux_moyen[None, :], len(annees))[0]
+        if nb_scenarios:
+            taux_par_annee = _taux_mortalite_matrix(src, DEBUT_PREV, FIN_TAUX_MORTALITE) if "resample" in mode else taux_moyen[None, :]
+            start = time.time()
+            scenarios = _project_deaths(pop, taux_par_annee, len(annees), nb_scenarios=nb_scenarios, poisson="poisson" in mode, rng=np.random.default_rng(seed))
+            print(f"{nb_scenarios} scenarios ({mode}) in {time.time() - start:.2f}s")
+    charts.add(chart, "bar", list(mortalite_reelle_par_annee.keys()), list(mortalite_reelle_par_annee.values()), label="Mortalité réelle")
+    if nb_scenarios:
+        q05, q25, q50, q75, q95 = np.quantile(scenarios, [0.05, 0.25, 0.5, 0.75, 0.95], axis=0)
+        charts.add(chart, "fill_between", annees, q05, q95, color='r', alpha=0.15, linewidth=0, label=f"Scénarios ({mode}): 5%-95%")
+        charts.add(chart, "fill_between", annees, q25, q75, color='r', alpha=0.3, linewidth=0, label="25%-75%")
+        charts.add(chart, "plot", annees, q50, 'r--', linewidth=1, label="médiane")
+    charts.add(chart, "plot", annees, prev_morts.tolist(), 'r', label="Prévision de mortalité")
+    charts.add(chart, "legend")
+    chart["fpath"] = os.path.join(HERE, 'results/prevision_morts.png')
+    return chart
+
+
+def _project_deaths(pop, taux, nb_years, nb_scenarios=1, poisson=False, rng=None):
+    # projection of the deaths of the population pop [age], by [scenario, year], nb_years from its year
+    # each year: deaths = pop * rates, then the survivors get one year older (100 being 100+)
+    # and the nb of people aged 0 is kept (no births)
+    # taux: mortality rates by [ref year, age], each scenario drawing one of them per year (if several)
+    # without poisson, deaths are rounded down
+    pop = np.repeat(pop[None, :], nb_scenarios, axis=0)
+    res = np.empty((nb_scenarios, nb_years))
+    for year in range(nb_years):
+        if len(taux) > 1:
+            year_taux = taux[rng.integers(len(taux), size=nb_scenarios)]
+        else:
+            year_taux = taux
+        deaths = rng.poisson(pop * year_taux).astype(np.float64) if poisson else np.floor(pop * year_taux)
+        res[:, year] = deaths.sum(axis=1)
+        survivors = np.maximum(pop - deaths, 0)
+        pop[:, 1:-1] = survivors[:, :-2]
+        pop[:, -1] = survivors[:, -2] + survivors[:, -1]
+    return res
+
+
+def _taux_mortalite_matrix(src, annee1, annee2):
+    # mortality rates by [year, age]
+    return np.array([
+        [taux.get(age, 0) for age in range(NB_AGES)]
+        for taux in (
+            _compute_taux_mortalite_par_age(src, annee, calendar_index.year_range(annee))
+            for annee in range(annee1, annee2+1)
+        )
+    ])
+
+
+def _compute_taux_mortalite_par_age_moyen(src, annee1, annee2):
     taux_mortalite_par_age_par_annee = {
-        annee: _compute_taux_mortalite_par_age(conn, annee, (f"{annee}-01-01", f"{annee}-12-31"))
+        annee: _compute_taux_mortalite_par_age(src, annee, calendar_index.year_range(annee))
         for annee in range(annee1, annee2+1)
     }
     return {
@@ -632,20 +776,21 @@ def _compute_taux_mortalite_par_age_moyen(conn, annee1, annee2):
 @main.command("compute_surmortality")
 @click.option("--debut", default=2010)
 def cmd_compute_surmortality(debut):
-    compute_surmortality(debut=debut)
+    charts.render_chart(compute_surmortality(debut=debut))
 
-def compute_surmortality(debut=2010):
+@profiling.profiled("compute")
+def compute_surmortality(debut=2010, src=None):
     print("compute surmortality")
-    plt.clf()
-    plt.title("[France] Surmortalité")
+    chart = charts.new_chart()
+    charts.add(chart, "set_title", "[France] Surmortalité")
     DEBUT = 2010
     FIN_TAUX_MORTALITE = 2019
     FIN = 2020
-    with _db_connect() as conn:
-        mortalite_reelle_par_annee = __compute_mortalite_par_annee(conn, range(debut, FIN+1))
-        taux_mortalite_par_age_moyen = _compute_taux_mortalite_par_age_moyen(conn, debut, FIN_TAUX_MORTALITE)
+    with _open_source(src) as src:
+        mortalite_reelle_par_annee = __compute_mortalite_par_annee(src, range(debut, FIN+1))
+        taux_mortalite_par_age_moyen = _compute_taux_mortalite_par_age_moyen(src, debut, FIN_TAUX_MORTALITE)
         pop_par_ages = {
-            annee: _select_pop_par_age(conn, annee)
+            annee: _select_pop_par_age(src, annee)
             for annee in range(debut, FIN+1)
         }
         mortalite_estimee_par_annee = {
@@ -660,152 +805,153 @@ def compute_surmortality(debut=2010):
             for annee in range(debut, FIN+1)
         }
         surmortalite_stdev = stdev(surmortalite_par_annee.values())
-    plt.bar(range(debut, FIN+1), surmortalite_par_annee.values(), label=f"Surmortalité (avec taux mortalité moyen depuis {debut})")
-    plt.hlines(surmortalite_stdev, debut, FIN, colors='r')
-    plt.legend()
-    plt.savefig(os.path.join(HERE, f'results/surmortalite_{debut}.png'))
+    charts.add(chart, "bar", range(debut, FIN+1), list(surmortalite_par_annee.values()), label=f"Surmortalité (avec taux mortalité moyen depuis {debut})")
+    charts.add(chart, "hlines", surmortalite_stdev, debut, FIN, colors='r')
+    charts.add(chart, "legend")
+    chart["fpath"] = os.path.join(HERE, f'results/surmortalite_{debut}.png')
+    return chart
 
 
 @main.command("compute_standard_mortality_by_date_clage")
 @click.option("--debut", default=2010)
-@click.option("--dep")
+@click.option("--dep", help="Department code (2 first chars of the death place code)")
 @click.option("--by-month", is_flag=True)
-def cmd_compute_standard_mortality_by_date_clage(debut, dep, by_month):
-    compute_standard_mortality_by_date_clage(debut=debut, dep=dep, by_month=by_month)
+@click.option("--by-year", is_flag=True)
+def cmd_compute_standard_mortality_by_date_clage(debut, dep, by_month, by_year):
+    charts.render_chart(compute_standard_mortality_by_date_clage(debut=debut, dep=dep, by_month=by_month, by_year=by_year))
 
-def compute_standard_mortality_by_date_clage(debut=2010, dep=None, by_month=None):
+@profiling.profiled("compute")
+def compute_standard_mortality_by_date_clage(debut=2010, dep=None, by_month=None, by_year=None, src=None):
     print("compute_standard_mortality_by_date_clage")
     last_year = 2021
-    all_dates = []
-    deces_standardise_par_clage = { clage:{} for clage in CLAGES }
-    with _db_connect() as conn:
-        last_pop_par_age = _select_pop_par_age(conn, last_year)
-        for year in range(debut, last_year+1):
-            pop_par_age = _select_pop_par_age(conn, year)
-            req = "SELECT date_deces, age, count(*) FROM deces WHERE is_metro=true AND date_deces between ? and ?"
-            if dep: req += f" AND lieu_deces LIKE '{dep}%'"
-            req += " GROUP BY date_deces, age"
-            deces_par_date_age = {
-                (date, age): val
-                for date, age, val in conn.execute(req, (str(year), str(year+1)))
-            }
-            dates = sorted(set(d for (d, _) in deces_par_date_age.keys()))
-            deces_standard_par_date_age = {
-                (date, age): val * last_pop_par_age.get(age, 0) / pop_par_age.get(age, 1)
-                for (date, age), val in deces_par_date_age.items()
-            }
-            deces_standard_par_date_clage = {
-                (date, clage): sum(
-                    deces_standard_par_date_age.get((date, age),0)
-                    for age in range(age_range[0], age_range[1]+1)
-                )
-                for date in dates
-                for clage, age_range in CLAGES.items()
-            }
-            if by_month:
-                _dates, _deces_standard_par_date_clage = [], {}
-                for (date, clage), val in deces_standard_par_date_clage.items():
-                    month = date[:7]
-                    if not _dates or _dates[-1] != month: _dates.append(month)
-                    if (month, clage) not in _deces_standard_par_date_clage: _deces_standard_par_date_clage[(month, clage)] = []
-                    _deces_standard_par_date_clage[(month, clage)].append(val)
-                for k, vs in _deces_standard_par_date_clage.items():
-                    _deces_standard_par_date_clage[k] = sum(vs)
-                dates = _dates
-                deces_standard_par_date_clage = _deces_standard_par_date_clage
-            for clage in CLAGES:
-                for date in dates:
-                    deces_standardise_par_clage[clage][date] = deces_standard_par_date_clage[(date, clage)]
-            all_dates += dates
-    
-    for d, v in zip(all_dates, [ sum(deces_standardise_par_clage[clage].get(date,0) for clage in CLAGES.keys()) for date in all_dates]):
+    with _open_source(src) as src:
+        all_days, deces_standard_par_date_age = _compute_standard_deces_par_date_age(src, debut, last_year, dep=dep)
+    # [date, clage]
+    deces_standard_par_date_clage = deces_standard_par_date_age @ _clages_matrix()
+    if by_month or by_year:
+        all_dates, deces_standard_par_date_clage = _sum_by_period(all_days, deces_standard_par_date_clage, "Y" if by_year else "M")
+    else:
+        all_dates = calendar_index.to_isos(all_days).tolist()
+
+    for d, v in zip(all_dates, deces_standard_par_date_clage.sum(axis=1).tolist()):
         print(d, v)
 
-    plt.clf()
     suptitle = ["[France] Mortalité standardisée"]
     if dep: suptitle.append(f"Département: {dep}")
-    plt.suptitle(", ".join(suptitle))
-    plt.title("Source: INSEE - registre des décès", fontsize=10)
-
-    plt.stackplot(
-        all_dates,
-        *[
-            [ deces_standardise_par_clage[clage].get(date,0) for date in all_dates ]
-            for clage in CLAGES.keys()
-        ],
-        labels=CLAGES.keys()
+    chart = charts.new_chart(suptitle=", ".join(suptitle))
+    charts.add(chart, "set_title", "Source: INSEE - registre des décès", fontsize=10)
+
+    # dates are placed by index: as categories, matplotlib would try to parse each of them
+    charts.add(chart, "stackplot",
+        range(len(all_dates)),
+        *deces_standard_par_date_clage.T,
+        labels=list(CLAGES.keys())
     )
-    plt.xticks([
-        d
-        for d in all_dates
-        if (not by_month and d.endswith("-01-01")) or (by_month and d.endswith("-01"))
-    ], rotation=20, ha='right')
-    plt.legend(ncol=4)
+    xticks = [
+        (i, d)
+        for i, d in enumerate(all_dates)
+        if by_year or (not by_month and d.endswith("-01-01")) or (by_month and d.endswith("-01"))
+    ]
+    charts.add(chart, "set_xticks", [i for i, _ in xticks], [d for _, d in xticks], rotation=20, ha='right')
+    charts.add(chart, "legend", ncol=4)
     fpath = [f'results/standard_mortality_by_date_clage_{debut}']
     if dep: fpath.append(dep)
-    if by_month: fpath.append("by_month")
-    plt.savefig(os.path.join(HERE, '_'.join(fpath)+'.png'))
-
-
-
-# parsing
-
-class ParseError(Exception):
-    pass
-
-class ParseSexError(ParseError):
-    pass
-
-def _parse_sex(val):
-    if val == "1": return "M"
-    if val == "2": return "F"
-    raise ParseSexError(f"Bad sex value: {val}")
-
-def _parse_int(val, def_val=0):
-    try:
-        return int(val)
-    except:
-        return def_val
-
-class DateParseError(ParseError):
-    pass
-
-def _parse_date(val, def_month=None, def_day=None):
-    try:
-        year = val[0:4]
-        month = val[4:6]
-        day = val[6:8]
-        if year=="0000":
-            raise DateParseError(f"Bad year value: {year}")
-        if month=="00":
-            if def_month:
-                month = def_month
-            else:
-                raise DateParseError(f"Bad month value: {month}")
-        if day=="00":
-            if def_day:
-                day = def_day
-            else:
-                raise DateParseError(f"Bad day value: {day}")
-        return f"{year}-{month}-{day}"
-    except Exception as exc:
-        raise DateParseError(exc)
-
-
-def _date_range_to_dates(date_range):
-    res = []
-    start, end = _to_dt(date_range[0]), _to_dt(date_range[1])
-    day = start
-    while day <= end:
-        res.append(day)
-        day += timedelta(days=1)
-    return res
+    if by_year: fpath.append("by_year")
+    elif by_month: fpath.append("by_month")
+    chart["fpath"] = os.path.join(HERE, '_'.join(fpath)+'.png')
+    return chart
+
+
+def _compute_standard_deces_par_date_age(src, debut, last_year, dep=None):
+    # (days, deaths by [date, age]), standardized on the population of last_year
+    # (dates without deaths are skipped)
+    last_pop = _pop_vector(_select_pop_par_age(src, last_year), 0)
+    all_days, res = [], []
+    for year in range(debut, last_year+1):
+        pop = _pop_vector(_select_pop_par_age(src, year), 1)
+        days, deces_par_date_age = _select_deces_matrix(src, calendar_index.year_range(year), dep=dep)
+        with_deces = deces_par_date_age.any(axis=1)
+        all_days.append(days[with_deces])
+        res.append(deces_par_date_age[with_deces] * last_pop / pop)
+    if not res:
+        return np.zeros(0, dtype=np.int64), np.zeros((0, NB_AGES))
+    return np.concatenate(all_days), np.concatenate(res)
+
+
+def _pop_vector(pop_par_age, default):
+    return np.array([pop_par_age.get(age, default) for age in range(NB_AGES)], dtype=np.float64)
+
+
+def _clages_matrix():
+    # [age, clage] = 1 if age is in clage
+    ages = np.arange(NB_AGES)[:, None]
+    return np.hstack([
+        (ages >= age_range[0]) & (ages <= age_range[1])
+        for age_range in CLAGES.values()
+    ]).astype(np.float64)
+
+
+def _sum_by_period(days, values, unit):
+    # sums the rows of values by period of days (sorted), unit being "M" for months, "Y" for years
+    # returns the periods as ISO labels ("2020-01", "2020")
+    periods = calendar_index.to_datetimes(days).astype(f"datetime64[{unit}]")
+    if len(periods) == 0:
+        return [], values
+    starts = np.flatnonzero(np.r_[True, periods[1:] != periods[:-1]])
+    return periods[starts].astype(str).tolist(), np.add.reduceat(values, starts, axis=0)
+
+
+SQL_DECES_PAR_DATE_AGE = "SELECT date, age, SUM(n) FROM deces_agg WHERE is_metro=true AND date between ? and ? GROUP BY date, age"
+SQL_DECES_PAR_DATE_AGE_DEP = "SELECT date, age, SUM(n) FROM deces_agg WHERE is_metro=true AND date between ? and ? AND dep LIKE ? GROUP BY date, age"
+
+def _select_deces_matrix(src, day_range, dep=None):
+    # (days, [date, age] deaths)
+    if isinstance(src, tensor.DeathTensor):
+        return src.deaths_by_date_age(day_range, dep=dep)
+    rows = list(_select_deces_par_date_age(src, day_range, dep=dep))
+    days, day_idx = np.unique(np.array([day for day, _, _ in rows], dtype=np.int64), return_inverse=True)
+    res = np.zeros((len(days), NB_AGES), dtype=np.int64)
+    res[day_idx, [age for _, age, _ in rows]] = [nb for _, _, nb in rows]
+    return days, res
+
+
+def _select_deces_par_date_age(src, day_range, dep=None):
+    if isinstance(src, tensor.DeathTensor):
+        days, deaths = src.deaths_by_date_age(day_range, dep=dep)
+        idx, ages = deaths.nonzero()
+        return zip(days[idx].tolist(), ages.tolist(), deaths[idx, ages].tolist())
+    if dep:
+        return src.execute(SQL_DECES_PAR_DATE_AGE_DEP, [*day_range, f"{dep}%"])
+    return src.execute(SQL_DECES_PAR_DATE_AGE, [*day_range])
+
+
+@main.command("export_tensor")
+@click.option("--start", default="2000-01-01")
+@click.option("--end", default="2021-12-31")
+@click.argument("path", default=os.path.join(HERE, "tensor"))
+def cmd_export_tensor(start, end, path):
+    with _db_connect() as conn:
+        tensor.save_tensor(tensor.build_tensor(conn, start, end), path)
 
 
-# utils
+# queries issued by the compute commands, with example arguments
+EXPLAINED_QUERIES = {
+    "pop_par_age": (SQL_POP_PAR_AGE, [2020]),
+    "deces_par_age": (SQL_DECES_PAR_AGE, [*calendar_index.year_range(2020)]),
+    "deces_par_date": (SQL_DECES_PAR_DATE, [*calendar_index.year_range(2020)]),
+    "nb_deces": (SQL_NB_DECES, [*calendar_index.year_range(2020)]),
+    "deces_par_date_age": (SQL_DECES_PAR_DATE_AGE, [*calendar_index.year_range(2020)]),
+    "deces_par_date_age_dep": (SQL_DECES_PAR_DATE_AGE_DEP, [*calendar_index.year_range(2020), "75%"]),
+}
 
-def _dt_to_annees(dt):
-    return int(dt.days / 365.25)
+@main.command("explain_queries")
+def cmd_explain_queries():
+    with _db_connect() as conn:
+        for name, (req, args) in EXPLAINED_QUERIES.items():
+            utils.print_query_plan(conn, name, req, args)
+
+
+# utils
 
 def _db_bulk_insert(conn, table_name, values):
     if len(values) == 0:
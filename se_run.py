@@ -8,6 +8,7 @@ import matplotlib.pyplot as plt
 from statistics import mean
 
 import utils
+import profiling
 
 HERE = os.path.dirname(__file__)
 DATA_DIR = os.path.join(HERE, "data", "se")
@@ -27,6 +28,7 @@ DATA_SE_AGE_PYRAMIDS_CONFS = [{
 
 
 @click.group()
+@profiling.cli_options
 def main():
     pass
 
@@ -65,6 +67,7 @@ def _import_data():
             _import_age_pyramid_file(conn, conf)
 
 
+@profiling.profiled("import")
 def _import_deces_file(conn, conf):
     fname = utils.get_conf_fname(conf)
     path = os.path.join(DATA_DIR, fname)
@@ -82,6 +85,7 @@ def _import_deces_file(conn, conf):
     } for (year, age), nb in deaths_by_year_age.items()])
 
 
+@profiling.profiled("import")
 def _import_age_pyramid_file(conn, conf):
     fname = utils.get_conf_fname(conf)
     path = os.path.join(DATA_DIR, fname)
@@ -101,6 +105,7 @@ def _import_age_pyramid_file(conn, conf):
 def compute_mortality_rate_meaned_by_age():
     _compute_mortality_rate_meaned_by_age()
 
+@profiling.profiled("compute")
 def _compute_mortality_rate_meaned_by_age():
     print("compute _compute_mortality_rate_meaned_by_age")
     plt.clf()
@@ -130,7 +135,8 @@ def _compute_mortality_rate_meaned_by_age():
     ]
     plt.bar(YEARS, mean_mortality_by_year)
     plt.legend()
-    plt.savefig(os.path.join(HERE, 'results/se_mortality_rate_meaned_by_age.png'))
+    with profiling.stage("render", "savefig"):
+        plt.savefig(os.path.join(HERE, 'results/se_mortality_rate_meaned_by_age.png'))
 
 
 def _select_pop_by_year_clage(conn):
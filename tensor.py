@@ -0,0 +1,121 @@
+# deaths (from deces_agg) and population (from ages) as dense numpy arrays,
+# saved as .npy files to be loaded with np.load(mmap_mode='r'):
+#   deaths.npy: nb of deaths by [day, age, stratum], a stratum being a (dep, is_metro) pair
+#   pop.npy: population by [year, age] (-1 when unknown)
+import os
+import json
+import numpy as np
+
+import calendar_index
+
+NB_AGES = 101
+FETCH_SIZE = 1000000
+
+
+# (sexes are summed by np.add.at, cheaper than a GROUP BY not following the primary key)
+SQL_DEATHS = "SELECT date, age, dep, is_metro, n FROM deces_agg WHERE date BETWEEN ? AND ?"
+# metropolitan deaths only, in a single stratum: much less rows to read
+SQL_METRO_DEATHS = "SELECT date, age, '', true, SUM(n) FROM deces_agg WHERE is_metro=true AND date BETWEEN ? AND ? GROUP BY date, age"
+
+
+def build_tensor(conn, start, end, by_dep=True):
+    # start, end: ISO dates
+    first_day, last_day = calendar_index.to_day(start), calendar_index.to_day(end)
+    if by_dep:
+        strata = [
+            (dep, bool(is_metro))
+            for dep, is_metro in conn.execute("SELECT DISTINCT dep, is_metro FROM deces_agg ORDER BY dep, is_metro")
+        ]
+    else:
+        strata = [("", True)]
+    strata_idx = {stratum: i for i, stratum in enumerate(strata)}
+    deaths = np.zeros((last_day - first_day + 1, NB_AGES, len(strata)), dtype=np.int64)
+    cur = conn.execute(SQL_DEATHS if by_dep else SQL_METRO_DEATHS, [first_day, last_day])
+    while True:
+        rows = cur.fetchmany(FETCH_SIZE)
+        if not rows:
+            break
+        date, age, dep, is_metro, n = zip(*rows)
+        day = np.array(date, dtype=np.int64) - first_day
+        stratum = [strata_idx[(d, bool(m))] for d, m in zip(dep, is_metro)]
+        np.add.at(deaths, (day, np.clip(age, 0, NB_AGES-1), np.array(stratum)), n)
+    if deaths.max(initial=0) < np.iinfo(np.uint16).max:
+        deaths = deaths.astype(np.uint16)
+    years = [year for year, in conn.execute("SELECT DISTINCT annee FROM ages ORDER BY annee")]
+    first_year = years[0] if years else int(start[:4])
+    pop = np.full((len(years) and years[-1] - first_year + 1, NB_AGES), -1, dtype=np.int64)
+    for year, age, nb in conn.execute("SELECT annee, age, SUM(nb) FROM ages GROUP BY annee, age"):
+        pop[year - first_year, age] = nb
+    meta = {"start": str(start), "strata": strata, "by_dep": by_dep, "first_year": first_year}
+    return DeathTensor(deaths, pop, meta)
+
+
+def save_tensor(tensor, path):
+    os.makedirs(path, exist_ok=True)
+    np.save(os.path.join(path, "deaths.npy"), tensor.deaths)
+    np.save(os.path.join(path, "pop.npy"), tensor.pop)
+    with open(os.path.join(path, "meta.json"), "w") as file:
+        json.dump(tensor.meta, file)
+
+
+def load_tensor(path, mmap_mode='r'):
+    # with mmap, nothing is read before being used, and the pages are shared by all the processes
+    with open(os.path.join(path, "meta.json")) as file:
+        meta = json.load(file)
+    return DeathTensor(
+        np.load(os.path.join(path, "deaths.npy"), mmap_mode=mmap_mode),
+        np.load(os.path.join(path, "pop.npy"), mmap_mode=mmap_mode),
+        meta)
+
+
+class DeathTensor:
+
+    def __init__(self, deaths, pop, meta):
+        self.deaths, self.pop, self.meta = deaths, pop, meta
+        self.first_day = calendar_index.to_day(meta["start"])
+        self.days = calendar_index.day_range(self.first_day, self.first_day + len(deaths) - 1)
+        self.deps = np.array([dep for dep, _ in meta["strata"]])
+        self.is_metro = np.array([is_metro for _, is_metro in meta["strata"]], dtype=bool)
+        self.first_year = meta["first_year"]
+
+    def date_slice(self, day_range):
+        # (first day, last day) included, as "date BETWEEN ? AND ?"
+        first, last = day_range
+        return slice(
+            min(max(first - self.first_day, 0), len(self.days)),
+            min(max(last + 1 - self.first_day, 0), len(self.days)))
+
+    def strata_mask(self, dep=None, metro=True):
+        mask = np.ones(len(self.deps), dtype=bool)
+        if metro is not None:
+            mask &= self.is_metro == metro
+        if dep:
+            if not self.meta["by_dep"]:
+                raise ValueError("tensor built without departments")
+            mask &= np.char.startswith(self.deps, dep)
+        return mask
+
+    def deaths_by_date_age(self, day_range, dep=None, metro=True):
+        sl = self.date_slice(day_range)
+        return self.days[sl], self.deaths[sl] @ self.strata_mask(dep=dep, metro=metro).astype(np.int64)
+
+    def deaths_by_date_dep_age(self, day_range, metro=True):
+        # [date, age, dep]
+        sl, mask = self.date_slice(day_range), self.strata_mask(metro=metro)
+        return self.days[sl], self.deps[mask], self.deaths[sl][:, :, mask]
+
+    def deaths_by_dep(self, metro=None):
+        mask = self.strata_mask(metro=metro)
+        deps = self.deps[mask]
+        totals = self.deaths[:, :, mask].sum(axis=(0, 1), dtype=np.int64)
+        res = {}
+        for dep, total in zip(deps.tolist(), totals.tolist()):
+            res[dep] = res.get(dep, 0) + total
+        return res
+
+    def pop_by_age(self, year):
+        # unknown ages are not returned, as with the ages table
+        idx = year - self.first_year
+        if idx < 0 or idx >= len(self.pop):
+            return {}
+        return {age: nb for age, nb in enumerate(self.pop[idx].tolist()) if nb >= 0}
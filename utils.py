@@ -1,4 +1,9 @@
 import os
+import gzip
+import lzma
+import shutil
+
+import profiling
 
 def get_conf_fname(conf):
     return conf.get("name") or os.path.basename(conf["src"])
@@ -6,10 +11,79 @@ def get_conf_fname(conf):
 def db_bulk_insert(conn, table_name, values):
     if len(values) == 0:
         return
+    profiling.add_rows(len(values))
     conn.cursor().executemany(
         f"INSERT INTO {table_name} ({','.join(values[0].keys())}) VALUES ({','.join('?' for _ in range(len(values[0])))})",
         [list(v.values()) for v in values])
 
 def parse_digits(val):
     digits = [d for d in val if d.isdigit()]
-    return int(''.join(digits))
\ No newline at end of file
+    return int(''.join(digits))
+
+def get_by_paquet(ite, size):
+    paquet = []
+    for val in ite:
+        paquet.append(val)
+        if len(paquet) >= size:
+            yield paquet
+            paquet = []
+    if paquet:
+        yield paquet
+
+def create_indexes(conn, indexes):
+    for name, on in indexes.items():
+        conn.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {on}")
+    conn.execute("ANALYZE")
+
+def drop_indexes(conn, indexes):
+    for name in indexes:
+        conn.execute(f"DROP INDEX IF EXISTS {name}")
+
+def print_query_plan(conn, name, req, args):
+    print(f"{name}: {req}")
+    for _, _, _, detail in conn.execute(f"EXPLAIN QUERY PLAN {req}", args):
+        # a SCAN not using an index reads the whole table
+        warn = "  <- FULL SCAN" if detail.startswith("SCAN") and "INDEX" not in detail else ""
+        print(f"  {detail}{warn}")
+
+# source files may be kept compressed: they are decompressed on the fly when read
+
+COMPRESSED_EXTS = (".gz", ".xz", ".zst")
+
+def find_source(path):
+    # the file itself, or else a compressed version of it
+    for p in [path] + [path + ext for ext in COMPRESSED_EXTS]:
+        if os.path.exists(p):
+            return p
+    return path
+
+def source_name(path):
+    # file name, without compression extension
+    fname = os.path.basename(path)
+    for ext in COMPRESSED_EXTS:
+        if fname.endswith(ext):
+            return fname[:-len(ext)]
+    return fname
+
+def is_compressed(path):
+    return path.endswith(COMPRESSED_EXTS)
+
+def open_source(path, mode="rb", **kwargs):
+    # binary ("rb") or text ("rt") stream of a source file, compressed or not
+    if path.endswith(".gz"):
+        return gzip.open(path, mode, **kwargs)
+    if path.endswith(".xz"):
+        return lzma.open(path, mode, **kwargs)
+    if path.endswith(".zst"):
+        import zstandard  # optional, only needed for .zst files
+        return zstandard.open(path, mode, **kwargs)
+    return open(path, mode, **kwargs)
+
+def compress_file(path, ext=".gz"):
+    # path is replaced by path+ext, written to a temporary file first
+    opath, tmp_path = path + ext, f"{path}.tmp{ext}"
+    with open(path, "rb") as file, open_source(tmp_path, "wb") as ofile:
+        shutil.copyfileobj(file, ofile, 1024 * 1024)
+    os.replace(tmp_path, opath)
+    os.remove(path)
+    return opath
@@ -0,0 +1,51 @@
+# windowed statistics over the day axis of series (see calendar_index), from their cumulative sums:
+# sums and means over any [start, end) days in O(1) by stratum, and rolling windows
+import numpy as np
+
+ROLLING_WINDOWS = (7, 14, 30)
+
+
+class DayWindows:
+    # values: [day, ...strata] from first_day, nan where missing (not counted in the means)
+
+    def __init__(self, values, first_day=0):
+        values = np.asarray(values, dtype=float)
+        present = ~np.isnan(values)
+        self.first_day = first_day
+        self.nb_days = len(values)
+        self.sums = _prefix_sums(np.where(present, values, 0))
+        self.counts = _prefix_sums(present)
+
+    def _idx(self, day):
+        return np.clip(np.asarray(day) - self.first_day, 0, self.nb_days)
+
+    def sum(self, start, end):
+        # start and end: day numbers (or arrays of them), end excluded
+        return self.sums[self._idx(end)] - self.sums[self._idx(start)]
+
+    def count(self, start, end):
+        return self.counts[self._idx(end)] - self.counts[self._idx(start)]
+
+    def mean(self, start, end):
+        # nan if no value in the window
+        sums, counts = self.sum(start, end), self.count(start, end)
+        return np.divide(sums, counts, out=np.full(np.shape(sums), np.nan), where=counts > 0)
+
+    def rolling_sum(self, window, center=False):
+        return self.sum(*self._rolling_bounds(window, center))
+
+    def rolling_mean(self, window, center=False):
+        # by day: mean of the window days ending with it (or centered on it), truncated at the ends of the series
+        return self.mean(*self._rolling_bounds(window, center))
+
+    def _rolling_bounds(self, window, center):
+        days = np.arange(self.nb_days) + self.first_day
+        end = days + 1 + (window // 2 if center else 0)
+        return end - window, end
+
+
+def _prefix_sums(values):
+    # sums[i]: sum of the values before day index i
+    sums = np.zeros((len(values) + 1, *np.shape(values)[1:]))
+    np.cumsum(values, axis=0, out=sums[1:])
+    return sums